@@ -0,0 +1,118 @@
+"""
+URL configuration for requests served over ASGI (see ASGIURLConfMiddleware).
+
+The read-only pages and the JSON reads of single names, random names and
+substring search are served by async views using the async ORM; every other
+request, including writes and the browsable API on the same URLs, goes to the
+views of derbynames.urls. That includes the paginated name list
+(/api/names/) and prefix search (/api/starts-with/), which run their DRF
+pagination in a worker thread.
+"""
+
+import logging
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.urls import path, resolve
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.csrf import csrf_exempt
+
+from derbynames import urls
+from derbynames.names.caching import cache_page_policy, row_validators, table_validators
+from derbynames.names.models import DerbyName
+from derbynames.names.sampling import random_name
+from derbynames.names.search import search_limit, search_names
+from derbynames.names.views import detail_async, index_async, jersey_grid_async
+
+logger = logging.getLogger(__name__)
+
+
+def wants_json(request):
+    # DRF's negotiation: ?format= wins, else browsers get the browsable API
+    requested = request.GET.get("format")
+    if requested:
+        return requested == "json"
+    return "text/html" not in request.headers.get("Accept", "*/*")
+
+
+def json_reads(view):
+    """
+    Serve GET and HEAD requests for JSON from the async view; hand anything
+    else to the view derbynames.urls has for the same path. CSRF is left to
+    DRF, as for any DRF view.
+    """
+
+    @csrf_exempt
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method in ("GET", "HEAD") and wants_json(request):
+            response = await view(request, *args, **kwargs)
+            patch_vary_headers(response, ["Accept"])
+            return response
+        match = resolve(request.path_info, urlconf=urls)
+        return await sync_to_async(match.func)(request, *match.args, **match.kwargs)
+
+    return wrapper
+
+
+def name_json(name):
+    # DerbyNameSerializer's representation
+    return {"id": name.id, "name": name.name} if name else {"name": ""}
+
+
+def json_response(data, **kwargs):
+    # Byte for byte what DRF's JSONRenderer writes
+    return JsonResponse(
+        data,
+        safe=False,
+        json_dumps_params={"separators": (",", ":"), "ensure_ascii": False},
+        **kwargs,
+    )
+
+
+async def name_validators(request, pk):
+    updated_at = (
+        await DerbyName.objects.filter(pk=pk)
+        .values_list("updated_at", flat=True)
+        .afirst()
+    )
+    return row_validators(updated_at, variant="json-")
+
+
+@json_reads
+@cache_page_policy("detail", name_validators)
+async def name_detail(request, pk):
+    name = await DerbyName.objects.filter(pk=pk).afirst()
+    if name is None:
+        return json_response(
+            {"detail": "No DerbyName matches the given query."}, status=404
+        )
+    return json_response(name_json(name))
+
+
+@json_reads
+@cache_page_policy("random")
+async def random_name_view(request):
+    return json_response(name_json(await sync_to_async(random_name)()))
+
+
+@json_reads
+@cache_page_policy(
+    "listing", lambda request, substring: table_validators(DerbyName, variant="json-")
+)
+async def name_contains(request, substring):
+    limit = search_limit(request.GET.get("limit"))
+    names = search_names(substring.lower(), limit)
+    return json_response([name_json(name) async for name in names])
+
+
+urlpatterns = [
+    path("", index_async, name="index"),
+    path("names/<int:name_id>/", detail_async, name="name-detail"),
+    path("jerseys/", jersey_grid_async, name="jersey-grid"),
+    path("api/names/<int:pk>/", name_detail),
+    path("api/random-name/", random_name_view),
+    path("api/contains/<path:substring>/", name_contains),
+    *urls.urlpatterns,
+]
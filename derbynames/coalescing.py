@@ -0,0 +1,250 @@
+import hashlib
+from logging import getLogger
+from threading import Event, Lock
+from time import monotonic
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+
+from derbynames.instrumentation import current as current_request_metrics
+
+logger = getLogger(__name__)
+
+COALESCED_METHODS = ("GET", "HEAD")
+
+# Headers that change the response for the same URL: content negotiation and
+# conditional GET
+VARYING_HEADERS = ("HTTP_ACCEPT", "HTTP_IF_NONE_MATCH", "HTTP_IF_MODIFIED_SINCE")
+
+
+class CoalescingMetrics:
+    """
+    Running counts of coalesced requests: `leader` requests ran the view,
+    `joined` waited for one in flight, `reused` got a finished result within
+    its TTL, and `solo` ran the view themselves because the shared result
+    could not be used.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.counts = {}
+
+    def incr(self, counter, amount=1):
+        with self._lock:
+            self.counts[counter] = self.counts.get(counter, 0) + amount
+
+    def as_dict(self):
+        with self._lock:
+            counts = dict(self.counts)
+        requests = sum(counts.values())
+        shared = counts.get("joined", 0) + counts.get("reused", 0)
+        return {
+            "counts": counts,
+            "requests": requests,
+            "ratio": shared / requests if requests else 0.0,
+        }
+
+
+metrics = CoalescingMetrics()
+
+
+class Flight:
+    """One computation and the requests waiting on it."""
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.expires = None
+
+
+class SingleFlight:
+    """
+    Run each key's computation once at a time: callers arriving while it runs
+    wait and share its result, as do callers within `ttl` seconds after.
+    Results that cannot be shared (None from `share`) and errors are not
+    kept; waiting callers then run the computation themselves.
+    """
+
+    def __init__(self, ttl, timeout):
+        self.ttl = ttl
+        self.timeout = timeout
+        self._lock = Lock()
+        self._flights = {}
+
+    def clear(self):
+        with self._lock:
+            self._flights.clear()
+
+    def join(self, key):
+        """The key's flight and whether the caller leads it."""
+        now = monotonic()
+        with self._lock:
+            expired = [
+                k
+                for k, flight in self._flights.items()
+                if flight.expires is not None and flight.expires <= now
+            ]
+            for k in expired:
+                del self._flights[k]
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight()
+                return flight, True
+            return flight, False
+
+    def land(self, key, flight, result):
+        with self._lock:
+            flight.result = result
+            flight.expires = monotonic() + self.ttl
+            if result is None and self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.done.set()
+
+    def follow(self, flight):
+        role = "reused" if flight.done.is_set() else "joined"
+        if not flight.done.wait(self.timeout):
+            logger.warning(f"Gave up waiting {self.timeout}s for a coalesced request.")
+        return (role, flight.result) if flight.result is not None else ("solo", None)
+
+    def run(self, key, compute, share):
+        """
+        `compute()`'s result, or one shared from another caller. Returns the
+        caller's role and the result; `share(result)` is what is kept for
+        others, and what they are given.
+        """
+        flight, leader = self.join(key)
+        if leader:
+            result = None
+            try:
+                result = compute()
+            finally:
+                self.land(key, flight, share(result) if result is not None else None)
+            return "leader", result
+        role, shared = self.follow(flight)
+        return role, shared if shared is not None else compute()
+
+    async def arun(self, key, compute, share):
+        """run() for async `compute`: followers wait in a worker thread."""
+        flight, leader = self.join(key)
+        if leader:
+            result = None
+            try:
+                result = await compute()
+            finally:
+                self.land(key, flight, share(result) if result is not None else None)
+            return "leader", result
+        if flight.done.is_set():
+            role, shared = self.follow(flight)
+        else:
+            role, shared = await sync_to_async(self.follow, thread_sensitive=False)(
+                flight
+            )
+        return role, shared if shared is not None else await compute()
+
+
+class RenderedResponse:
+    """A response's status, headers and content, to copy for each request."""
+
+    def __init__(self, response):
+        self.status = response.status_code
+        self.headers = list(response.items())
+        self.content = response.content
+
+    def response(self):
+        response = HttpResponse(self.content, status=self.status)
+        for header, value in self.headers:
+            response[header] = value
+        return response
+
+
+def shareable(response):
+    """
+    A copy of a rendered 200 or 304 response that sets no cookies, which any
+    request with the same key may be given; else None.
+    """
+    if response.streaming or response.cookies or response.status_code not in (200, 304):
+        return None
+    return RenderedResponse(response)
+
+
+def auth_state(request):
+    """A digest of the credentials a request carries, or "anonymous"."""
+    credentials = [
+        request.COOKIES.get(settings.SESSION_COOKIE_NAME, ""),
+        request.META.get("HTTP_AUTHORIZATION", ""),
+    ]
+    if not any(credentials):
+        return "anonymous"
+    return hashlib.sha256("\n".join(credentials).encode()).hexdigest()
+
+
+def request_key(request):
+    # Absolute URLs in responses (pagination links) depend on host and scheme
+    return (
+        request.method,
+        request.scheme,
+        request.get_host(),
+        request.get_full_path(),
+        *(request.META.get(header, "") for header in VARYING_HEADERS),
+        auth_state(request),
+    )
+
+
+class CoalesceRequestsMiddleware:
+    """
+    Let concurrent identical GET and HEAD requests for COALESCE_PATHS share
+    one run of the view and its rendered response, which is also reused for
+    COALESCE_TTL seconds. Requests are identical when their method, scheme,
+    host, path, query string, Accept and conditional headers, and
+    credentials match.
+
+    Place it after RequestMetricsMiddleware and before the session and CSRF
+    middleware, so responses that set cookies are seen and never shared.
+    """
+
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.flights = SingleFlight(
+            ttl=settings.COALESCE_TTL, timeout=settings.COALESCE_TIMEOUT
+        )
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def coalesces(self, request):
+        # Requests pinned to the primary after a write read other data
+        return (
+            request.method in COALESCED_METHODS
+            and request.path.startswith(tuple(settings.COALESCE_PATHS))
+            and settings.DB_PRIMARY_COOKIE not in request.COOKIES
+        )
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.coalesces(request):
+            return self.get_response(request)
+        role, result = self.flights.run(
+            request_key(request), lambda: self.get_response(request), shareable
+        )
+        return self.finish(role, result)
+
+    async def __acall__(self, request):
+        if not self.coalesces(request):
+            return await self.get_response(request)
+        role, result = await self.flights.arun(
+            request_key(request), lambda: self.get_response(request), shareable
+        )
+        return self.finish(role, result)
+
+    def finish(self, role, result):
+        metrics.incr(role)
+        request_metrics = current_request_metrics.get()
+        if request_metrics is not None:
+            request_metrics.coalesced = role
+        if isinstance(result, RenderedResponse):
+            return result.response()
+        return result
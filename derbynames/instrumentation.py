@@ -0,0 +1,219 @@
+import json
+import random
+from contextvars import ContextVar
+from logging import getLogger
+from time import perf_counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template.backends.django import DjangoTemplates, Template
+
+from derbynames.s3sqlite.snapshot import client_listeners as s3_client_listeners
+from derbynames.s3sqlite.snapshot import metrics as snapshot_metrics
+
+logger = getLogger(__name__)
+
+current = ContextVar("request_metrics", default=None)
+
+
+class RequestMetrics:
+    """What one request spent its time on, in milliseconds."""
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.queries = 0
+        self.sql_ms = 0.0
+        self.slowest_ms = 0.0
+        self.slowest_sql = ""
+        self.template_ms = 0.0
+        self.s3_calls = 0
+        self.s3_ms = 0.0
+        self.snapshot = {}
+        # Set by CoalesceRequestsMiddleware: leader, joined, reused or solo
+        self.coalesced = None
+
+    def record_query(self, sql, ms):
+        self.queries += 1
+        self.sql_ms += ms
+        if ms > self.slowest_ms:
+            self.slowest_ms, self.slowest_sql = ms, sql
+
+    def total_ms(self):
+        return (perf_counter() - self.start) * 1000
+
+    def server_timing(self, total_ms):
+        entries = [
+            f'db;dur={self.sql_ms:.1f};desc="{self.queries} queries"',
+            f"db-slowest;dur={self.slowest_ms:.1f}",
+            f"tpl;dur={self.template_ms:.1f}",
+        ]
+        if self.s3_calls:
+            entries.append(f's3;dur={self.s3_ms:.1f};desc="{self.s3_calls} calls"')
+        entries += [
+            f"snapshot-{phase};dur={ms:.1f}" for phase, ms in self.snapshot.items()
+        ]
+        if self.coalesced:
+            entries.append(f'coalesce;desc="{self.coalesced}"')
+        entries.append(f"total;dur={total_ms:.1f}")
+        return ", ".join(entries)
+
+    def as_dict(self, request, response, total_ms):
+        return {
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "total_ms": round(total_ms, 1),
+            "queries": self.queries,
+            "sql_ms": round(self.sql_ms, 1),
+            "slowest_sql_ms": round(self.slowest_ms, 1),
+            "slowest_sql": self.slowest_sql[: settings.REQUEST_METRICS_SQL_LENGTH],
+            "template_ms": round(self.template_ms, 1),
+            "s3_calls": self.s3_calls,
+            "s3_ms": round(self.s3_ms, 1),
+            "snapshot_ms": {phase: round(ms, 1) for phase, ms in self.snapshot.items()},
+            "coalesced": self.coalesced,
+        }
+
+
+def time_query(execute, sql, params, many, context):
+    """Database execute wrapper adding each statement to the request's totals."""
+    request_metrics = current.get()
+    if request_metrics is None:
+        return execute(sql, params, many, context)
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        request_metrics.record_query(sql, (perf_counter() - start) * 1000)
+
+
+# Installed on every connection for good, rather than per request: the async
+# ORM queries on a connection of another thread. Outside a request
+# time_query only passes the call through.
+def instrument_connection(connection, **kwargs):
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, time_query)
+
+
+connection_created.connect(instrument_connection)
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        request_metrics = current.get()
+        if request_metrics is None:
+            return super().render(context, request)
+        start = perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            request_metrics.template_ms += (perf_counter() - start) * 1000
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The Django template backend, timing each top-level render."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return TimedTemplate(template.template, self)
+
+
+# S3 calls from boto3 clients (media storage and the database snapshot)
+def start_s3_call(params, context, **kwargs):
+    context["request_metrics_start"] = perf_counter()
+
+
+def finish_s3_call(context, **kwargs):
+    request_metrics = current.get()
+    start = context.get("request_metrics_start")
+    if request_metrics is not None and start is not None:
+        request_metrics.s3_calls += 1
+        request_metrics.s3_ms += (perf_counter() - start) * 1000
+
+
+S3_CALL_HANDLERS = (
+    ("before-call.s3", start_s3_call),
+    ("after-call.s3", finish_s3_call),
+    ("after-call-error.s3", finish_s3_call),
+)
+
+
+def instrument_s3_client(client):
+    """Time a boto3 S3 client's calls; registering again is a no-op."""
+    for event, handler in S3_CALL_HANDLERS:
+        client.meta.events.register(
+            event, handler, unique_id=f"request-metrics-{event}"
+        )
+
+
+s3_client_listeners.append(instrument_s3_client)
+
+
+def record_snapshot_phase(phase, ms):
+    request_metrics = current.get()
+    if request_metrics is not None:
+        request_metrics.snapshot[phase] = request_metrics.snapshot.get(phase, 0) + ms
+
+
+snapshot_metrics.listeners.append(record_snapshot_phase)
+
+
+class RequestMetricsMiddleware:
+    """
+    Count queries, SQL time, the slowest statement, template rendering, S3
+    calls and database snapshot I/O for each request. Adds them as a
+    Server-Timing header and logs them as one JSON line for a sample of
+    requests (REQUEST_METRICS_SAMPLE_RATE) and for every request slower
+    than REQUEST_METRICS_SLOW_MS.
+
+    Place it first, so the timings cover the other middleware.
+    """
+
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        # Connections opened before this module was imported
+        for connection in connections.all(initialized_only=True):
+            instrument_connection(connection)
+        request_metrics = RequestMetrics()
+        token = current.set(request_metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.report(request, response, request_metrics)
+
+    async def __acall__(self, request):
+        request_metrics = RequestMetrics()
+        token = current.set(request_metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.report(request, response, request_metrics)
+
+    def report(self, request, response, request_metrics):
+        total_ms = request_metrics.total_ms()
+        if settings.REQUEST_METRICS_SERVER_TIMING:
+            response["Server-Timing"] = request_metrics.server_timing(total_ms)
+        slow = total_ms >= settings.REQUEST_METRICS_SLOW_MS
+        if slow or random.random() < settings.REQUEST_METRICS_SAMPLE_RATE:
+            line = json.dumps(request_metrics.as_dict(request, response, total_ms))
+            if slow:
+                logger.warning(line)
+            else:
+                logger.info(line)
+        return response
@@ -0,0 +1,48 @@
+"""
+Deferred imports for dependencies that are slow to load but rarely needed on
+a given request, keeping them off the cold start path. See `manage.py
+profile_startup` for what the start path costs.
+"""
+
+from functools import wraps
+
+from django.utils.module_loading import import_string
+from django.views.decorators.csrf import csrf_exempt
+
+
+def task(func):
+    """
+    zappa's @task, imported on the first dispatch: zappa.asynchronous creates
+    its boto3 clients at import. `.sync` runs `func` in-process, as zappa's
+    own wrapper does, so queued messages still resolve to it.
+    """
+    dispatch = None
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        nonlocal dispatch
+        if dispatch is None:
+            from zappa.asynchronous import task as zappa_task
+
+            dispatch = zappa_task(func)
+        return dispatch(*args, **kwargs)
+
+    wrapper.sync = func
+    return wrapper
+
+
+def api_view(path, **initkwargs):
+    """
+    A DRF class-based view given by dotted path, imported on its first request.
+    Exempt from CSRF like every DRF view; DRF's authentication enforces it.
+    """
+    view = None
+
+    @csrf_exempt
+    def wrapper(request, *args, **kwargs):
+        nonlocal view
+        if view is None:
+            view = import_string(path).as_view(**initkwargs)
+        return view(request, *args, **kwargs)
+
+    return wrapper
@@ -1,14 +1,232 @@
-from django.contrib import admin
-from django.db.models import Q
+import codecs
+import csv
+from logging import getLogger
+
+from django import forms
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db.models import Max
+from django.http import Http404
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.html import format_html_join
 from import_export.admin import ImportExportMixin
-from .models import DerbyName, DerbyJersey
+
+from derbynames.s3sqlite.base import group_commit
+
+from .generation import retry_jobs
+from .ingest import ingest_names, read_names
+from .models import DerbyJersey, DerbyName, JerseyJob
+from .search import indexed_search, matching_ids
+from .similarity import similar_names
+from .transfer import EXPORT_FORMATS, export_response, import_rows
+
+logger = getLogger(__name__)
+
+
+# Upload the S3-backed database as soon as an import finishes, in one go,
+# whatever the flush window
+class GroupCommitImportMixin:
+    def process_import(self, request, **kwargs):
+        with group_commit():
+            return super().process_import(request, **kwargs)
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Counts an unfiltered changelist by its largest id, one index seek, rather
+    than COUNT(*) over the whole table; deleted rows make it an overestimate.
+    Filtered changelists and small tables are counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            estimate = self.object_list.aggregate(last=Max("pk"))["last"] or 0
+            if estimate > settings.ADMIN_EXACT_COUNT_LIMIT:
+                return estimate
+        return super().count
+
+
+class BatchImportForm(forms.Form):
+    file = forms.FileField(help_text="A UTF-8 CSV file with a header row.")
+
+
+class StreamingTransferMixin:
+    """
+    Changelist links to export the filtered rows as CSV (or XLSX) without
+    building the dataset in memory, and to import a CSV upload in batches,
+    alongside ImportExportMixin, whose resource defines the columns.
+    """
+
+    import_export_change_list_template = "admin/names/change_list_transfer.html"
+    paginator = EstimatedCountPaginator
+    # The unfiltered total would be a second COUNT(*)
+    show_full_result_count = False
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            path(
+                "export-stream/<str:file_format>/",
+                self.admin_site.admin_view(self.export_stream_view),
+                name="{}_{}_export_stream".format(*info),
+            ),
+            path(
+                "import-batches/",
+                self.admin_site.admin_view(self.import_batches_view),
+                name="{}_{}_import_batches".format(*info),
+            ),
+            *super().get_urls(),
+        ]
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = {
+            "stream_export_formats": EXPORT_FORMATS,
+            **(extra_context or {}),
+        }
+        return super().changelist_view(request, extra_context)
+
+    def transfer_resource(self, request):
+        resource_class = self.get_export_resource_classes(request)[0]
+        return resource_class(**self.get_export_resource_kwargs(request))
+
+    def export_stream_view(self, request, file_format):
+        if not self.has_export_permission(request):
+            raise PermissionDenied
+        if file_format not in EXPORT_FORMATS:
+            raise Http404(f"Unsupported export format: {file_format}")
+        # The changelist's filters, search and ordering apply
+        queryset = self.get_changelist_instance(request).get_queryset(request)
+        opts = self.model._meta
+        limit = settings.NAME_EXPORT_XLSX_MAX_ROWS
+        # Counts no further than the limit
+        if file_format == "xlsx" and queryset[: limit + 1].count() > limit:
+            self.message_user(
+                request,
+                f"XLSX exports are limited to {limit} rows; export CSV, or "
+                f"filter the list first.",
+                messages.WARNING,
+            )
+            changelist = reverse(f"admin:{opts.app_label}_{opts.model_name}_changelist")
+            query = request.GET.urlencode()
+            return redirect(f"{changelist}?{query}" if query else changelist)
+        filename = f"{opts.model_name}-{timezone.now():%Y-%m-%d}.{file_format}"
+        logger.info(f"Streaming {file_format} export of {opts.verbose_name_plural}.")
+        return export_response(
+            self.transfer_resource(request),
+            queryset,
+            file_format,
+            filename,
+            settings.NAME_EXPORT_CHUNK_SIZE,
+        )
+
+    def import_upload(self, request, lines, progress):
+        """Import decoded CSV lines; returns a dict of counts."""
+        return import_rows(
+            self.transfer_resource(request),
+            csv.reader(lines),
+            settings.ADMIN_IMPORT_BATCH_SIZE,
+            progress,
+        )
+
+    def import_batches_view(self, request):
+        if not self.has_import_permission(request):
+            raise PermissionDenied
+        opts = self.model._meta
+        form = BatchImportForm(request.POST or None, request.FILES or None)
+        if request.method == "POST" and form.is_valid():
+            upload = form.cleaned_data["file"]
+
+            def progress(stats):
+                logger.info(f"Importing {upload.name}: {dict(stats)}")
+
+            # Read line by line from the upload's temporary file
+            lines = codecs.iterdecode(upload, "utf-8-sig")
+            stats = self.import_upload(request, lines, progress)
+            summary = ", ".join(
+                f"{key.replace('_', ' ')} {round(value, 1)}"
+                for key, value in stats.items()
+                if value
+            )
+            self.message_user(request, f"Imported {upload.name}: {summary}.")
+            return redirect(
+                reverse(f"admin:{opts.app_label}_{opts.model_name}_changelist")
+            )
+        context = {
+            **self.admin_site.each_context(request),
+            "opts": opts,
+            "form": form,
+            "title": f"Import {opts.verbose_name_plural} in batches",
+            "batch_size": settings.ADMIN_IMPORT_BATCH_SIZE,
+        }
+        return TemplateResponse(request, "admin/names/import_batches.html", context)
+
+
+class TrigramSearchMixin:
+    """
+    Admin search through the trigram index behind /api/contains/, for terms
+    it can answer; `search_name_id` is the path to the DerbyName id.
+    """
+
+    search_name_id = "id"
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if term and indexed_search(term, queryset.db):
+            lookup = {f"{self.search_name_id}__in": matching_ids(term)}
+            return queryset.filter(**lookup), False
+        return super().get_search_results(request, queryset, search_term)
 
 
 @admin.register(DerbyName)
-class DerbyNameAdmin(ImportExportMixin, admin.ModelAdmin):
+class DerbyNameAdmin(
+    TrigramSearchMixin,
+    StreamingTransferMixin,
+    GroupCommitImportMixin,
+    ImportExportMixin,
+    admin.ModelAdmin,
+):
     list_display = ("name", "created_at", "updated_at")
     search_fields = ("name",)
     ordering = ("name",)
+    readonly_fields = ("similar_names",)
+
+    def import_upload(self, request, lines, progress):
+        # The bulk ingest path: deduplicated, one transaction and upload
+        return ingest_names(
+            read_names(lines, "csv"), settings.ADMIN_IMPORT_BATCH_SIZE, progress
+        )
+
+    @admin.display(description="Similar names")
+    def similar_names(self, obj):
+        if obj.pk is None:
+            return "-"
+        matches = similar_names(obj.name, exclude=obj.pk)
+        return (
+            format_html_join(
+                ", ",
+                "{} ({})",
+                ((match["name"], f"{match['similarity']:.0%}") for match in matches),
+            )
+            or "None"
+        )
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        matches = similar_names(obj.name, exclude=obj.pk)
+        if matches:
+            self.message_user(
+                request,
+                f"{obj.name} is close to existing names: "
+                + ", ".join(match["name"] for match in matches),
+                messages.WARNING,
+            )
 
 
 # Allow filtering of jerseys based on whether they have an image
@@ -24,14 +242,40 @@ class HasImageFilter(admin.SimpleListFilter):
 
     def queryset(self, request, queryset):
         if self.value() == "yes":
-            return queryset.filter(Q(image__isnull=False) & ~Q(image__exact=""))
+            return queryset.with_image()
         elif self.value() == "no":
-            return queryset.filter(Q(image__isnull=True) | Q(image__exact=""))
+            return queryset.without_image()
 
 
 @admin.register(DerbyJersey)
-class DerbyJerseyAdmin(ImportExportMixin, admin.ModelAdmin):
-    list_display = ("name", "created_at", "updated_at")
-    list_filter = (HasImageFilter,)
-    search_fields = ("name",)
+class DerbyJerseyAdmin(
+    TrigramSearchMixin,
+    StreamingTransferMixin,
+    GroupCommitImportMixin,
+    ImportExportMixin,
+    admin.ModelAdmin,
+):
+    list_display = ("name", "image_status", "image_attempts", "updated_at")
+    list_filter = (HasImageFilter, "image_status")
+    list_select_related = ("name",)
+    readonly_fields = ("image_status", "image_generated_at", "image_attempts")
+    # A select of every name would not fit on the page
+    raw_id_fields = ("name",)
+    search_fields = ("name__name",)
+    search_name_id = "name_id"
     ordering = ("name",)
+
+
+@admin.register(JerseyJob)
+class JerseyJobAdmin(admin.ModelAdmin):
+    list_display = ("key", "jersey", "state", "attempts", "next_attempt_at")
+    # The jersey is shown by its name
+    list_select_related = ("jersey__name",)
+    list_filter = ("state",)
+    search_fields = ("key",)
+    raw_id_fields = ("jersey",)
+    actions = ("retry_now",)
+
+    @admin.action(description="Retry selected jobs now")
+    def retry_now(self, request, queryset):
+        retry_jobs(queryset)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class NamesConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "derbynames.names"
+
+    def ready(self):
+        # Registers the receivers that keep the static export fresh
+        from . import static_site  # noqa: F401
@@ -0,0 +1,207 @@
+from datetime import timedelta
+from logging import getLogger
+from math import ceil, log
+from threading import RLock
+from time import monotonic
+
+from django.conf import settings
+from django.db import models
+from django.db.models.functions import Lower
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .corpus import ASCII_FOLD
+from .models import DerbyName, TableVersion
+
+logger = getLogger(__name__)
+
+# Catch-up rereads renames made this long before the last sync, covering
+# transactions that committed late and clock drift between processes
+CATCH_UP_OVERLAP = timedelta(minutes=1)
+
+
+class BloomFilter:
+    """
+    A set that can answer "certainly absent" or "maybe present": no false
+    negatives, false positives at about `error_rate` while it holds no more
+    than `capacity` keys.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = max(capacity, 1)
+        self.size = max(64, ceil(-self.capacity * log(error_rate) / log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        # Double hashing from one 64-bit hash; str hashes are salted per
+        # process, which is fine for a filter that never leaves it
+        digest = hash(key) & 0xFFFFFFFFFFFFFFFF
+        first, step = digest & 0xFFFFFFFF, (digest >> 32) | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(key)
+        )
+
+
+def fold(name):
+    return name.translate(ASCII_FOLD)
+
+
+class NameFilter:
+    """
+    Bloom filter of every DerbyName, case-folded, so availability checks can
+    answer "not taken" without a query; only possible matches are looked up.
+
+    Built from the name column on first use. Names saved in this process are
+    added by signals; writes from other processes are noticed through
+    TableVersion (at most every `check_interval` seconds) and caught up:
+    rows with ids past the last one seen are new, and rows with a recent
+    updated_at cover renames. Deleted or renamed names stay behind as false positives,
+    which the lookup settles, until deletions reach a quarter of the filter
+    or it outgrows its capacity; then it is rebuilt.
+    """
+
+    def __init__(self, error_rate, check_interval):
+        self.error_rate = error_rate
+        self.check_interval = check_interval
+        self._lock = RLock()
+        self._bloom = None
+        self._version = None
+        self._last_id = 0
+        self._synced_at = None
+        self._checked_at = None
+        self._deleted = 0
+
+    def expire(self):
+        """Check TableVersion on the next call, e.g. after a bulk insert."""
+        with self._lock:
+            self._checked_at = None
+
+    def build(self):
+        table = DerbyName._meta.db_table
+        # Read first: a write during the scan bumps the version past it
+        version = TableVersion.current(table)
+        synced_at = timezone.now()
+        count = DerbyName.objects.count()
+        bloom = BloomFilter(count + count // 2 + 1000, self.error_rate)
+        last_id = 0
+        rows = DerbyName.objects.order_by().values_list("id", "name")
+        for pk, name in rows.iterator(chunk_size=10000):
+            bloom.add(fold(name))
+            last_id = max(last_id, pk)
+        self._bloom, self._version, self._last_id = bloom, version, last_id
+        self._synced_at, self._checked_at = synced_at, monotonic()
+        self._deleted = 0
+        logger.info(f"Built name filter of {bloom.size // 8} bytes for {count} names.")
+
+    def catch_up(self):
+        self._checked_at = monotonic()
+        version = TableVersion.current(DerbyName._meta.db_table)
+        if version == self._version:
+            return
+        synced_at = timezone.now()
+        # Inserts are found by id, whenever their transaction committed; bulk
+        # ingests stamp updated_at with the time they started
+        rows = (
+            DerbyName.objects.order_by()
+            .filter(
+                models.Q(id__gt=self._last_id)
+                | models.Q(updated_at__gte=self._synced_at - CATCH_UP_OVERLAP)
+            )
+            .values_list("id", "name")
+        )
+        added = 0
+        for pk, name in rows.iterator(chunk_size=10000):
+            self._bloom.add(fold(name))
+            self._last_id = max(self._last_id, pk)
+            added += 1
+        self._version, self._synced_at = version, synced_at
+        logger.info(f"Caught up name filter to v{version} with {added} names.")
+
+    def sync(self):
+        with self._lock:
+            bloom = self._bloom
+            if (
+                bloom is None
+                or bloom.count > bloom.capacity
+                or self._deleted * 4 > bloom.count
+            ):
+                self.build()
+            elif (
+                self._checked_at is None
+                or monotonic() - self._checked_at >= self.check_interval
+            ):
+                self.catch_up()
+
+    def add(self, name):
+        with self._lock:
+            if self._bloom is not None:
+                self._bloom.add(fold(name))
+
+    def discard(self, name):
+        with self._lock:
+            self._deleted += 1
+
+    def untaken(self, names):
+        """The names the filter rules out as taken, ignoring case; no query."""
+        self.sync()
+        with self._lock:
+            return [name for name in names if fold(name) not in self._bloom]
+
+    def check(self, names):
+        """
+        Availability of each name: whether it is taken exactly, whether a
+        name differing only in case is, and the names that match ignoring
+        case. One query covers every name the filter cannot rule out.
+        """
+        self.sync()
+        with self._lock:
+            maybe = {fold(name) for name in names if fold(name) in self._bloom}
+        matches = {}
+        if maybe:
+            rows = (
+                DerbyName.objects.order_by()
+                .annotate(lower_name=Lower("name"))
+                .filter(lower_name__in=list(maybe))
+                .values_list("lower_name", "name")
+            )
+            for key, name in rows:
+                matches.setdefault(key, []).append(name)
+        results = []
+        for name in names:
+            taken_as = sorted(matches.get(fold(name), ()))
+            results.append(
+                {
+                    "name": name,
+                    "taken": name in taken_as,
+                    "taken_ignoring_case": bool(taken_as),
+                    "matches": taken_as,
+                }
+            )
+        return {"results": results, "looked_up": len(maybe)}
+
+
+name_filter = NameFilter(
+    error_rate=settings.NAME_FILTER_ERROR_RATE,
+    check_interval=settings.NAMES_CORPUS_CHECK_INTERVAL,
+)
+
+
+@receiver(models.signals.post_save, sender=DerbyName)
+def add_to_name_filter(sender, instance, **kwargs):
+    name_filter.add(instance.name)
+
+
+@receiver(models.signals.post_delete, sender=DerbyName)
+def discard_from_name_filter(sender, instance, **kwargs):
+    name_filter.discard(instance.name)
@@ -0,0 +1,440 @@
+import asyncio
+import gc
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+from asgiref.sync import ThreadSensitiveContext, async_to_sync
+from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.test import AsyncClient, Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from .generation import StubProvider, adrain, drain, enqueue_jersey_image
+from .ingest import ingest_names
+from .models import DerbyJersey, DerbyName, TableVersion
+
+# Routes measured by benchmark_routes; {name_id} is filled in with a name
+# from the middle of the corpus
+ROUTES = {
+    "index": "/",
+    "detail": "/names/{name_id}/",
+    "jersey_grid": "/jerseys/",
+    "api_names": "/api/names/",
+    "api_random_name": "/api/random-name/",
+    "api_starts_with": "/api/starts-with/b/",
+    "api_contains": "/api/contains/00042/",
+    "admin_names": "/admin/names/derbyname/",
+    "admin_jerseys": "/admin/names/derbyjersey/",
+}
+
+# Routes compared by load_test: the read paths that have async views under
+# ASGI (derbynames.asgi_urls)
+LOAD_ROUTES = {
+    "index": "/",
+    "detail": "/names/{name_id}/",
+    "jersey_grid": "/jerseys/",
+    "api_name": "/api/names/{name_id}/",
+    "api_random_name": "/api/random-name/",
+    "api_contains": "/api/contains/00042/",
+}
+
+# ASGIURLConfMiddleware routes the "asgi" requests to derbynames.asgi_urls
+SERVERS = ("wsgi", "asgi")
+
+
+def scratch_storages():
+    """Every configured storage in memory, and static files served locally."""
+    in_memory = {"BACKEND": "django.core.files.storage.InMemoryStorage"}
+    return {
+        **{alias: in_memory for alias in settings.STORAGES},
+        "staticfiles": {
+            "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"
+        },
+    }
+
+
+@contextmanager
+def scratch_database(path=None):
+    """
+    Run a block against a throwaway test database instead of the real one:
+    in memory, or for SQLite in the file at `path`. Storages are swapped for
+    in-memory ones too, so nothing reaches the bucket.
+    """
+    test_settings = connection.settings_dict["TEST"]
+    test_name = test_settings.get("NAME")
+    if path:
+        test_settings["NAME"] = str(path)
+    with override_settings(STORAGES=scratch_storages()):
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        try:
+            yield
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            test_settings["NAME"] = test_name
+
+
+def synthetic_names(start, stop):
+    """Deterministic, unique names for seeding benchmark corpora."""
+    for i in range(start, stop):
+        yield f"Benchmark Blocker {i:07d}"
+
+
+def seed_names(total, batch_size=5000):
+    """Grow the DerbyName table to `total` rows of synthetic names."""
+    existing = DerbyName.objects.count()
+    if existing < total:
+        ingest_names(synthetic_names(existing, total), batch_size)
+
+
+def seed_jerseys(total, batch_size=5000):
+    """
+    Grow the DerbyJersey table to `total` rows, one per name from the first
+    name on; every other jersey has an image (its file need not exist).
+    Bulk-created, so no image generation is queued.
+    """
+    existing = DerbyJersey.objects.count()
+    name_ids = (
+        DerbyName.objects.exclude(derbyjersey__isnull=False)
+        .order_by("id")
+        .values_list("id", flat=True)[: max(0, total - existing)]
+    )
+    batch = []
+    for i, name_id in enumerate(name_ids.iterator(chunk_size=batch_size), existing):
+        image = f"jerseys/benchmark-{i:07d}.png" if i % 2 == 0 else ""
+        # bulk_create skips save(), which keeps image_status
+        status = (
+            DerbyJersey.ImageStatus.READY if image else DerbyJersey.ImageStatus.PENDING
+        )
+        batch.append(
+            DerbyJersey(
+                name_id=name_id,
+                image=image,
+                image_status=status,
+                metadata={"prompt": "benchmark"},
+            )
+        )
+        if len(batch) >= batch_size:
+            DerbyJersey.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        DerbyJersey.objects.bulk_create(batch)
+    TableVersion.bump(DerbyJersey._meta.db_table)
+
+
+def seed_pending_jerseys(count, label):
+    """
+    `count` new names, each with a jersey without an image and no job yet,
+    named after `label`. Bulk-created, so nothing is queued.
+    """
+    names = DerbyName.objects.bulk_create(
+        DerbyName(name=f"Benchmark {label} {i:07d}") for i in range(count)
+    )
+    jerseys = DerbyJersey.objects.bulk_create(
+        DerbyJersey(name=name, metadata={"prompt": "benchmark"}) for name in names
+    )
+    TableVersion.bump(DerbyName._meta.db_table)
+    TableVersion.bump(DerbyJersey._meta.db_table)
+    return jerseys
+
+
+def seed_corpus(names, jerseys=None):
+    """Seed `names` names and (by default) a jersey for one name in ten."""
+    seed_names(names)
+    seed_jerseys(names // 10 if jerseys is None else jerseys)
+
+
+def time_call(func, repeat):
+    """Call `func` `repeat` times and summarise the latencies in milliseconds."""
+    samples = []
+    # Like timeit: keep collection pauses out of the samples
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            samples.append((time.perf_counter() - start) * 1000)
+    finally:
+        gc.enable()
+    samples.sort()
+    return {
+        "p50": statistics.median(samples),
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "mean": statistics.fmean(samples),
+    }
+
+
+def peak_rss_mib():
+    """Peak resident memory of this process so far, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+def measure_route(client, url, repeat):
+    """
+    Latency over `repeat` requests after one warm-up, plus the query count and
+    peak Python allocation of a single request.
+    """
+    response = client.get(url)
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url)
+    # Count now: the next request clears the query log
+    query_count = len(queries)
+    tracemalloc.start()
+    try:
+        client.get(url)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    result = time_call(lambda: client.get(url), repeat)
+    result.update(
+        status=response.status_code,
+        queries=query_count,
+        peak_alloc_kib=round(peak / 1024, 1),
+    )
+    return result
+
+
+def run_routes(repeat, routes=ROUTES):
+    """Measure every route against the current database as a staff user."""
+    user, _ = get_user_model().objects.get_or_create(
+        username="benchmark", defaults={"is_staff": True, "is_superuser": True}
+    )
+    name_id = DerbyName.objects.order_by("id").values_list("id", flat=True)[
+        DerbyName.objects.count() // 2
+    ]
+    results = {}
+    with override_settings(DEBUG=False, ALLOWED_HOSTS=["localhost"]):
+        client = Client(HTTP_HOST="localhost")
+        client.force_login(user)
+        for route, url in routes.items():
+            results[route] = measure_route(client, url.format(name_id=name_id), repeat)
+    return results
+
+
+def compare(results, baseline, tolerance, slack_ms=2.0):
+    """
+    Regressions of `results` against `baseline` (both {size: {route: {...}}}):
+    more queries, or median latency or peak allocation more than `tolerance`
+    (a fraction) above the baseline. Latency also gets `slack_ms` of
+    absolute headroom against timer noise on fast routes; the median is
+    used because p95 over a few dozen samples is mostly noise.
+    """
+    regressions = []
+    for size, routes in results.items():
+        for route, current in routes.items():
+            before = baseline.get(size, {}).get(route)
+            if before is None:
+                continue
+            if current["queries"] > before["queries"]:
+                regressions.append(
+                    f"{size} {route}: {current['queries']} queries "
+                    f"(baseline {before['queries']})"
+                )
+            if current["p50"] > before["p50"] * (1 + tolerance) + slack_ms:
+                regressions.append(
+                    f"{size} {route}: p50 {current['p50']:.1f}ms "
+                    f"(baseline {before['p50']:.1f}ms)"
+                )
+            if current["peak_alloc_kib"] > before["peak_alloc_kib"] * (1 + tolerance):
+                regressions.append(
+                    f"{size} {route}: peak allocation {current['peak_alloc_kib']}KiB "
+                    f"(baseline {before['peak_alloc_kib']}KiB)"
+                )
+    return regressions
+
+
+def summarise(latencies, seconds, errors):
+    latencies.sort()
+    return {
+        "errors": errors,
+        "rps": round(len(latencies) / seconds, 1),
+        "p50": round(statistics.median(latencies), 2),
+        "p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+    }
+
+
+def load_wsgi(url, total, concurrency):
+    """
+    `total` GETs through the WSGI handler from `concurrency` threads, each
+    with its own client, like a threaded WSGI server. Returns (latencies in
+    ms, wall seconds, error responses).
+    """
+    latencies, errors = [], []
+
+    def worker(count):
+        client = Client()
+        for _ in range(count):
+            start = time.perf_counter()
+            response = client.get(url)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+
+    counts = [
+        total // concurrency + (i < total % concurrency) for i in range(concurrency)
+    ]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, counts))
+    return latencies, time.perf_counter() - start, len(errors)
+
+
+async def load_asgi(url, total, concurrency):
+    """
+    `total` GETs through the ASGI handler with `concurrency` requests in
+    flight on one event loop. Each request gets its own sync thread context,
+    as Django's ASGIHandler gives it.
+    """
+    client = AsyncClient()
+    latencies, errors = [], []
+    remaining = iter(range(total))
+
+    async def worker():
+        for _ in remaining:
+            start = time.perf_counter()
+            async with ThreadSensitiveContext():
+                response = await client.get(url)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - start, len(errors)
+
+
+def run_load(server, url, total, concurrency):
+    if server == "asgi":
+        return async_to_sync(load_asgi)(url, total, concurrency)
+    return load_wsgi(url, total, concurrency)
+
+
+def load_test(total, concurrency, routes=LOAD_ROUTES):
+    """
+    Requests per second, latency and peak Python allocation of each route
+    under the WSGI and ASGI handlers at the same concurrency. The clients
+    call the handlers in-process, so this compares Django's two request
+    paths without a server or network in between.
+    """
+    name_id = DerbyName.objects.order_by("id").values_list("id", flat=True)[
+        DerbyName.objects.count() // 2
+    ]
+    results = {}
+    with override_settings(DEBUG=False, ALLOWED_HOSTS=["testserver"]):
+        for route, url in routes.items():
+            url = url.format(name_id=name_id)
+            results[route] = {}
+            for server in SERVERS:
+                # Warm up, then measure throughput and, separately,
+                # allocation over one round of concurrent requests
+                run_load(server, url, concurrency, concurrency)
+                result = summarise(*run_load(server, url, total, concurrency))
+                tracemalloc.start()
+                try:
+                    run_load(server, url, concurrency, concurrency)
+                    _, peak = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+                result["peak_alloc_kib"] = round(peak / 1024, 1)
+                results[route][server] = result
+    return results
+
+
+def generation_load_test(jobs, latency, threads, concurrency):
+    """
+    Jobs per second and peak allocation of drain() with `threads` worker
+    threads and adrain() with `concurrency` calls in flight, each running
+    `jobs` jobs against a stub provider that waits `latency` seconds per
+    image. Each runner gets jerseys of its own, so both run every job.
+    Images go to in-memory storage.
+    """
+    runners = {
+        "threads": lambda provider: drain(provider, threads, jobs),
+        "asyncio": lambda provider: async_to_sync(adrain)(provider, concurrency, jobs),
+    }
+    results = {}
+    with override_settings(STORAGES=scratch_storages()):
+        for runner, run in runners.items():
+            for jersey in seed_pending_jerseys(jobs, f"Generation {runner}"):
+                enqueue_jersey_image(jersey, drain=False)
+            provider = StubProvider(latency=latency, size=64)
+            tracemalloc.start()
+            try:
+                start = time.perf_counter()
+                counts = run(provider)
+                seconds = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            if not sum(counts.values()):
+                raise RuntimeError(f"The {runner} runner ran no jobs.")
+            results[runner] = {
+                "jobs": sum(counts.values()),
+                "jobs_per_second": round(sum(counts.values()) / seconds, 1),
+                "peak_alloc_kib": round(peak / 1024, 1),
+            }
+    return results
+
+
+@contextmanager
+def read_snapshot_alias(alias="read"):
+    """
+    The read snapshot alias, added for the block with a copy next to the
+    primary's file if the settings do not configure one.
+    """
+    if alias in settings.DATABASES:
+        yield alias
+        return
+    primary = Path(connection.settings_dict["NAME"])
+    # connections.settings is settings.DATABASES, with defaults filled in
+    connections.settings[alias] = {
+        **connection.settings_dict,
+        "ENGINE": "derbynames.s3sqlite.replica",
+        "PRIMARY": DEFAULT_DB_ALIAS,
+        "NAME": primary.with_name(f"{primary.stem}.read{primary.suffix}"),
+        "REFRESH_SECONDS": 1.0,
+    }
+    try:
+        yield alias
+    finally:
+        connections[alias].close()
+        del connections[alias]
+        del connections.settings[alias]
+
+
+def read_snapshot_load_test(total, concurrency, routes=LOAD_ROUTES):
+    """
+    Requests per second and latency of each route under the WSGI handler
+    with GET requests reading from the primary connection, and from the
+    immutable read snapshot. Coalescing is off, so every request runs its
+    view. Needs a file-backed database (see scratch_database).
+    """
+    name_id = DerbyName.objects.order_by("id").values_list("id", flat=True)[
+        DerbyName.objects.count() // 2
+    ]
+    results = {}
+    with (
+        read_snapshot_alias() as alias,
+        override_settings(DEBUG=False, ALLOWED_HOSTS=["testserver"], COALESCE_PATHS=[]),
+    ):
+        for route, url in routes.items():
+            url = url.format(name_id=name_id)
+            results[route] = {}
+            for configuration, read_alias in (("primary", None), ("snapshot", alias)):
+                with override_settings(DB_READ_ALIAS=read_alias):
+                    load_wsgi(url, concurrency, concurrency)
+                    results[route][configuration] = summarise(
+                        *load_wsgi(url, total, concurrency)
+                    )
+    return results
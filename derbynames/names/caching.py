@@ -0,0 +1,147 @@
+from functools import wraps
+from inspect import iscoroutinefunction
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from .models import TableVersion
+
+SAFE_METHODS = ("GET", "HEAD")
+
+
+def table_validators(*models, variant=""):
+    """
+    ETag and Last-Modified for responses built from whole tables: the tables'
+    version stamps, read in one query.
+    """
+    tables = sorted(model._meta.db_table for model in models)
+    stamps = {
+        table: (version, updated_at)
+        for table, version, updated_at in TableVersion.objects.filter(
+            table__in=tables
+        ).values_list("table", "version", "updated_at")
+    }
+    versions = "-".join(str(stamps.get(table, (0,))[0]) for table in tables)
+    modified = [updated_at for _, updated_at in stamps.values()]
+    return f"{variant}v{versions}", max(modified) if modified else None
+
+
+def row_validators(*timestamps, variant=""):
+    """ETag and Last-Modified for a response built from rows' updated_at."""
+    timestamps = [timestamp for timestamp in timestamps if timestamp]
+    if not timestamps:
+        return None
+    tag = "-".join(f"{timestamp.timestamp():.6f}" for timestamp in timestamps)
+    return f"{variant}{tag}", max(timestamps)
+
+
+def not_modified(request, validators):
+    """A 304 response if the request's conditional headers match, else None."""
+    if validators is None or request.method not in SAFE_METHODS:
+        return None
+    etag, last_modified = validators
+    return get_conditional_response(
+        request,
+        etag=quote_etag(etag),
+        last_modified=last_modified and int(last_modified.timestamp()),
+    )
+
+
+def finish_response(request, response, policy, validators=None):
+    """Add validators and the named Cache-Control policy to a GET response."""
+    if request.method not in SAFE_METHODS or response.status_code not in (200, 304):
+        return response
+    if validators is not None:
+        etag, last_modified = validators
+        response.headers.setdefault("ETag", quote_etag(etag))
+        if last_modified:
+            response.headers.setdefault(
+                "Last-Modified", http_date(last_modified.timestamp())
+            )
+    # Responses for signed-in users may be personalised; keep them out of
+    # shared caches
+    if (
+        settings.SESSION_COOKIE_NAME in request.COOKIES
+        or "HTTP_AUTHORIZATION" in request.META
+    ):
+        patch_cache_control(response, private=True, no_cache=True)
+    else:
+        patch_cache_control(response, public=True, **settings.CACHE_POLICIES[policy])
+    return response
+
+
+def cache_page_policy(policy, validators=None):
+    """
+    Decorate a function view with a Cache-Control policy from
+    settings.CACHE_POLICIES, and conditional GET support if `validators`
+    (called with the view's arguments) returns (etag, last_modified).
+    Async views may have async validators.
+    """
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            get_validators = validators
+            if validators and not iscoroutinefunction(validators):
+                get_validators = sync_to_async(validators)
+
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                current = None
+                if get_validators:
+                    current = await get_validators(request, *args, **kwargs)
+                response = not_modified(request, current)
+                if response is None:
+                    response = await view(request, *args, **kwargs)
+                return finish_response(request, response, policy, current)
+
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            current = validators(request, *args, **kwargs) if validators else None
+            response = not_modified(request, current)
+            if response is None:
+                response = view(request, *args, **kwargs)
+            return finish_response(request, response, policy, current)
+
+        return wrapper
+
+    return decorator
+
+
+class NotModified(Exception):
+    pass
+
+
+class CachePolicyMixin:
+    """
+    Conditional GET and Cache-Control for DRF views. `get_validators` returns
+    (etag, last_modified), or None for responses without validators; a
+    match is answered with 304 before the queryset is evaluated.
+    """
+
+    cache_policy = "listing"
+
+    def get_validators(self):
+        return None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.validators = None
+        if request.method in SAFE_METHODS:
+            self.validators = self.get_validators()
+            if not_modified(request, self.validators) is not None:
+                raise NotModified
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return not_modified(self.request, self.validators)
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        return finish_response(
+            request, response, self.cache_policy, getattr(self, "validators", None)
+        )
@@ -0,0 +1,209 @@
+import random
+import string
+import sys
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import accumulate
+from logging import getLogger
+from threading import RLock
+from time import monotonic
+
+from django.conf import settings
+from django.db import models
+from django.db.models import Count
+from django.db.models.functions import Lower, Substr
+from django.dispatch import receiver
+
+from .models import DerbyName, TableVersion
+
+logger = getLogger(__name__)
+
+
+# SQLite's lower() only folds ASCII, and the lower(name) index is built with
+# it, so names compared ignoring case are folded the same way.
+ASCII_FOLD = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def initial_of(name):
+    # Matches SQLite's lower(), which only folds ASCII characters.
+    initial = name[:1]
+    return initial.lower() if initial.isascii() else initial
+
+
+class SortedNames:
+    """A run of DerbyNames held as parallel id/name arrays, sorted by name."""
+
+    __slots__ = ("ids", "names", "nbytes")
+
+    def __init__(self, rows):
+        self.ids = array("q")
+        self.names = []
+        for id, name in rows:
+            self.ids.append(id)
+            self.names.append(name)
+        self.nbytes = (
+            sys.getsizeof(self.names)
+            + sum(map(sys.getsizeof, self.names))
+            + self.ids.itemsize * len(self.ids)
+        )
+
+    def __len__(self):
+        return len(self.names)
+
+    def instance(self, index):
+        return DerbyName(id=self.ids[index], name=self.names[index])
+
+    def instances(self, start, stop):
+        return [self.instance(i) for i in range(max(start, 0), min(stop, len(self)))]
+
+
+class NameCorpus:
+    """
+    Process-wide copy of the DerbyName table for warm containers.
+
+    Names are grouped into buckets by initial and loaded on first use, so the
+    prefix index for /api/starts-with/ is the bucket itself and random picks
+    touch at most one bucket per name. Buckets are evicted least recently used
+    once the corpus outgrows `max_bytes`.
+
+    Local writes invalidate the corpus through signals. Writes from other
+    processes are noticed through TableVersion, checked at most once every
+    `check_interval` seconds.
+    """
+
+    def __init__(self, max_bytes, check_interval):
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self._lock = RLock()
+        self._version = None
+        self._checked_at = None
+        self._initials = None
+        self._offsets = None
+        self._buckets = OrderedDict()
+        self._nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._initials = self._offsets = None
+            self._buckets.clear()
+            self._nbytes = 0
+            self._checked_at = None
+
+    def check_version(self):
+        now = monotonic()
+        if (
+            self._checked_at is not None
+            and now - self._checked_at < self.check_interval
+        ):
+            return
+        version = TableVersion.current(DerbyName._meta.db_table)
+        with self._lock:
+            if version != self._version:
+                logger.info(f"Name corpus is stale (v{self._version} -> v{version}).")
+                self.invalidate()
+                self._version = version
+            self._checked_at = now
+
+    def _index(self):
+        # Bucket sizes, as cumulative offsets, for uniform random picks
+        with self._lock:
+            if self._offsets is not None:
+                return self._initials, self._offsets
+        rows = (
+            DerbyName.objects.order_by()
+            .annotate(initial=Lower(Substr("name", 1, 1)))
+            .values_list("initial")
+            .annotate(count=Count("id"))
+            .order_by("initial")
+        )
+        initials, counts = [], []
+        for initial, count in rows:
+            initials.append(initial)
+            counts.append(count)
+        with self._lock:
+            self._initials, self._offsets = initials, list(accumulate(counts))
+            return self._initials, self._offsets
+
+    def bucket(self, initial):
+        with self._lock:
+            bucket = self._buckets.get(initial)
+            if bucket is not None:
+                self._buckets.move_to_end(initial)
+                self.hits += 1
+                return bucket
+            self.misses += 1
+        if initial:
+            queryset = DerbyName.objects.filter(name__istartswith=initial)
+        else:
+            queryset = DerbyName.objects.filter(name="")
+        bucket = SortedNames(queryset.order_by("name").values_list("id", "name"))
+        with self._lock:
+            if initial in self._buckets:
+                return self._buckets[initial]
+            self._buckets[initial] = bucket
+            self._nbytes += bucket.nbytes
+            while self._nbytes > self.max_bytes and len(self._buckets) > 1:
+                _, evicted = self._buckets.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+                self.evictions += 1
+        return bucket
+
+    def random(self, k):
+        """Up to k distinct random names, uniform over the whole table."""
+        self.check_version()
+        initials, offsets = self._index()
+        total = offsets[-1] if offsets else 0
+        picked = []
+        for position in random.sample(range(total), min(k, total)):
+            i = bisect_right(offsets, position)
+            bucket = self.bucket(initials[i])
+            index = position - (offsets[i - 1] if i else 0)
+            # The bucket may have shrunk since the offsets were counted.
+            if index < len(bucket):
+                picked.append(bucket.instance(index))
+        return picked
+
+    def starting_with(self, prefix):
+        """Names starting with `prefix` (case-insensitive), ordered by name."""
+        self.check_version()
+        bucket = self.bucket(initial_of(prefix))
+        if len(prefix) <= 1:
+            return bucket
+        folded = prefix.lower()
+        return SortedNames(
+            (bucket.ids[i], name)
+            for i, name in enumerate(bucket.names)
+            if name.lower().startswith(folded)
+        )
+
+    def warm(self):
+        """Load every bucket, e.g. ahead of traffic from a keep-warm event."""
+        self.check_version()
+        initials, _ = self._index()
+        for initial in initials:
+            self.bucket(initial)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "version": self._version,
+                "buckets": len(self._buckets),
+                "bytes": self._nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+corpus = NameCorpus(
+    max_bytes=settings.NAMES_CORPUS_MAX_BYTES,
+    check_interval=settings.NAMES_CORPUS_CHECK_INTERVAL,
+)
+
+
+@receiver(models.signals.post_save, sender=DerbyName)
+@receiver(models.signals.post_delete, sender=DerbyName)
+def invalidate_corpus(sender, **kwargs):
+    corpus.invalidate()
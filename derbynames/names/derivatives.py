@@ -0,0 +1,84 @@
+import base64
+from io import BytesIO
+from logging import getLogger
+
+from django.conf import settings
+from PIL import Image, ImageFilter, features
+
+from .media import IMAGE_PREFIX, save_content
+
+logger = getLogger(__name__)
+
+DERIVATIVE_PREFIX = f"{IMAGE_PREFIX}derived/"
+
+PLACEHOLDER_WIDTH = 16
+
+
+def supported_formats():
+    # Pillow builds without libavif (e.g. some Lambda layers) just skip AVIF
+    formats = []
+    for image_format in settings.JERSEY_DERIVATIVE_FORMATS:
+        if features.check(image_format):
+            formats.append(image_format)
+        else:
+            logger.warning(f"Pillow cannot write {image_format}; skipping it.")
+    return formats
+
+
+def encode(image, image_format, quality):
+    buffer = BytesIO()
+    image.save(buffer, image_format.upper(), quality=quality)
+    return buffer.getvalue()
+
+
+def placeholder(image):
+    """A tiny blurred WebP of the image, as a data URI to inline in pages."""
+    height = max(1, round(image.height * PLACEHOLDER_WIDTH / image.width))
+    small = image.resize((PLACEHOLDER_WIDTH, height), Image.Resampling.BILINEAR)
+    data = encode(small.filter(ImageFilter.GaussianBlur(1)), "webp", 30)
+    return "data:image/webp;base64," + base64.b64encode(data).decode("ascii")
+
+
+def build_derivatives(jersey, force=False, image=None):
+    """
+    Write resized WebP/AVIF copies of a jersey's image and record them, with a
+    blur placeholder, in jersey.metadata["derivatives"]. Pass the decoded
+    `image` if it is at hand to skip downloading it. Returns False if the
+    jersey has no image or its derivatives are already current.
+    """
+    if not jersey.image:
+        return False
+    current = jersey.get_metadata("derivatives") or {}
+    if not force and current.get("source") == jersey.image.name:
+        return False
+    storage = jersey.image.storage
+    if image is None:
+        with jersey.image.open("rb") as source:
+            image = Image.open(source)
+            image.load()
+    image = image.convert("RGB")
+    widths = sorted(
+        {min(width, image.width) for width in settings.JERSEY_DERIVATIVE_WIDTHS}
+    )
+    sources = {}
+    for image_format in supported_formats():
+        sources[image_format] = []
+        for width in widths:
+            height = round(image.height * width / image.width)
+            resized = image.resize((width, height), Image.Resampling.LANCZOS)
+            data = encode(resized, image_format, settings.JERSEY_DERIVATIVE_QUALITY)
+            name = save_content(storage, data, DERIVATIVE_PREFIX, image_format)
+            sources[image_format].append({"width": width, "name": name})
+    jersey.set_metadata(
+        "derivatives",
+        {
+            "source": jersey.image.name,
+            "width": image.width,
+            "height": image.height,
+            "placeholder": placeholder(image),
+            "sources": sources,
+        },
+    )
+    jersey.save(update_fields=["metadata", "updated_at"])
+    logger.info(f"Built {sum(map(len, sources.values()))} derivatives for {jersey}.")
+    return True
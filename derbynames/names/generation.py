@@ -0,0 +1,376 @@
+import asyncio
+import hashlib
+import importlib.util
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from functools import cache
+from logging import getLogger
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from PIL import Image, ImageDraw
+
+from derbynames.lazy import task
+from derbynames.s3sqlite.base import group_commit
+from derbynames.s3sqlite.router import use_primary
+
+from .derivatives import build_derivatives
+from .media import IMAGE_PREFIX, encode_image, save_content
+from .models import DerbyJersey, JerseyJob, TableVersion
+
+logger = getLogger(__name__)
+
+
+class ProviderError(Exception):
+    """An image provider failed; `retryable` errors are retried with backoff."""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class HuggingFaceProvider:
+    """
+    Text-to-image through the Hugging Face inference API. huggingface_hub is
+    imported when the provider is built, not with this module, which every
+    new jersey loads to queue its job.
+    """
+
+    def __init__(self, model=None, token=None):
+        from huggingface_hub import AsyncInferenceClient, InferenceClient
+
+        self.model = model or settings.JERSEY_IMAGE_MODEL
+        token = token or settings.HF_TOKEN
+        self.client = InferenceClient(provider="auto", token=token)
+        # The async client needs aiohttp; without it agenerate() uses a thread
+        self.async_client = None
+        if importlib.util.find_spec("aiohttp"):
+            self.async_client = AsyncInferenceClient(provider="auto", token=token)
+
+    def generate(self, prompt):
+        from huggingface_hub.errors import HfHubHTTPError
+        from requests.exceptions import ConnectionError, Timeout
+
+        try:
+            return self.client.text_to_image(prompt, model=self.model)
+        except HfHubHTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            retryable = status is None or status == 429 or status >= 500
+            raise ProviderError(str(e), retryable=retryable) from e
+        except (ConnectionError, Timeout) as e:
+            raise ProviderError(str(e)) from e
+
+    async def agenerate(self, prompt):
+        if self.async_client is None:
+            return await sync_to_async(self.generate, thread_sensitive=False)(prompt)
+        import aiohttp
+        from huggingface_hub.errors import InferenceTimeoutError
+
+        try:
+            return await self.async_client.text_to_image(prompt, model=self.model)
+        except aiohttp.ClientResponseError as e:
+            retryable = e.status == 429 or e.status >= 500
+            raise ProviderError(str(e), retryable=retryable) from e
+        except (aiohttp.ClientError, InferenceTimeoutError) as e:
+            raise ProviderError(str(e)) from e
+
+
+class StubProvider:
+    """
+    Offline provider drawing a deterministic placeholder jersey from the
+    prompt, with optional artificial latency, for tests and benchmarks.
+    """
+
+    def __init__(self, latency=0.0, size=512):
+        self.latency = latency
+        self.size = size
+
+    def generate(self, prompt):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.draw(prompt)
+
+    async def agenerate(self, prompt):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.draw(prompt)
+
+    def draw(self, prompt):
+        digest = hashlib.sha256(prompt.encode()).digest()
+        image = Image.new("RGB", (self.size, self.size), tuple(digest[:3]))
+        draw = ImageDraw.Draw(image)
+        margin = self.size // 5
+        draw.rectangle(
+            (margin, margin, self.size - margin, self.size - margin // 2),
+            fill=tuple(digest[3:6]),
+        )
+        draw.text((margin + 8, self.size // 2), prompt[-40:], fill=tuple(digest[6:9]))
+        return image
+
+
+PROVIDERS = {
+    "huggingface": HuggingFaceProvider,
+    "stub": StubProvider,
+}
+
+
+def get_provider(name=None, **kwargs):
+    """Build a provider by registered name or dotted path."""
+    name = name or settings.JERSEY_IMAGE_PROVIDER
+    provider_class = PROVIDERS[name] if name in PROVIDERS else import_string(name)
+    return provider_class(**kwargs)
+
+
+@cache
+def default_provider():
+    """The configured provider, built once per process and shared by drains."""
+    return get_provider()
+
+
+def job_key(jersey, prompt):
+    digest = hashlib.sha256(prompt.encode()).hexdigest()[:16]
+    return f"jersey-{jersey.pk}-{digest}"
+
+
+def enqueue_jersey_image(jersey, drain=True):
+    """
+    Queue image generation for a jersey. Re-enqueueing the same jersey and
+    prompt reuses the existing job, and gives it a new round of attempts if
+    it failed. Returns the job, or None if the jersey already has an image.
+    """
+    if jersey.image:
+        logger.info(f"Jersey image for {jersey.name} already exists.")
+        return None
+    prompt = settings.JERSEY_IMAGE_PROMPT.format(name=jersey.name)
+    job, created = JerseyJob.objects.get_or_create(
+        key=job_key(jersey, prompt), defaults={"jersey": jersey, "prompt": prompt}
+    )
+    queued = created
+    if job.state == JerseyJob.State.FAILED:
+        queued = retry_jobs(JerseyJob.objects.filter(pk=job.pk))
+        job.refresh_from_db()
+    if queued and drain:
+        schedule_drain()
+    return job
+
+
+def retry_jobs(jobs):
+    """
+    Give unfinished jobs a fresh set of attempts, due now, and mark their
+    failed jerseys pending again. Returns the number of jobs reset.
+    """
+    jobs = jobs.exclude(state=JerseyJob.State.SUCCEEDED)
+    reset = (
+        DerbyJersey.objects.failed()
+        .filter(jerseyjob__in=jobs)
+        .update(image_status=DerbyJersey.ImageStatus.PENDING, updated_at=timezone.now())
+    )
+    # update() skips the post_save that would bump the version
+    if reset:
+        TableVersion.bump(DerbyJersey._meta.db_table)
+    return jobs.update(
+        state=JerseyJob.State.PENDING, attempts=0, next_attempt_at=timezone.now()
+    )
+
+
+def schedule_drain():
+    """
+    Start one drain once the current transaction commits, however many jobs
+    it enqueued: a bulk jersey import becomes one invocation, not N.
+    """
+    connection = transaction.get_connection()
+    if any(func is drain_jersey_jobs for _, func, _ in connection.run_on_commit):
+        return
+    transaction.on_commit(drain_jersey_jobs)
+
+
+def claim_jobs(limit):
+    """Mark up to `limit` due jobs as running and return them."""
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.JERSEY_GENERATION_TIMEOUT)
+    due = JerseyJob.objects.filter(
+        Q(state=JerseyJob.State.PENDING, next_attempt_at__lte=now)
+        | Q(state=JerseyJob.State.RUNNING, updated_at__lt=stale)
+    ).values_list("pk", "state", "updated_at")[:limit]
+    claimed = []
+    for pk, state, updated_at in due:
+        # Conditional update, so concurrent drains never run the same job: a
+        # reclaimed stale job stays RUNNING, but its updated_at moves on
+        if JerseyJob.objects.filter(pk=pk, state=state, updated_at=updated_at).update(
+            state=JerseyJob.State.RUNNING, updated_at=now
+        ):
+            claimed.append(pk)
+    return list(JerseyJob.objects.filter(pk__in=claimed).select_related("jersey__name"))
+
+
+def save_jersey_image(jersey, image, prompt):
+    image_format = settings.JERSEY_IMAGE_FORMAT
+    data = encode_image(image, image_format)
+    jersey.image = save_content(jersey.image.storage, data, IMAGE_PREFIX, image_format)
+    jersey.set_metadata("prompt", prompt)
+    jersey.image_generated_at = timezone.now()
+    jersey.image_attempts += 1
+    jersey.save()
+    logger.info(f"Image for {jersey.name} saved to model: {jersey.image.url}")
+    try:
+        build_derivatives(jersey, image=image)
+    except Exception:
+        # The image itself is saved; build_jersey_derivatives backfills
+        logger.exception(f"Building derivatives for {jersey.name} failed.")
+
+
+def backoff(attempts):
+    base = settings.JERSEY_GENERATION_BACKOFF_SECONDS
+    return timedelta(seconds=base * 2 ** (attempts - 1) * random.uniform(0.5, 1.5))
+
+
+def finish_job(job, image=None, error=None):
+    """Record the outcome of one generation attempt."""
+    job.attempts += 1
+    if error is None:
+        try:
+            save_jersey_image(job.jersey, image, job.prompt)
+        except Exception as e:
+            logger.exception(f"Saving the image for {job.key} failed.")
+            error = e
+    if error is None:
+        job.state = JerseyJob.State.SUCCEEDED
+        job.last_error = ""
+    elif (
+        getattr(error, "retryable", False)
+        and job.attempts < settings.JERSEY_GENERATION_MAX_ATTEMPTS
+    ):
+        job.state = JerseyJob.State.PENDING
+        job.last_error = str(error)
+        job.next_attempt_at = timezone.now() + backoff(job.attempts)
+        # update() sends no post_save: move updated_at and the table version
+        # here, so cached API responses see the new count
+        DerbyJersey.objects.filter(pk=job.jersey_id).update(
+            image_attempts=F("image_attempts") + 1, updated_at=timezone.now()
+        )
+        TableVersion.bump(DerbyJersey._meta.db_table)
+        logger.warning(
+            f"Generation for {job.key} failed (attempt {job.attempts}), "
+            f"retrying at {job.next_attempt_at}: {error}"
+        )
+    else:
+        job.state = JerseyJob.State.FAILED
+        job.last_error = str(error)
+        jersey = job.jersey
+        jersey.refresh_from_db()
+        jersey.image_status = DerbyJersey.ImageStatus.FAILED
+        jersey.image_attempts += 1
+        jersey.save()
+        logger.error(f"Generation for {job.key} failed for good: {error}")
+    job.save()
+
+
+def record_outcome(job, outcome, counts):
+    """Finish a job with its provider result (an image or an exception)."""
+    if isinstance(outcome, ProviderError):
+        finish_job(job, error=outcome)
+    elif isinstance(outcome, BaseException):
+        logger.error(f"Generation for {job.key} raised.", exc_info=outcome)
+        finish_job(job, error=outcome)
+    else:
+        finish_job(job, image=outcome)
+    counts["retrying" if job.state == JerseyJob.State.PENDING else job.state] += 1
+
+
+def drain(provider=None, concurrency=None, limit=None):
+    """
+    Run due jobs until none are left (or `limit` have run), at most
+    `concurrency` provider calls at a time. Provider calls run in worker
+    threads; all database writes stay on this thread, and the S3 database is
+    uploaded once per batch. Returns a dict of outcome counts.
+    """
+    provider = provider or default_provider()
+    concurrency = concurrency or settings.JERSEY_GENERATION_CONCURRENCY
+    counts = {"succeeded": 0, "retrying": 0, "failed": 0}
+    done = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while limit is None or done < limit:
+            batch_size = concurrency * 2
+            if limit is not None:
+                batch_size = min(batch_size, limit - done)
+            jobs = claim_jobs(batch_size)
+            if not jobs:
+                break
+            futures = {pool.submit(provider.generate, job.prompt): job for job in jobs}
+            with group_commit():
+                for future in as_completed(futures):
+                    record_outcome(
+                        futures[future], future.exception() or future.result(), counts
+                    )
+            done += len(jobs)
+    logger.info(f"Drained jersey jobs: {counts}")
+    return counts
+
+
+def finish_batch(jobs, outcomes, counts):
+    with group_commit():
+        for job, outcome in zip(jobs, outcomes):
+            record_outcome(job, outcome, counts)
+
+
+async def adrain(provider=None, concurrency=None, limit=None):
+    """
+    drain() on an event loop: each batch of up to `concurrency` jobs has all
+    its provider calls in flight at once, without a thread per call. The
+    database work runs in Django's sync thread, one batch at a time.
+    Providers without agenerate() fall back to worker threads.
+    """
+    provider = provider or default_provider()
+    concurrency = concurrency or settings.JERSEY_GENERATION_ASYNC_CONCURRENCY
+    generate = getattr(provider, "agenerate", None) or sync_to_async(
+        provider.generate, thread_sensitive=False
+    )
+    counts = {"succeeded": 0, "retrying": 0, "failed": 0}
+    done = 0
+    while limit is None or done < limit:
+        batch_size = concurrency if limit is None else min(concurrency, limit - done)
+        jobs = await sync_to_async(claim_jobs)(batch_size)
+        if not jobs:
+            break
+        outcomes = await asyncio.gather(
+            *(generate(job.prompt) for job in jobs), return_exceptions=True
+        )
+        await sync_to_async(finish_batch)(jobs, outcomes, counts)
+        done += len(jobs)
+    logger.info(f"Drained jersey jobs on the event loop: {counts}")
+    return counts
+
+
+def run_drain():
+    """Drain with the threaded or event loop runner, per settings."""
+    if settings.JERSEY_GENERATION_ASYNC:
+        return async_to_sync(adrain)()
+    return drain()
+
+
+@task
+def drain_jersey_jobs():
+    return run_drain()
+
+
+def scheduled_drain(event, context):
+    """Zappa scheduled event: picks up retries whose backoff has elapsed."""
+    return run_drain()
+
+
+@task
+def generate_jersey_image(jersey_id):
+    """Queue and immediately drain generation for one jersey."""
+    # Run in a request, this still reads the jersey it writes to from the primary
+    with use_primary():
+        jersey = DerbyJersey.objects.get(id=jersey_id)
+        enqueue_jersey_image(jersey, drain=False)
+        run_drain()
+        jersey.refresh_from_db()
+    return jersey.image.url if jersey.image else None
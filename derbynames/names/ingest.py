@@ -0,0 +1,116 @@
+import csv
+import time
+from itertools import islice
+from logging import getLogger
+
+from django.db import connection, transaction
+from django.db.models.functions import Lower
+from django.utils import timezone
+
+from derbynames.s3sqlite.base import group_commit
+
+from .availability import name_filter
+from .corpus import ASCII_FOLD, corpus
+from .models import DerbyName, TableVersion
+from .search import bulk_indexing
+
+logger = getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 5000
+
+MAX_NAME_LENGTH = DerbyName._meta.get_field("name").max_length
+
+
+def read_names(stream, format="text"):
+    """
+    Yield names from a text stream: one per line, or for CSV the "name"
+    column (else the first column, with no header row).
+    """
+    if format == "csv":
+        rows = csv.reader(stream)
+        header = next(rows, None)
+        if header is None:
+            return
+        if "name" in header:
+            column = header.index("name")
+        else:
+            column = 0
+            yield header[0] if header else ""
+        for row in rows:
+            if len(row) > column:
+                yield row[column]
+    else:
+        for line in stream:
+            yield line.rstrip("\r\n")
+
+
+def insert_names(table, names, now):
+    """
+    Insert names, skipping any that already exist, with the statement
+    bulk_create(ignore_conflicts=True) would run but without preparing every
+    field of every model instance in Python. Returns the number inserted.
+    """
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {table} (name, created_at, updated_at, metadata) "
+            "VALUES (%s, %s, %s, NULL) ON CONFLICT DO NOTHING",
+            [(name, now, now) for name in names],
+        )
+        return cursor.rowcount
+
+
+def ingest_names(names, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+    """
+    Insert names that are not already present, ignoring case.
+
+    Each batch is deduplicated against itself and, through the lower(name)
+    index, against the table (including earlier batches) with one query,
+    then inserted with one executemany. The search index is updated once
+    at the end. Everything runs in one transaction and one database upload.
+    `progress`, if given, is called with the running stats after each batch.
+    """
+    stats = {"read": 0, "blank": 0, "too_long": 0, "duplicates": 0, "inserted": 0}
+    start = time.perf_counter()
+    names = iter(names)
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    table = DerbyName._meta.db_table
+    with group_commit(), transaction.atomic(), bulk_indexing():
+        while batch := list(islice(names, batch_size)):
+            stats["read"] += len(batch)
+            candidates = {}
+            for name in batch:
+                name = name.strip()
+                if not name:
+                    stats["blank"] += 1
+                    continue
+                if len(name) > MAX_NAME_LENGTH:
+                    stats["too_long"] += 1
+                    continue
+                key = name.translate(ASCII_FOLD)
+                if key in candidates:
+                    stats["duplicates"] += 1
+                    continue
+                candidates[key] = name
+            existing = set(
+                DerbyName.objects.order_by()
+                .annotate(lower_name=Lower("name"))
+                .filter(lower_name__in=list(candidates))
+                .values_list("lower_name", flat=True)
+            )
+            stats["duplicates"] += len(existing)
+            new = [name for key, name in candidates.items() if key not in existing]
+            if new:
+                inserted = insert_names(table, new, now)
+                # Skipped by ON CONFLICT: inserted since the check above
+                stats["duplicates"] += len(new) - inserted
+                stats["inserted"] += inserted
+            if progress:
+                progress(stats)
+        if stats["inserted"]:
+            # Raw inserts send no signals
+            TableVersion.bump(table)
+    corpus.invalidate()
+    name_filter.expire()
+    stats["seconds"] = time.perf_counter() - start
+    logger.info(f"Ingested names: {stats}")
+    return stats
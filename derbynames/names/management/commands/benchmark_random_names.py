@@ -0,0 +1,67 @@
+import time
+from functools import partial
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from derbynames.names.benchmarks import scratch_database, seed_names, time_call
+from derbynames.names.corpus import NameCorpus
+from derbynames.names.models import DerbyName
+from derbynames.names.sampling import IdReservoir
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare random name selection through the name corpus and the id "
+        "reservoir with ORDER BY RANDOM() on synthetic corpora of increasing size."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default="10000,100000,1000000",
+            help="Comma-separated corpus sizes to benchmark.",
+        )
+        parser.add_argument("--repeat", type=int, default=200)
+        parser.add_argument(
+            "--order-by-repeat",
+            type=int,
+            default=5,
+            help="Repetitions for the (slow) ORDER BY RANDOM() baseline.",
+        )
+        parser.add_argument("--k", type=int, default=10)
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options["sizes"].split(","))
+        k = options["k"]
+        with scratch_database():
+            for size in sizes:
+                seed_names(size)
+                reservoir = IdReservoir(
+                    DerbyName.objects.all(),
+                    check_interval=settings.JERSEY_IDS_CHECK_INTERVAL,
+                )
+                # Record the table version, or the first pick would reload
+                reservoir.check_version()
+                start = time.perf_counter()
+                reservoir.ids()
+                load_ms = (time.perf_counter() - start) * 1000
+                one = time_call(partial(reservoir.pick, 1), options["repeat"])
+                many = time_call(partial(reservoir.pick, k), options["repeat"])
+                names = NameCorpus(max_bytes=2**40, check_interval=60)
+                start = time.perf_counter()
+                names.warm()
+                warm_ms = (time.perf_counter() - start) * 1000
+                cached = time_call(partial(names.random, k), options["repeat"])
+                baseline = time_call(
+                    lambda: list(DerbyName.objects.order_by("?")[:k]),
+                    options["order_by_repeat"],
+                )
+                self.stdout.write(
+                    f"{size:>9} names: reservoir load {load_ms:.1f}ms, "
+                    f"pick(1) p50 {one['p50']:.3f}ms p95 {one['p95']:.3f}ms, "
+                    f"pick({k}) p50 {many['p50']:.3f}ms p95 {many['p95']:.3f}ms, "
+                    f"corpus warm-up {warm_ms:.1f}ms, "
+                    f"corpus random({k}) p50 {cached['p50']:.3f}ms, "
+                    f"ORDER BY RANDOM() p50 {baseline['p50']:.1f}ms"
+                )
@@ -0,0 +1,58 @@
+import json
+import tempfile
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from derbynames.names.benchmarks import (
+    LOAD_ROUTES,
+    read_snapshot_load_test,
+    scratch_database,
+    seed_corpus,
+)
+from derbynames.names.corpus import corpus
+from derbynames.names.management.commands.seed_benchmark_corpus import parse_size
+from derbynames.s3sqlite.snapshot import metrics
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare read throughput of the read routes with GET requests served "
+        "from the primary database and from the immutable read snapshot, on "
+        "a synthetic corpus in a scratch SQLite file. Reports JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", default="10k", help="Corpus size, e.g. 10k.")
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument(
+            "--routes",
+            default=",".join(LOAD_ROUTES),
+            help="Comma-separated routes to measure.",
+        )
+        parser.add_argument("--output", help="Write the JSON report here.")
+
+    def handle(self, *args, **options):
+        routes = {route: LOAD_ROUTES[route] for route in options["routes"].split(",")}
+        size = parse_size(options["size"])
+        report = {
+            "size": size,
+            "requests": options["requests"],
+            "concurrency": options["concurrency"],
+        }
+        with (
+            tempfile.TemporaryDirectory() as directory,
+            scratch_database(Path(directory) / "benchmark.sqlite3"),
+        ):
+            seed_corpus(size)
+            report["routes"] = read_snapshot_load_test(
+                options["requests"], options["concurrency"], routes
+            )
+            corpus.invalidate()
+        report["snapshot"] = metrics.as_dict()
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            Path(options["output"]).write_text(output + "\n")
+        else:
+            self.stdout.write(output)
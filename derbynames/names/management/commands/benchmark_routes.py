@@ -0,0 +1,101 @@
+import json
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from derbynames.names.benchmarks import (
+    compare,
+    peak_rss_mib,
+    run_routes,
+    scratch_database,
+    seed_corpus,
+)
+from derbynames.names.corpus import corpus
+from derbynames.names.management.commands.seed_benchmark_corpus import parse_size
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure p50/p95 latency, query count and peak allocation of the main "
+        "pages, API routes and admin changelists on synthetic corpora, report "
+        "them as JSON and fail on regressions against a stored baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default="1k,100k",
+            help="Comma-separated corpus sizes, e.g. 1k,100k,1m.",
+        )
+        parser.add_argument(
+            "--existing",
+            action="store_true",
+            help="Measure the configured database as it is instead of seeding.",
+        )
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--output", help="Write the JSON report here.")
+        parser.add_argument(
+            "--baseline", help="Compare with this report and fail on regressions."
+        )
+        parser.add_argument(
+            "--save-baseline",
+            action="store_true",
+            help="Write the report to --baseline instead of comparing.",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.5,
+            help="Allowed median latency and allocation growth over the baseline "
+            "(0.5 = 50%%).",
+        )
+        parser.add_argument(
+            "--memory-budget-mb",
+            type=float,
+            help="Fail if peak process memory exceeds this (e.g. the Lambda size).",
+        )
+
+    def handle(self, *args, **options):
+        report = {"sizes": {}}
+        if options["existing"]:
+            report["sizes"]["existing"] = {"routes": run_routes(options["repeat"])}
+        else:
+            with scratch_database():
+                for size in sorted(map(parse_size, options["sizes"].split(","))):
+                    start = time.perf_counter()
+                    seed_corpus(size)
+                    seed_seconds = time.perf_counter() - start
+                    self.stderr.write(f"Seeded {size} names in {seed_seconds:.1f}s")
+                    routes = run_routes(options["repeat"])
+                    report["sizes"][str(size)] = {
+                        "seed_seconds": round(seed_seconds, 1),
+                        "routes": routes,
+                    }
+                # The scratch database goes away; so must anything cached from it
+                corpus.invalidate()
+        report["peak_rss_mib"] = round(peak_rss_mib(), 1)
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            Path(options["output"]).write_text(output + "\n")
+        else:
+            self.stdout.write(output)
+
+        failures = []
+        if options["baseline"] and options["save_baseline"]:
+            Path(options["baseline"]).write_text(output + "\n")
+            self.stderr.write(f"Saved baseline to {options['baseline']}")
+        elif options["baseline"]:
+            baseline = json.loads(Path(options["baseline"]).read_text())
+            failures += compare(
+                {size: data["routes"] for size, data in report["sizes"].items()},
+                {size: data["routes"] for size, data in baseline["sizes"].items()},
+                options["tolerance"],
+            )
+        budget = options["memory_budget_mb"]
+        if budget and report["peak_rss_mib"] > budget:
+            failures.append(
+                f"peak memory {report['peak_rss_mib']}MiB exceeds {budget}MiB"
+            )
+        if failures:
+            raise CommandError("Regressions:\n" + "\n".join(failures))
@@ -0,0 +1,38 @@
+from logging import getLogger
+
+from django.core.management.base import BaseCommand
+
+from derbynames.names.derivatives import build_derivatives
+from derbynames.names.models import DerbyJersey
+from derbynames.s3sqlite.base import group_commit
+
+logger = getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Build resized WebP/AVIF copies and blur placeholders for jersey images "
+        "that are missing them or were built from an older image."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force", action="store_true", help="Rebuild current derivatives too."
+        )
+
+    def handle(self, *args, **options):
+        jerseys = DerbyJersey.objects.with_image().select_related("name")
+        built = failed = 0
+        with group_commit():
+            for jersey in jerseys.iterator():
+                try:
+                    built += build_derivatives(jersey, force=options["force"])
+                except Exception:
+                    # A missing or unreadable image skips this jersey only
+                    failed += 1
+                    logger.exception(f"Building derivatives for {jersey} failed.")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Built derivatives for {built} jerseys ({failed} failed)."
+            )
+        )
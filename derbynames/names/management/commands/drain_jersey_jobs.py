@@ -0,0 +1,69 @@
+import time
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+
+from derbynames.names.generation import (
+    adrain,
+    drain,
+    enqueue_jersey_image,
+    get_provider,
+)
+from derbynames.names.models import DerbyJersey
+
+
+class Command(BaseCommand):
+    help = (
+        "Run pending jersey image generation jobs. Use --provider stub to "
+        "measure queue throughput without network access."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--provider", help="Provider name or dotted path (default: settings)."
+        )
+        parser.add_argument(
+            "--stub-latency",
+            type=float,
+            default=0.0,
+            help="Seconds each stub provider call sleeps.",
+        )
+        parser.add_argument("--concurrency", type=int)
+        parser.add_argument("--limit", type=int, help="Stop after this many jobs.")
+        parser.add_argument(
+            "--async",
+            action="store_true",
+            dest="use_async",
+            help="Run provider calls on an event loop instead of threads.",
+        )
+        parser.add_argument(
+            "--enqueue-missing",
+            action="store_true",
+            help="First queue a job for every jersey without an image.",
+        )
+
+    def handle(self, *args, **options):
+        if options["enqueue_missing"]:
+            jerseys = DerbyJersey.objects.without_image().select_related("name")
+            queued = sum(
+                enqueue_jersey_image(jersey, drain=False) is not None
+                for jersey in jerseys.iterator()
+            )
+            self.stdout.write(f"Queued {queued} jerseys.")
+        kwargs = {}
+        if options["provider"] == "stub":
+            kwargs["latency"] = options["stub_latency"]
+        provider = get_provider(options["provider"], **kwargs)
+        start = time.perf_counter()
+        run = async_to_sync(adrain) if options["use_async"] else drain
+        counts = run(provider, options["concurrency"], options["limit"])
+        seconds = time.perf_counter() - start
+        total = sum(counts.values())
+        rate = total / seconds if seconds else 0
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Ran {total} jobs in {seconds:.1f}s ({rate:,.1f} jobs/s): "
+                f"{counts['succeeded']} succeeded, {counts['retrying']} retrying, "
+                f"{counts['failed']} failed"
+            )
+        )
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from derbynames.names.static_site import export_site, site_storage
+
+
+class Command(BaseCommand):
+    help = (
+        "Render name detail pages, the index and sitemaps to static HTML. Only "
+        "names changed since the last export are re-rendered."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output",
+            help="Write to this local directory instead of the STATIC_EXPORT_STORAGE "
+            "storage.",
+        )
+        parser.add_argument(
+            "--base-url",
+            default=settings.STATIC_EXPORT_BASE_URL,
+            help="Public URL of the export, used in its links and sitemaps.",
+        )
+        parser.add_argument("--full", action="store_true", help="Re-render every page.")
+        parser.add_argument("--workers", type=int, default=8, help="Upload threads.")
+
+    def handle(self, *args, **options):
+        counts = export_site(
+            site_storage(options["output"]),
+            options["base_url"],
+            full=options["full"],
+            workers=options["workers"],
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rendered {counts['rendered']} of {counts['pages']} pages, "
+                f"removed {counts['removed']}."
+            )
+        )
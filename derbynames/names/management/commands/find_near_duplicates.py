@@ -0,0 +1,40 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from derbynames.names.similarity import near_duplicate_clusters
+
+
+class Command(BaseCommand):
+    help = (
+        "List clusters of confusingly similar names across the whole table, "
+        "largest first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            help="Minimum similarity, 1 - edit distance / length (default: "
+            "settings.NAME_SIMILARITY_THRESHOLD).",
+        )
+        parser.add_argument(
+            "--json", action="store_true", help="Print the clusters as JSON."
+        )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        clusters = near_duplicate_clusters(options["threshold"])
+        seconds = time.perf_counter() - start
+        clusters.sort(key=len, reverse=True)
+        if options["json"]:
+            self.stdout.write(
+                json.dumps([[name for _, name in cluster] for cluster in clusters])
+            )
+            return
+        for cluster in clusters:
+            self.stdout.write(" | ".join(name for _, name in cluster))
+        self.stdout.write(
+            self.style.SUCCESS(f"Found {len(clusters)} clusters in {seconds:.1f}s.")
+        )
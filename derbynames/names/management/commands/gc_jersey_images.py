@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from derbynames.names.media import collect_garbage
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete stored jersey images and derivatives under jerseys/ that no "
+        "jersey references any more."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-age",
+            type=float,
+            default=24,
+            help="Keep unreferenced files younger than this many hours.",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", help="List files without deleting."
+        )
+
+    def handle(self, *args, **options):
+        deleted = collect_garbage(
+            default_storage,
+            timedelta(hours=options["min_age"]),
+            dry_run=options["dry_run"],
+        )
+        for name in deleted:
+            self.stdout.write(name)
+        verb = "Would delete" if options["dry_run"] else "Deleted"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {len(deleted)} files."))
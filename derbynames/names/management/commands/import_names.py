@@ -0,0 +1,65 @@
+import sys
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from derbynames.names.ingest import DEFAULT_BATCH_SIZE, ingest_names, read_names
+from derbynames.names.markov import name_generator
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk-import derby names from newline-delimited or CSV files, skipping "
+        "names that already exist (ignoring case), then fold the new names "
+        "into the name generator's model."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="Files to import, or - for stdin.")
+        parser.add_argument(
+            "--format",
+            choices=["text", "csv"],
+            help="Input format (default: csv for .csv files, otherwise text).",
+        )
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument(
+            "--no-retrain",
+            action="store_false",
+            dest="retrain",
+            help="Leave the name model to the scheduled retrain.",
+        )
+
+    def handle(self, *args, **options):
+        inserted = 0
+        for path in options["paths"]:
+            file_format = options["format"] or (
+                "csv" if Path(path).suffix.lower() == ".csv" else "text"
+            )
+            if path == "-":
+                stats = ingest_names(
+                    read_names(sys.stdin, file_format), options["batch_size"]
+                )
+            else:
+                with open(path, encoding="utf-8", newline="") as stream:
+                    stats = ingest_names(
+                        read_names(stream, file_format), options["batch_size"]
+                    )
+            inserted += stats["inserted"]
+            rate = stats["read"] / stats["seconds"] if stats["seconds"] else 0
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{path}: read {stats['read']}, inserted {stats['inserted']}, "
+                    f"duplicates {stats['duplicates']}, blank {stats['blank']}, "
+                    f"too long {stats['too_long']} in {stats['seconds']:.1f}s "
+                    f"({rate:,.0f} rows/s)"
+                )
+            )
+        # Requests never train the model; the admin and the API leave it to
+        # the scheduled retrain, but an import from the shell can wait for it
+        if inserted and options["retrain"]:
+            model = name_generator.retrain()
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Retrained the name model on {model.meta['names']} names."
+                )
+            )
@@ -0,0 +1,76 @@
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from derbynames.names.benchmarks import (
+    LOAD_ROUTES,
+    generation_load_test,
+    load_test,
+    peak_rss_mib,
+    scratch_database,
+    seed_corpus,
+)
+from derbynames.names.corpus import corpus
+from derbynames.names.management.commands.seed_benchmark_corpus import parse_size
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the WSGI and ASGI request paths of the read routes in "
+        "requests per second, latency and allocation at the same concurrency, "
+        "and threaded against event loop image generation, on a synthetic "
+        "corpus. Reports JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", default="10k", help="Corpus size, e.g. 10k.")
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--concurrency", type=int, default=16)
+        parser.add_argument(
+            "--routes",
+            default=",".join(LOAD_ROUTES),
+            help="Comma-separated routes to measure.",
+        )
+        parser.add_argument(
+            "--generation-jobs",
+            type=int,
+            default=64,
+            help="Image generation jobs per runner (0 to skip).",
+        )
+        parser.add_argument(
+            "--stub-latency",
+            type=float,
+            default=0.5,
+            help="Seconds each stub image generation waits.",
+        )
+        parser.add_argument("--output", help="Write the JSON report here.")
+
+    def handle(self, *args, **options):
+        routes = {route: LOAD_ROUTES[route] for route in options["routes"].split(",")}
+        size = parse_size(options["size"])
+        report = {
+            "size": size,
+            "requests": options["requests"],
+            "concurrency": options["concurrency"],
+        }
+        with scratch_database():
+            seed_corpus(size)
+            report["routes"] = load_test(
+                options["requests"], options["concurrency"], routes
+            )
+            if options["generation_jobs"]:
+                report["generation"] = generation_load_test(
+                    options["generation_jobs"],
+                    options["stub_latency"],
+                    settings.JERSEY_GENERATION_CONCURRENCY,
+                    settings.JERSEY_GENERATION_ASYNC_CONCURRENCY,
+                )
+            corpus.invalidate()
+        report["peak_rss_mib"] = round(peak_rss_mib(), 1)
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            Path(options["output"]).write_text(output + "\n")
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,159 @@
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# What a cold Lambda does before answering: set up Django, build the WSGI
+# handler (loading middleware) and the URLconf, then serve one request.
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import django
+django.setup()
+from django.core.wsgi import get_wsgi_application
+get_wsgi_application()
+from django.urls import get_resolver
+get_resolver().url_patterns
+ready = time.perf_counter()
+if sys.argv[1]:
+    from django.test import Client
+    from django.test.utils import override_settings
+    with override_settings(ALLOWED_HOSTS=["testserver"]):
+        Client().get(sys.argv[1])
+done = time.perf_counter()
+print(f"{(ready - start) * 1000:.1f} {(done - ready) * 1000:.1f}")
+"""
+
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def parse_importtime(output):
+    """
+    Turn `python -X importtime` output into {module: (self_us, cumulative_us,
+    depth)}. Modules are listed after their own imports, so depth 0 lines
+    are the ones imported by the startup code itself.
+    """
+    modules = {}
+    for line in output.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            modules[module] = (int(self_us), int(cumulative_us), len(indent) // 2)
+    return modules
+
+
+def profile_once(url):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT, url],
+        capture_output=True,
+        text=True,
+        env=os.environ,
+        cwd=settings.BASE_DIR,
+        # Failures are reported below, with the import lines filtered out
+        check=False,
+    )
+    if result.returncode:
+        errors = [
+            line for line in result.stderr.splitlines() if not IMPORT_LINE.match(line)
+        ]
+        raise CommandError("Startup failed:\n" + "\n".join(errors[-20:]))
+    ready_ms, request_ms = map(float, result.stdout.split()[-2:])
+    return parse_importtime(result.stderr), ready_ms, request_ms
+
+
+class Command(BaseCommand):
+    help = (
+        "Profile a cold start in fresh interpreters with -X importtime and "
+        "report import time per package and per top-level module, as text or "
+        "JSON to diff against an earlier run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--url",
+            default="",
+            help="Also serve this path once, as the first request (needs a migrated database).",
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=5, help="Runs; medians are reported."
+        )
+        parser.add_argument("--top", type=int, default=25)
+        parser.add_argument("--json", help="Write the full report to this file.")
+        parser.add_argument(
+            "--compare", help="Show the change against a report saved with --json."
+        )
+
+    def handle(self, *args, **options):
+        runs = [profile_once(options["url"]) for _ in range(options["repeat"])]
+        modules = {}
+        for module in runs[0][0]:
+            samples = [run[0][module] for run in runs if module in run[0]]
+            modules[module] = {
+                "self_ms": statistics.median(s[0] for s in samples) / 1000,
+                "cumulative_ms": statistics.median(s[1] for s in samples) / 1000,
+                "depth": samples[0][2],
+            }
+        packages = {}
+        for module, timing in modules.items():
+            package = module.split(".")[0]
+            packages[package] = packages.get(package, 0) + timing["self_ms"]
+        report = {
+            "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "ready_ms": statistics.median(run[1] for run in runs),
+            "first_request_ms": statistics.median(run[2] for run in runs),
+            "import_ms": sum(timing["self_ms"] for timing in modules.values()),
+            "packages": dict(sorted(packages.items(), key=lambda item: -item[1])),
+            "modules": modules,
+        }
+        previous = (
+            json.loads(Path(options["compare"]).read_text())
+            if options["compare"]
+            else None
+        )
+
+        def line(label, value, key=None, section=None):
+            text = f"{value:9.1f}ms  {label}"
+            if previous is not None:
+                before = (
+                    previous.get(section, {}).get(key) if section else previous.get(key)
+                )
+                if isinstance(before, dict):
+                    before = before.get("cumulative_ms")
+                delta = value - (before or 0)
+                text = f"{text:<60} {delta:+9.1f}ms"
+            self.stdout.write(text)
+
+        line(
+            "django ready (setup, WSGI handler, URLconf)",
+            report["ready_ms"],
+            "ready_ms",
+        )
+        line(
+            f"first request {options['url']}",
+            report["first_request_ms"],
+            "first_request_ms",
+        )
+        line("total import time", report["import_ms"], "import_ms")
+        self.stdout.write("\nImport time by package (self time of its modules):")
+        for package, ms in list(report["packages"].items())[: options["top"]]:
+            line(package, ms, package, "packages")
+        self.stdout.write("\nSlowest modules imported directly by the startup code:")
+        roots = sorted(
+            (
+                (module, timing)
+                for module, timing in modules.items()
+                if timing["depth"] == 0
+            ),
+            key=lambda item: -item[1]["cumulative_ms"],
+        )
+        for module, timing in roots[: options["top"]]:
+            line(module, timing["cumulative_ms"], module, "modules")
+        if options["json"]:
+            Path(options["json"]).write_text(json.dumps(report, indent=2) + "\n")
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from derbynames.names.models import DerbyName
+from derbynames.names.search import rebuild_search_index, search_enabled
+
+
+class Command(BaseCommand):
+    help = "Rebuild the trigram search index behind /api/contains/ from existing names."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default="default")
+
+    def handle(self, *args, **options):
+        using = options["database"]
+        if not search_enabled(using):
+            raise CommandError("The name search index is only available on SQLite.")
+        start = time.perf_counter()
+        rebuild_search_index(using)
+        elapsed = time.perf_counter() - start
+        count = DerbyName.objects.using(using).count()
+        self.stdout.write(
+            self.style.SUCCESS(f"Indexed {count} names in {elapsed:.2f}s.")
+        )
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from derbynames.names.benchmarks import seed_corpus
+
+SUFFIXES = {"k": 1000, "m": 1000000}
+
+
+def parse_size(value):
+    """1000, 100k or 1m"""
+    multiplier = SUFFIXES.get(value[-1:].lower(), 1)
+    try:
+        return int(value.rstrip("kKmM")) * multiplier
+    except ValueError:
+        raise CommandError(f"Invalid size: {value}")
+
+
+class Command(BaseCommand):
+    help = (
+        "Grow the database to a deterministic synthetic corpus of derby names "
+        "and jerseys for benchmarking (e.g. 1k, 100k, 1m)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("names", help="Number of names, e.g. 100k.")
+        parser.add_argument(
+            "--jerseys", help="Number of jerseys (default: one per ten names)."
+        )
+
+    def handle(self, *args, **options):
+        names = parse_size(options["names"])
+        jerseys = parse_size(options["jerseys"]) if options["jerseys"] else None
+        seed_corpus(names, jerseys)
+        self.stdout.write(self.style.SUCCESS(f"Seeded a corpus of {names} names."))
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from derbynames.names.markov import name_generator
+
+
+class Command(BaseCommand):
+    help = (
+        "Train the n-gram name generator behind /api/generate/ on names added "
+        "since it was last trained, and store the compiled model."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Retrain from every name, dropping deleted and renamed ones.",
+        )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        model = name_generator.retrain(full=options["full"])
+        elapsed = time.perf_counter() - start
+        size = len(model.dumps())
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Trained on {model.meta['names']} names in {elapsed:.2f}s: "
+                f"{len(model.contexts)} contexts, {size} bytes at "
+                f"{name_generator.path}."
+            )
+        )
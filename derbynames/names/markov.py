@@ -0,0 +1,328 @@
+import json
+import random
+import struct
+import sys
+from array import array
+from collections import Counter, defaultdict
+from itertools import accumulate
+from logging import getLogger
+from threading import RLock
+from time import monotonic
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import storages
+
+from .availability import fold, name_filter
+from .models import DerbyName, TableVersion
+
+logger = getLogger(__name__)
+
+MAGIC = b"DNGRAM1\n"
+HEADER = struct.Struct("<I")
+
+# Symbol 0 pads the start of a name and marks its end
+BOUNDARY = "\0"
+
+MAX_NAME_LENGTH = DerbyName._meta.get_field("name").max_length
+
+
+def count_ngrams(names, order, counts=None):
+    """Add each name's (previous order - 1 characters, next character) pairs."""
+    counts = Counter() if counts is None else counts
+    pad = BOUNDARY * (order - 1)
+    for name in names:
+        padded = pad + name + BOUNDARY
+        for i in range(len(name) + 1):
+            counts[padded[i : i + order - 1], padded[i + order - 1]] += 1
+    return counts
+
+
+class NoNameModel(Exception):
+    """No compiled name model is stored yet; run train_name_model."""
+
+
+class NameModel:
+    """
+    A character n-gram model compiled into flat arrays: sorted context codes,
+    each with a run of next symbols and cumulative counts to sample from.
+
+    Contexts are the previous `order - 1` symbols read as a number in base
+    len(alphabet), so moving to the next context is one multiply and modulo.
+    """
+
+    def __init__(self, order, alphabet, contexts, offsets, symbols, counts, meta):
+        self.order = order
+        self.alphabet = alphabet
+        self.contexts = contexts
+        self.offsets = offsets
+        self.symbols = symbols
+        self.counts = counts
+        self.meta = meta
+        self.base = len(alphabet)
+        self.modulus = self.base ** (order - 1)
+        self.index = {code: i for i, code in enumerate(contexts)}
+        self.cumulative = array("Q")
+        for i in range(len(contexts)):
+            run = counts[offsets[i] : offsets[i + 1]]
+            self.cumulative.extend(accumulate(run))
+
+    @classmethod
+    def compile(cls, ngrams, order, **meta):
+        chars = {char for context, following in ngrams for char in context + following}
+        alphabet = BOUNDARY + "".join(sorted(chars - {BOUNDARY}))
+        code_of = {char: i for i, char in enumerate(alphabet)}
+        base = len(alphabet)
+        runs = defaultdict(list)
+        for (context, char), count in ngrams.items():
+            code = 0
+            for symbol in context:
+                code = code * base + code_of[symbol]
+            runs[code].append((code_of[char], count))
+        contexts, offsets = array("Q"), array("I", [0])
+        symbols, counts = array("H"), array("I")
+        for code in sorted(runs):
+            contexts.append(code)
+            for symbol, count in sorted(runs[code]):
+                symbols.append(symbol)
+                counts.append(count)
+            offsets.append(len(symbols))
+        return cls(order, alphabet, contexts, offsets, symbols, counts, meta)
+
+    def ngrams(self):
+        """The counts this model was compiled from, to add more names to."""
+        ngrams = Counter()
+        width = self.order - 1
+        for i, code in enumerate(self.contexts):
+            context = []
+            for _ in range(width):
+                code, symbol = divmod(code, self.base)
+                context.append(self.alphabet[symbol])
+            context = "".join(reversed(context))
+            for j in range(self.offsets[i], self.offsets[i + 1]):
+                ngrams[context, self.alphabet[self.symbols[j]]] = self.counts[j]
+        return ngrams
+
+    def sample(self, k, max_length=MAX_NAME_LENGTH, rng=random):
+        """
+        Up to k names. All k walk the model in step: at each position, names
+        in the same context draw their next symbols in one random.choices
+        call. Names that run past `max_length` are dropped.
+        """
+        contexts = [0] * k
+        built = [[] for _ in range(k)]
+        active, done = list(range(k)), []
+        for _ in range(max_length + 1):
+            if not active:
+                break
+            groups = defaultdict(list)
+            for i in active:
+                groups[contexts[i]].append(i)
+            active = []
+            for code, members in groups.items():
+                row = self.index.get(code)
+                if row is None:
+                    continue
+                start, stop = self.offsets[row], self.offsets[row + 1]
+                drawn = rng.choices(
+                    self.symbols[start:stop],
+                    cum_weights=self.cumulative[start:stop],
+                    k=len(members),
+                )
+                for i, symbol in zip(members, drawn):
+                    if symbol == 0:
+                        done.append(i)
+                        continue
+                    built[i].append(symbol)
+                    contexts[i] = (code * self.base + symbol) % self.modulus
+                    active.append(i)
+        alphabet = self.alphabet
+        # In walk order, not finishing order, which would put short names first
+        return ["".join(alphabet[symbol] for symbol in built[i]) for i in sorted(done)]
+
+    def dumps(self):
+        header = json.dumps(
+            {
+                "order": self.order,
+                "alphabet": self.alphabet,
+                "byteorder": sys.byteorder,
+                "sizes": [len(self.contexts), len(self.symbols)],
+                "meta": self.meta,
+            }
+        ).encode()
+        return b"".join(
+            [
+                MAGIC,
+                HEADER.pack(len(header)),
+                header,
+                self.contexts.tobytes(),
+                self.offsets.tobytes(),
+                self.symbols.tobytes(),
+                self.counts.tobytes(),
+            ]
+        )
+
+    @classmethod
+    def loads(cls, data):
+        if not data.startswith(MAGIC):
+            raise ValueError("Not a compiled name model.")
+        position = len(MAGIC) + HEADER.size
+        (length,) = HEADER.unpack_from(data, len(MAGIC))
+        header = json.loads(data[position : position + length])
+        position += length
+        contexts_size, symbols_size = header["sizes"]
+        arrays = []
+        for typecode, size in (
+            ("Q", contexts_size),
+            ("I", contexts_size + 1),
+            ("H", symbols_size),
+            ("I", symbols_size),
+        ):
+            values = array(typecode)
+            end = position + size * values.itemsize
+            values.frombytes(data[position:end])
+            if header["byteorder"] != sys.byteorder:
+                values.byteswap()
+            arrays.append(values)
+            position = end
+        return cls(header["order"], header["alphabet"], *arrays, header["meta"])
+
+
+def train(order, model=None):
+    """
+    A model of every DerbyName, or `model` with the names added since it was
+    trained. Deleted and renamed names stay in an updated model until it is
+    retrained from scratch.
+    """
+    table = DerbyName._meta.db_table
+    # Read first: a write during the scan bumps the version past it
+    version = TableVersion.current(table)
+    queryset = DerbyName.objects.order_by()
+    if model is not None and model.order == order:
+        ngrams = model.ngrams()
+        trained = model.meta["names"]
+        since = model.meta["trained_through"]
+        queryset = queryset.filter(id__gt=since)
+    else:
+        ngrams, trained, since = Counter(), 0, 0
+    added = 0
+    for id, name in queryset.values_list("id", "name").iterator(chunk_size=10000):
+        count_ngrams([name], order, ngrams)
+        since = max(since, id)
+        added += 1
+    model = NameModel.compile(
+        ngrams, order, version=version, trained_through=since, names=trained + added
+    )
+    logger.info(
+        f"Trained order {order} name model on {added} new names "
+        f"({model.meta['names']} in all, {len(model.contexts)} contexts)."
+    )
+    return model
+
+
+class NameGenerator:
+    """
+    Process-wide name model for warm containers, loaded from the compiled
+    artifact in storage. Requests only ever read it: the artifact is
+    replaced by retrain() (train_name_model, import_names and the scheduled
+    retrain_name_model event), and containers pick up a newer one at most
+    every `check_interval` seconds.
+    """
+
+    def __init__(self, order, storage, path, check_interval):
+        self.order = order
+        self.storage = storage
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = RLock()
+        self._model = None
+        self._modified = None
+        self._checked_at = None
+
+    def modified_time(self):
+        try:
+            return storages[self.storage].get_modified_time(self.path)
+        except (FileNotFoundError, NotImplementedError):
+            return None
+
+    def load(self):
+        storage = storages[self.storage]
+        try:
+            with storage.open(self.path, "rb") as f:
+                model = NameModel.loads(f.read())
+        except (FileNotFoundError, ValueError) as e:
+            logger.info(f"No usable name model at {self.path} ({e}).")
+            return None
+        return model if model.order == self.order else None
+
+    def save(self, model):
+        storage = storages[self.storage]
+        content = ContentFile(model.dumps())
+        name = storage.save(self.path, content)
+        if name != self.path:
+            # A backend that keeps existing files (local and test storage)
+            # saved under another name; S3Storage replaces the object in place
+            storage.delete(self.path)
+            storage.save(self.path, content)
+            storage.delete(name)
+
+    def retrain(self, full=False):
+        with self._lock:
+            current = None if full else (self._model or self.load())
+            model = train(self.order, current)
+            self.save(model)
+            self._model, self._modified = model, self.modified_time()
+            self._checked_at = monotonic()
+            return model
+
+    def model(self):
+        """The stored model, or None if none has been trained yet."""
+        with self._lock:
+            if (
+                self._checked_at is None
+                or monotonic() - self._checked_at >= self.check_interval
+            ):
+                self._checked_at = monotonic()
+                modified = self.modified_time()
+                if self._model is None or modified != self._modified:
+                    self._model = self.load() or self._model
+                    self._modified = modified
+            return self._model
+
+    def generate(self, k, attempts=3):
+        """
+        Up to k distinct names that are not taken, ignoring case. Samples
+        are screened with the in-memory name filter, so no query is made;
+        its rare false positives only discard a novel name.
+        """
+        model = self.model()
+        if model is None:
+            raise NoNameModel("No name model has been trained yet.")
+        names, seen = [], set()
+        sampled = 0
+        for _ in range(attempts):
+            wanted = k - len(names)
+            if wanted <= 0:
+                break
+            # Oversample: some samples are existing names or repeats
+            batch = model.sample(wanted * 2)
+            sampled += len(batch)
+            for name in name_filter.untaken(batch)[:wanted]:
+                key = fold(name)
+                if name and name == name.strip() and key not in seen:
+                    seen.add(key)
+                    names.append(name)
+        return {"names": names, "sampled": sampled}
+
+
+name_generator = NameGenerator(
+    order=settings.NAME_MODEL_ORDER,
+    storage=settings.NAME_MODEL_STORAGE,
+    path=settings.NAME_MODEL_PATH,
+    check_interval=settings.NAME_MODEL_CHECK_INTERVAL,
+)
+
+
+def retrain_name_model(event=None, context=None):
+    """Zappa scheduled event: fold names added since the last run into the model."""
+    name_generator.retrain()
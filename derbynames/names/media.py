@@ -0,0 +1,85 @@
+import hashlib
+from io import BytesIO
+from logging import getLogger
+from posixpath import join
+
+from django.core.files.base import ContentFile
+from django.utils import timezone
+
+from .models import DerbyJersey
+
+logger = getLogger(__name__)
+
+IMAGE_PREFIX = "jerseys/"
+
+# Encoder options for the stored original: smallest lossless output
+ENCODE_OPTIONS = {
+    "png": {"optimize": True},
+    "webp": {"lossless": True, "method": 6},
+}
+
+
+def encode_image(image, image_format="png", **options):
+    """Encode a PIL image in memory and return the bytes."""
+    buffer = BytesIO()
+    image.save(
+        buffer, image_format.upper(), **(options or ENCODE_OPTIONS[image_format])
+    )
+    return buffer.getvalue()
+
+
+def save_content(storage, data, prefix, extension):
+    """
+    Store bytes under a name derived from their SHA-256, so identical content
+    is uploaded once: if the object already exists nothing is sent. Returns
+    the stored name.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    name = f"{prefix}{digest}.{extension}"
+    if storage.exists(name):
+        logger.debug("%s already stored.", name)
+        return name
+    # S3Storage hands the buffer to boto3's managed transfer, which switches
+    # to a multipart upload above its threshold.
+    return storage.save(name, ContentFile(data, name=name))
+
+
+def walk(storage, path):
+    """Yield the name of every file under `path`."""
+    directories, files = storage.listdir(path)
+    for file in files:
+        yield join(path, file)
+    for directory in directories:
+        yield from walk(storage, join(path, directory))
+
+
+def referenced_images():
+    """Names of every stored jersey image and derivative still in use."""
+    names = set()
+    for image, metadata in DerbyJersey.objects.values_list("image", "metadata"):
+        if image:
+            names.add(image)
+        derivatives = (metadata or {}).get("derivatives") or {}
+        for entries in derivatives.get("sources", {}).values():
+            names.update(entry["name"] for entry in entries)
+    return names
+
+
+def collect_garbage(storage, min_age, dry_run=False, prefix=IMAGE_PREFIX):
+    """
+    Delete files under `prefix` that no jersey references. Files younger than
+    `min_age` (a timedelta) are kept: they may belong to a save that has
+    uploaded but not committed yet. Returns the names deleted (or that would
+    be, with dry_run).
+    """
+    referenced = referenced_images()
+    cutoff = timezone.now() - min_age
+    deleted = []
+    for name in walk(storage, prefix.rstrip("/")):
+        if name in referenced or storage.get_modified_time(name) > cutoff:
+            continue
+        if not dry_run:
+            storage.delete(name)
+        deleted.append(name)
+    logger.info(f"{'Would delete' if dry_run else 'Deleted'} {len(deleted)} images.")
+    return deleted
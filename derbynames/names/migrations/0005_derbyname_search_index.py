@@ -0,0 +1,63 @@
+from django.db import migrations
+
+# A trigram FTS5 index over DerbyName.name supports case-insensitive substring
+# matching without the full table scan of LIKE '%x%'. Triggers keep it in
+# step with every write, including bulk_create and raw SQL.
+CREATE_SEARCH_INDEX = [
+    """
+    CREATE VIRTUAL TABLE names_derbyname_fts USING fts5(
+        name, content='names_derbyname', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER names_derbyname_fts_ai AFTER INSERT ON names_derbyname BEGIN
+        INSERT INTO names_derbyname_fts(rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+    """
+    CREATE TRIGGER names_derbyname_fts_ad AFTER DELETE ON names_derbyname BEGIN
+        INSERT INTO names_derbyname_fts(names_derbyname_fts, rowid, name)
+        VALUES ('delete', old.id, old.name);
+    END
+    """,
+    """
+    CREATE TRIGGER names_derbyname_fts_au AFTER UPDATE OF name ON names_derbyname
+    BEGIN
+        INSERT INTO names_derbyname_fts(names_derbyname_fts, rowid, name)
+        VALUES ('delete', old.id, old.name);
+        INSERT INTO names_derbyname_fts(rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+    "INSERT INTO names_derbyname_fts(names_derbyname_fts) VALUES ('rebuild')",
+]
+
+DROP_SEARCH_INDEX = [
+    "DROP TRIGGER IF EXISTS names_derbyname_fts_au",
+    "DROP TRIGGER IF EXISTS names_derbyname_fts_ad",
+    "DROP TRIGGER IF EXISTS names_derbyname_fts_ai",
+    "DROP TABLE IF EXISTS names_derbyname_fts",
+]
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for sql in CREATE_SEARCH_INDEX:
+        schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for sql in DROP_SEARCH_INDEX:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("names", "0004_alter_derbyjersey_metadata"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
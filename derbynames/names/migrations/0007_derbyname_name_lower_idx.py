@@ -0,0 +1,20 @@
+# Generated by Django 5.2.5 on 2026-10-18 13:04
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("names", "0006_tableversion"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="derbyname",
+            index=models.Index(
+                django.db.models.functions.text.Lower("name"),
+                name="derbyname_name_lower_idx",
+            ),
+        ),
+    ]
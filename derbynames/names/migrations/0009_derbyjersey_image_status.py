@@ -0,0 +1,76 @@
+# Generated by Django 5.2.5 on 2026-10-18 13:57
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_image_status(apps, schema_editor):
+    """Derive the new columns from image, metadata and past jobs."""
+    DerbyJersey = apps.get_model("names", "DerbyJersey")
+    JerseyJob = apps.get_model("names", "JerseyJob")
+    has_image = Q(image__isnull=False) & ~Q(image="")
+    attempted = Q(metadata__image_generation_attempted=True)
+    job_attempts = (
+        JerseyJob.objects.filter(jersey=OuterRef("pk"))
+        .values("jersey")
+        .annotate(total=Sum("attempts"))
+        .values("total")
+    )
+    DerbyJersey.objects.update(image_attempts=Coalesce(Subquery(job_attempts), 0))
+    # Generated before jobs kept count
+    DerbyJersey.objects.filter(attempted, image_attempts=0).update(image_attempts=1)
+    DerbyJersey.objects.filter(has_image).update(image_status="ready")
+    DerbyJersey.objects.filter(has_image, metadata__has_key="prompt").update(
+        image_generated_at=F("updated_at")
+    )
+    DerbyJersey.objects.filter(~has_image & attempted).update(image_status="failed")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("names", "0008_jerseyjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="derbyjersey",
+            name="image_attempts",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="derbyjersey",
+            name="image_generated_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="derbyjersey",
+            name="image_status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("ready", "Ready"),
+                    ("failed", "Failed"),
+                ],
+                default="pending",
+                max_length=10,
+            ),
+        ),
+        migrations.RunPython(backfill_image_status, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="derbyjersey",
+            index=models.Index(
+                condition=models.Q(("image_status", "ready")),
+                fields=["name"],
+                name="derbyjersey_has_image_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="derbyjersey",
+            index=models.Index(
+                condition=models.Q(("image_status", "pending")),
+                fields=["name"],
+                name="derbyjersey_pending_idx",
+            ),
+        ),
+    ]
@@ -1,12 +1,9 @@
 from logging import getLogger
-from pathlib import Path
 from django.db import models
-from django.conf import settings
-from django.core.files.images import ImageFile
+from django.db.models import F
+from django.db.models.functions import Lower
+from django.utils import timezone
 from django.dispatch import receiver
-from huggingface_hub import InferenceClient
-from zappa.asynchronous import task
-import tempfile
 
 logger = getLogger(__name__)
 
@@ -24,61 +21,87 @@ class DerbyName(models.Model):
         verbose_name = "Derby Name"
         verbose_name_plural = "Derby Names"
         ordering = ["name"]
+        indexes = [
+            # Case-insensitive duplicate checks during bulk ingestion
+            models.Index(Lower("name"), name="derbyname_name_lower_idx"),
+        ]
 
 
-@task
-def generate_jersey_image(jersey_id):
-    try:
-        jersey = DerbyJersey.objects.get(id=jersey_id)
-        if jersey.image:
-            logger.info(f"Jersey image for {jersey.name} already exists.")
-            jersey.set_metadata("image_generation_attempted", True)
-            jersey.save()
-        else:
-            prompt = settings.JERSEY_IMAGE_PROMPT.format(name=jersey.name)
-            logger.info(f"Prompt for image generation: {prompt}")
-            client = InferenceClient(provider="auto", token=settings.HF_TOKEN)
-            logger.info("Client created for image generation.")
-            temp_file = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
-            logger.info(f"Temporary file created at {temp_file.name}")
-            generated_image = client.text_to_image(
-                prompt,
-                model="black-forest-labs/FLUX.1-schnell",
-            )
-            logger.info(f"Generated image for {jersey.name}: {generated_image}")
-            generated_image.save(temp_file.name)
-            logger.info(f"Image saved to temporary file: {temp_file.name}")
-            # Save the image to the model's image field
-            jersey.image = ImageFile(temp_file, name=f"jersey_{jersey.name}.png")
-            logger.info(f"Image for {jersey.name} saved to model: {jersey.image.url}")
-            # Add prompt to metadata
-            logger.info(f"Saving jersey {jersey.name} with generated image.")
-            logger.info(f"Jersey {jersey.name} saved with generated image.")
-            jersey.set_metadata("prompt", prompt)
-            jersey.set_metadata("image_generation_attempted", True)
-            jersey.save()
-            temp_path = Path(temp_file.name)
-            if temp_path.exists():
-                logger.info(f"Temporary file at {temp_path} exists - deleting...")
-                temp_path.unlink()
+class TableVersion(models.Model):
+    """A per-table counter bumped on every write, so other processes can tell
+    when their in-memory copies are stale."""
+
+    table = models.CharField(max_length=100, primary_key=True)
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.table} v{self.version}"
+
+    @classmethod
+    def current(cls, table):
         return (
-            jersey.image.url if jersey.image and hasattr(jersey.image, "url") else None
+            cls.objects.filter(table=table).values_list("version", flat=True).first()
+            or 0
+        )
+
+    @classmethod
+    def bump(cls, table):
+        updated = cls.objects.filter(table=table).update(
+            version=F("version") + 1, updated_at=timezone.now()
         )
-    except Exception as e:
-        logger.error(f"Error generating jersey image: {e}")
-        return None
+        if not updated:
+            cls.objects.get_or_create(table=table, defaults={"version": 1})
+
+
+class DerbyJerseyQuerySet(models.QuerySet):
+    """Jerseys by image status, each answered from an indexed column."""
+
+    def with_image(self):
+        return self.filter(image_status=DerbyJersey.ImageStatus.READY)
+
+    def without_image(self):
+        return self.exclude(image_status=DerbyJersey.ImageStatus.READY)
+
+    def pending(self):
+        return self.filter(image_status=DerbyJersey.ImageStatus.PENDING)
+
+    def failed(self):
+        return self.filter(image_status=DerbyJersey.ImageStatus.FAILED)
 
 
 class DerbyJersey(models.Model):
+    class ImageStatus(models.TextChoices):
+        PENDING = "pending"
+        READY = "ready"
+        FAILED = "failed"
+
     name = models.ForeignKey(DerbyName, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     metadata = models.JSONField(blank=True, null=True, default=dict)
     image = models.ImageField(upload_to="jerseys/", blank=True, null=True)
+    # Kept by save() and the generation pipeline, so listings never scan
+    # image or metadata
+    image_status = models.CharField(
+        max_length=10, choices=ImageStatus.choices, default=ImageStatus.PENDING
+    )
+    image_generated_at = models.DateTimeField(blank=True, null=True)
+    image_attempts = models.PositiveIntegerField(default=0)
+
+    objects = DerbyJerseyQuerySet.as_manager()
 
     def __str__(self):
         return str(self.name)
 
+    def save(self, *args, **kwargs):
+        # The status follows the image, whoever sets or clears it
+        if self.image:
+            self.image_status = self.ImageStatus.READY
+        elif self.image_status == self.ImageStatus.READY:
+            self.image_status = self.ImageStatus.PENDING
+        super().save(*args, **kwargs)
+
     def set_metadata(self, key, value):
         if self.metadata is None:
             self.metadata = {}
@@ -89,14 +112,88 @@ class DerbyJersey(models.Model):
             return self.metadata.get(key, default)
         return default
 
+    def image_sources(self):
+        """(MIME type, srcset) pairs for the image's resized copies, if current."""
+        derivatives = self.get_metadata("derivatives") or {}
+        if not self.image or derivatives.get("source") != self.image.name:
+            return []
+        storage = self.image.storage
+        return [
+            (
+                f"image/{image_format}",
+                ", ".join(
+                    f"{storage.url(entry['name'])} {entry['width']}w"
+                    for entry in entries
+                ),
+            )
+            for image_format, entries in derivatives["sources"].items()
+        ]
+
     class Meta:
         verbose_name = "Derby Jersey"
         verbose_name_plural = "Derby Jerseys"
         ordering = ["name"]
+        indexes = [
+            # Random picks and listings of jerseys with images, and the
+            # generation backlog; each holds only the rows it serves
+            models.Index(
+                fields=["name"],
+                condition=models.Q(image_status="ready"),
+                name="derbyjersey_has_image_idx",
+            ),
+            models.Index(
+                fields=["name"],
+                condition=models.Q(image_status="pending"),
+                name="derbyjersey_pending_idx",
+            ),
+        ]
+
+
+class JerseyJob(models.Model):
+    """One image generation for a jersey, retried with backoff until it
+    succeeds or runs out of attempts."""
+
+    class State(models.TextChoices):
+        PENDING = "pending"
+        RUNNING = "running"
+        SUCCEEDED = "succeeded"
+        FAILED = "failed"
+
+    # Identifies the work (jersey and prompt), so enqueueing twice is a no-op
+    key = models.CharField(max_length=100, unique=True)
+    jersey = models.ForeignKey(DerbyJersey, on_delete=models.CASCADE)
+    prompt = models.TextField()
+    state = models.CharField(
+        max_length=10, choices=State.choices, default=State.PENDING
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.key} ({self.state})"
+
+    class Meta:
+        verbose_name = "Jersey Job"
+        verbose_name_plural = "Jersey Jobs"
+        ordering = ["next_attempt_at"]
+        indexes = [models.Index(fields=["state", "next_attempt_at"])]
 
 
 @receiver(models.signals.post_save, sender=DerbyJersey)
 def generate_jersey_image_on_save(sender, instance, created, **kwargs):
     if created:
+        from .generation import enqueue_jersey_image
+
         logger.info(f"New jersey created: {instance.name}")
-        generate_jersey_image(instance.id)
+        enqueue_jersey_image(instance)
+
+
+@receiver(models.signals.post_save, sender=DerbyName)
+@receiver(models.signals.post_delete, sender=DerbyName)
+@receiver(models.signals.post_save, sender=DerbyJersey)
+@receiver(models.signals.post_delete, sender=DerbyJersey)
+def bump_table_version(sender, **kwargs):
+    TableVersion.bump(sender._meta.db_table)
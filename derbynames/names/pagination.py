@@ -0,0 +1,89 @@
+from bisect import bisect_left, bisect_right
+
+from rest_framework.pagination import CursorPagination
+
+from .corpus import SortedNames
+
+
+class JerseyKeysetPagination(CursorPagination):
+    """Cursor pagination over DerbyJersey by id, newest first."""
+
+    ordering = ("-id",)
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+
+class NameKeysetPagination(CursorPagination):
+    """
+    Cursor pagination over DerbyName in its Meta.ordering.
+
+    DerbyName.name is unique, so the cursor position is an exact keyset
+    (WHERE name > last) and page cost does not grow with depth. The id
+    tie-breaker keeps the ordering total for querysets that are not.
+
+    Also pages SortedNames from the in-memory corpus, by bisecting on name,
+    with cursors interchangeable with the queryset path.
+    """
+
+    ordering = ("name", "id")
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if isinstance(queryset, SortedNames):
+            return self.paginate_sorted_names(queryset, request)
+        return super().paginate_queryset(queryset, request, view)
+
+    def paginate_sorted_names(self, names, request):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            (offset, reverse, current_position) = (0, False, None)
+        else:
+            (offset, reverse, current_position) = self.cursor
+
+        # The same window CursorPagination would fetch, found by bisection
+        if reverse:
+            if current_position is None:
+                end = len(names)
+            else:
+                end = bisect_left(names.names, current_position)
+            end -= offset
+            start = end - self.page_size - 1
+            results = names.instances(start, end)[::-1]
+        else:
+            if current_position is None:
+                start = 0
+            else:
+                start = bisect_right(names.names, current_position)
+            start += offset
+            results = names.instances(start, start + self.page_size + 1)
+        self.page = results[: self.page_size]
+
+        has_following_position = len(results) > len(self.page)
+        following_position = results[-1].name if has_following_position else None
+        if reverse:
+            self.page = list(reversed(self.page))
+            self.has_next = (current_position is not None) or (offset > 0)
+            self.has_previous = has_following_position
+            if self.has_next:
+                self.next_position = current_position
+            if self.has_previous:
+                self.previous_position = following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = (current_position is not None) or (offset > 0)
+            if self.has_next:
+                self.next_position = following_position
+            if self.has_previous:
+                self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
@@ -0,0 +1,94 @@
+import random
+from logging import getLogger
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.dispatch import receiver
+from django.template.loader import render_to_string
+
+from .models import DerbyJersey, DerbyName
+from .sampling import random_jerseys, random_names
+
+logger = getLogger(__name__)
+
+
+class SelectionPool:
+    """
+    A rotating set of pre-rendered random selections kept in the cache, so a
+    page can show a fresh-looking pick without querying or rendering: each
+    request takes one entry at random. `build(size)` renders the entries.
+    The pool expires after SELECTION_POOL_TTL seconds and is rebuilt on the
+    next request.
+
+    The cache is the default per-process LocMemCache, so each container
+    keeps its own pool and invalidate() only reaches the container that
+    made the change; the others catch up within SELECTION_POOL_TTL.
+    """
+
+    def __init__(self, name, build):
+        self.key = f"selection-pool:{name}"
+        self.build = build
+
+    def refill(self):
+        entries = self.build(settings.SELECTION_POOL_SIZE)
+        cache.set(self.key, entries, settings.SELECTION_POOL_TTL)
+        logger.info(f"Refilled {self.key} with {len(entries)} selections.")
+        return entries
+
+    def pick(self):
+        entries = cache.get(self.key)
+        if entries is None:
+            entries = self.refill()
+        return random.choice(entries) if entries else ""
+
+    async def apick(self):
+        entries = await cache.aget(self.key)
+        if entries is None:
+            entries = await sync_to_async(self.refill)()
+        return random.choice(entries) if entries else ""
+
+    def invalidate(self):
+        cache.delete(self.key)
+
+
+def build_name_lists(size):
+    return [
+        render_to_string("names/_name_list.html", {"names": random_names(10)})
+        for _ in range(size)
+    ]
+
+
+def build_jersey_cards(size):
+    # One query for the whole pool, then each grid is sampled from it
+    jerseys = random_jerseys(size * 9)
+    if not jerseys:
+        return []
+    return [
+        render_to_string(
+            "names/_jersey_cards.html",
+            {"jerseys": random.sample(jerseys, min(9, len(jerseys)))},
+        )
+        for _ in range(size)
+    ]
+
+
+name_lists = SelectionPool("names", build_name_lists)
+jersey_cards = SelectionPool("jerseys", build_jersey_cards)
+
+
+@receiver(models.signals.post_save, sender=DerbyName)
+@receiver(models.signals.post_delete, sender=DerbyName)
+def invalidate_name_lists(sender, **kwargs):
+    name_lists.invalidate()
+    # Cards show their jersey's name
+    jersey_cards.invalidate()
+
+
+@receiver(models.signals.post_save, sender=DerbyJersey)
+@receiver(models.signals.post_delete, sender=DerbyJersey)
+def invalidate_jersey_cards(sender, **kwargs):
+    # Whether the jersey was pooled before the change is not known here: its
+    # image may just have been cleared
+    jersey_cards.invalidate()
@@ -0,0 +1,104 @@
+import random
+from array import array
+from logging import getLogger
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+from django.db import models
+from django.dispatch import receiver
+
+from .corpus import corpus
+from .models import DerbyJersey, TableVersion
+
+logger = getLogger(__name__)
+
+
+class IdReservoir:
+    """
+    In-process array of primary keys used to pick random rows without asking
+    the database to sort the whole table (ORDER BY RANDOM()).
+
+    The ids are read once from the primary key index and reloaded after an
+    invalidate(), e.g. from a post_save receiver. Writes from other
+    processes are noticed through TableVersion, checked at most once every
+    `check_interval` seconds; rows deleted since are also detected when
+    fetching and trigger a reload.
+    """
+
+    def __init__(self, queryset, check_interval):
+        self.queryset = queryset
+        self.check_interval = check_interval
+        self._ids = None
+        self._lock = Lock()
+        self._version = None
+        self._checked_at = None
+
+    def check_version(self):
+        now = monotonic()
+        if (
+            self._checked_at is not None
+            and now - self._checked_at < self.check_interval
+        ):
+            return
+        version = TableVersion.current(self.queryset.model._meta.db_table)
+        with self._lock:
+            if version != self._version:
+                logger.info(f"Random ids are stale (v{self._version} -> v{version}).")
+                self._ids = None
+                self._version = version
+            self._checked_at = now
+
+    def ids(self):
+        if self._ids is None:
+            with self._lock:
+                if self._ids is None:
+                    pks = self.queryset.order_by().values_list("pk", flat=True)
+                    self._ids = array("q", pks.iterator(chunk_size=10000))
+                    logger.info(f"Loaded {len(self._ids)} ids for random selection.")
+        return self._ids
+
+    def invalidate(self):
+        with self._lock:
+            self._ids = None
+            self._checked_at = None
+
+    def pick(self, k=1, attempts=3):
+        """Return up to k distinct random rows, in random order."""
+        self.check_version()
+        rows, pks = {}, []
+        for _ in range(attempts):
+            ids = self.ids()
+            pks = random.sample(ids, min(k, len(ids)))
+            rows = self.queryset.in_bulk(pks)
+            if len(rows) == len(pks):
+                break
+            # Another process deleted some of these rows; start over.
+            logger.info("Random selection hit deleted ids, reloading.")
+            self.invalidate()
+        return [rows[pk] for pk in pks if pk in rows]
+
+
+def random_names(k):
+    return corpus.random(k)
+
+
+def random_name():
+    picked = corpus.random(1)
+    return picked[0] if picked else None
+
+
+jerseys_with_images = IdReservoir(
+    DerbyJersey.objects.with_image().select_related("name"),
+    check_interval=settings.JERSEY_IDS_CHECK_INTERVAL,
+)
+
+
+def random_jerseys(k):
+    return jerseys_with_images.pick(k)
+
+
+@receiver(models.signals.post_save, sender=DerbyJersey)
+@receiver(models.signals.post_delete, sender=DerbyJersey)
+def invalidate_jersey_ids(sender, **kwargs):
+    jerseys_with_images.invalidate()
@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+from logging import getLogger
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Case, IntegerField, Value, When
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Length
+
+from .models import DerbyName
+
+logger = getLogger(__name__)
+
+# Created by migration 0005 on SQLite databases.
+SEARCH_TABLE = "names_derbyname_fts"
+
+# The trigram tokenizer can only answer queries of at least three characters.
+MIN_INDEXED_LENGTH = 3
+
+# The per-row insert trigger from migration 0005, dropped during bulk loads
+INSERT_TRIGGER = "names_derbyname_fts_ai"
+CREATE_INSERT_TRIGGER = f"""
+    CREATE TRIGGER {INSERT_TRIGGER} AFTER INSERT ON names_derbyname BEGIN
+        INSERT INTO {SEARCH_TABLE}(rowid, name) VALUES (new.id, new.name);
+    END
+"""
+
+
+def search_enabled(using="default"):
+    return connections[using].vendor == "sqlite"
+
+
+def search_limit(requested):
+    """Clamp a user-supplied result limit to the configured bounds."""
+    try:
+        limit = int(requested)
+    except (TypeError, ValueError):
+        return settings.NAME_SEARCH_DEFAULT_LIMIT
+    return max(1, min(limit, settings.NAME_SEARCH_MAX_LIMIT))
+
+
+def indexed_search(substring, using="default"):
+    return search_enabled(using) and len(substring) >= MIN_INDEXED_LENGTH
+
+
+def matching_ids(substring):
+    """Subquery of the ids of names containing `substring`, ignoring case."""
+    phrase = '"{}"'.format(substring.replace('"', '""'))
+    return RawSQL(
+        f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s", [phrase]
+    )
+
+
+def search_names(substring, limit=None):
+    """
+    Case-insensitive substring search over DerbyName.name.
+
+    Candidates come from the trigram index where possible. Results are ranked
+    exact match first, then prefix matches, then shorter names.
+    """
+    limit = limit or settings.NAME_SEARCH_DEFAULT_LIMIT
+    queryset = DerbyName.objects.all()
+    if indexed_search(substring, queryset.db):
+        queryset = queryset.filter(id__in=matching_ids(substring))
+    else:
+        queryset = queryset.filter(name__icontains=substring)
+    rank = Case(
+        When(name__iexact=substring, then=Value(0)),
+        When(name__istartswith=substring, then=Value(1)),
+        default=Value(2),
+        output_field=IntegerField(),
+    )
+    return queryset.annotate(search_rank=rank).order_by(
+        "search_rank", Length("name"), "name"
+    )[:limit]
+
+
+def rebuild_search_index(using="default"):
+    """Repopulate the search index from the DerbyName table."""
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')")
+    logger.info("Rebuilt name search index.")
+
+
+@contextmanager
+def bulk_indexing(using="default"):
+    """
+    Index the names inserted in this block with one statement at the end,
+    instead of one trigger call per row (about five times faster). Must run
+    inside a transaction, so a failure also restores the trigger.
+    """
+    connection = connections[using]
+    if not search_enabled(using):
+        yield
+        return
+    if not connection.in_atomic_block:
+        raise RuntimeError("bulk_indexing() must run inside a transaction.")
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM names_derbyname")
+        (last_id,) = cursor.fetchone()
+        cursor.execute(f"DROP TRIGGER {INSERT_TRIGGER}")
+    yield
+    with connection.cursor() as cursor:
+        # Ids only grow: Django creates SQLite primary keys with AUTOINCREMENT.
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE}(rowid, name) "
+            "SELECT id, name FROM names_derbyname WHERE id > %s",
+            [last_id],
+        )
+        cursor.execute(CREATE_INSERT_TRIGGER)
@@ -0,0 +1,172 @@
+import re
+from collections import Counter, defaultdict
+from logging import getLogger
+from math import floor
+
+from django.conf import settings
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Lower
+
+from .corpus import ASCII_FOLD
+from .models import DerbyName
+from .search import MIN_INDEXED_LENGTH, SEARCH_TABLE, search_enabled
+
+logger = getLogger(__name__)
+
+SEPARATORS = re.compile(r"[\W_]+")
+
+
+def normalize(name):
+    """Case-folded, with runs of punctuation and spaces made one space."""
+    return SEPARATORS.sub(" ", name.translate(ASCII_FOLD)).strip()
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, limit):
+    """Levenshtein distance of a and b, or None if it is over `limit`."""
+    if abs(len(a) - len(b)) > limit:
+        return None
+    # Cells more than `limit` off the diagonal cannot lead back under it, so
+    # only the band around it is computed
+    over = limit + 1
+    previous = [min(j, over) for j in range(len(b) + 1)]
+    for i, char in enumerate(a, 1):
+        low, high = max(1, i - limit), min(len(b), i + limit)
+        current = [over] * (len(b) + 1)
+        current[0] = min(i, over)
+        for j in range(low, high + 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char != b[j - 1]),
+            )
+        # Every later row is at least this row's minimum
+        if min(current[low - 1 : high + 1]) > limit:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= limit else None
+
+
+def edit_budget(length, threshold):
+    """Most edits a name `length` long can take and stay within `threshold`."""
+    # (1 - 0.8) * 10 is 1.999..., so allow for rounding
+    return floor((1 - threshold) * length + 1e-9)
+
+
+def similarity(a, b, threshold):
+    """
+    1 - edit distance / length of the longer, for normalized names; None
+    below `threshold`.
+    """
+    longest = max(len(a), len(b))
+    if not longest:
+        return 1.0
+    distance = edit_distance(a, b, edit_budget(longest, threshold))
+    return None if distance is None else 1 - distance / longest
+
+
+def candidates(name, limit, min_length=0):
+    """
+    Names sharing the most (and rarest) trigrams with `name`, from the FTS5
+    trigram index that backs search; triggers keep it in step with the table.
+    Names shorter than `min_length` are skipped before ranking.
+    """
+    folded = name.translate(ASCII_FOLD)
+    grams = {folded[i : i + 3] for i in range(len(folded) - 2)}
+    queryset = DerbyName.objects.order_by()
+    if len(folded) < MIN_INDEXED_LENGTH or not search_enabled(queryset.db):
+        # Too short for the index (or no index): only case variants
+        return queryset.annotate(lower_name=Lower("name")).filter(lower_name=folded)
+    query = " OR ".join('"{}"'.format(gram.replace('"', '""')) for gram in grams)
+    ranked = RawSQL(
+        f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s "
+        "AND length(name) >= %s ORDER BY rank LIMIT %s",
+        [query, min_length, limit],
+    )
+    return queryset.filter(id__in=ranked)
+
+
+def similar_names(name, k=None, threshold=None, exclude=None):
+    """
+    The `k` existing names most similar to `name` (at least `threshold`),
+    most similar first, as dicts of id, name and similarity. Candidates
+    come from the trigram index; each is verified by edit distance.
+    """
+    k = k or settings.NAME_SIMILARITY_TOP_K
+    threshold = threshold or settings.NAME_SIMILARITY_THRESHOLD
+    key = normalize(name)
+    # Normalizing never lengthens a name, so shorter ones cannot be in reach
+    min_length = len(key) - edit_budget(len(key), threshold)
+    matches = []
+    for other in candidates(name, settings.NAME_SIMILARITY_CANDIDATES, min_length):
+        if other.pk == exclude:
+            continue
+        score = similarity(key, normalize(other.name), threshold)
+        if score is not None:
+            matches.append({"id": other.pk, "name": other.name, "similarity": score})
+    matches.sort(key=lambda match: (-match["similarity"], match["name"]))
+    return matches[:k]
+
+
+def near_duplicate_clusters(threshold=None):
+    """
+    Group the whole table into clusters of names within `threshold` of each
+    other (transitively), as lists of (id, name); singletons are left out.
+
+    Prefix filtering keeps this well below comparing every pair: each name
+    is only compared with names sharing one of its rarest trigrams, taking
+    enough of them that any name within the edit distance the threshold
+    allows must share one.
+    """
+    threshold = threshold or settings.NAME_SIMILARITY_THRESHOLD
+    rows = list(DerbyName.objects.order_by("id").values_list("id", "name"))
+    # Shortest first, so each name is only compared with names no longer
+    rows.sort(key=lambda row: len(normalize(row[1])))
+    keys = [normalize(name) for _, name in rows]
+    grams = [trigrams(key) for key in keys]
+    frequency = Counter(gram for name_grams in grams for gram in name_grams)
+    index = defaultdict(list)
+    parent = list(range(len(rows)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    compared = 0
+    for i, key in enumerate(keys):
+        # Each edit changes at most three trigrams. Names already indexed are
+        # no longer than this one, so within the threshold of each other they
+        # are this many edits apart at most...
+        allowed = edit_budget(len(key), threshold)
+        # ...while a longer name still to come may be this many
+        edits = edit_budget(len(key) / threshold, threshold)
+        prefix = sorted(grams[i], key=lambda gram: (frequency[gram], gram))
+        others = {j for gram in prefix[: 3 * allowed + 1] for j in index[gram]}
+        for j in others:
+            if (
+                len(keys[j]) < len(key) - allowed
+                or len(grams[i] & grams[j]) < len(grams[i]) - 3 * allowed
+                or root(i) == root(j)
+            ):
+                continue
+            compared += 1
+            if similarity(key, keys[j], threshold) is not None:
+                parent[root(i)] = root(j)
+        for gram in prefix[: 3 * edits + 1]:
+            index[gram].append(i)
+
+    clusters = defaultdict(list)
+    for i, row in sorted(enumerate(rows), key=lambda item: item[1][0]):
+        clusters[root(i)].append(row)
+    found = [cluster for cluster in clusters.values() if len(cluster) > 1]
+    logger.info(
+        f"Found {len(found)} near-duplicate clusters in {len(rows)} names "
+        f"with {compared} comparisons."
+    )
+    return found
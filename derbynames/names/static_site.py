@@ -0,0 +1,234 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from logging import getLogger
+from threading import local
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, storages
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.template.loader import render_to_string
+from django.urls import get_script_prefix, reverse, set_script_prefix
+from django.utils import timezone
+
+from derbynames.lazy import task
+
+from .models import DerbyJersey, DerbyName
+from .pool import build_name_lists
+
+logger = getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+SITEMAP_URLS = 50000
+RENDER_BATCH_SIZE = 500
+
+
+class LocalSiteStorage(FileSystemStorage):
+    """Writes to a local directory, replacing files instead of renaming."""
+
+    def get_available_name(self, name, max_length=None):
+        self.delete(name)
+        return name
+
+
+def site_storage(directory=None):
+    if directory:
+        return LocalSiteStorage(location=directory)
+    return storages[settings.STATIC_EXPORT_STORAGE]
+
+
+@contextmanager
+def site_urls(base_url):
+    """
+    Make reverse() and {% url %} link to pages under `base_url` for the
+    block, so exported pages link to each other wherever they are served.
+    """
+    prefix = get_script_prefix()
+    set_script_prefix(base_url.rstrip("/") + "/")
+    try:
+        yield
+    finally:
+        set_script_prefix(prefix)
+
+
+def page_name(name_id):
+    url = reverse("name-detail", args=[name_id])
+    return url[len(get_script_prefix()) :] + "index.html"
+
+
+def stamp(*timestamps):
+    return max(filter(None, timestamps)).isoformat()
+
+
+def current_stamps():
+    """{name id: ISO timestamp of the latest change to it or its jerseys}"""
+    rows = (
+        DerbyName.objects.order_by()
+        .annotate(jersey_updated_at=Max("derbyjersey__updated_at"))
+        .values_list("id", "updated_at", "jersey_updated_at")
+    )
+    return {
+        name_id: stamp(updated_at, jersey_updated_at)
+        for name_id, updated_at, jersey_updated_at in rows.iterator(chunk_size=10000)
+    }
+
+
+def render_details(name_ids):
+    """Yield (page name, HTML) for each name, two queries per call."""
+    names = DerbyName.objects.in_bulk(name_ids)
+    # The detail view shows the first jersey for the name
+    jerseys = {}
+    for jersey in DerbyJersey.objects.filter(name_id__in=name_ids).order_by("-id"):
+        jerseys[jersey.name_id] = jersey
+    for name_id, name in names.items():
+        html = render_to_string(
+            "names/detail.html", {"name": name, "jersey": jerseys.get(name_id)}
+        )
+        yield page_name(name_id), html
+
+
+def render_sitemaps(stamps, base_url):
+    """Yield (file name, XML) for sitemaps of every detail page and their index."""
+    base_url = base_url.rstrip("/")
+    ids = sorted(stamps)
+    chunks = [ids[i : i + SITEMAP_URLS] for i in range(0, len(ids), SITEMAP_URLS)]
+    for number, chunk in enumerate(chunks, 1):
+        urls = "".join(
+            f"<url><loc>{escape(base_url)}/{page_name(name_id)[: -len('index.html')]}"
+            f"</loc><lastmod>{stamps[name_id]}</lastmod></url>"
+            for name_id in chunk
+        )
+        yield (
+            f"sitemap-{number}.xml",
+            (
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+                f"{urls}</urlset>"
+            ),
+        )
+    sitemaps = "".join(
+        f"<sitemap><loc>{escape(base_url)}/sitemap-{number}.xml</loc></sitemap>"
+        for number in range(1, len(chunks) + 1)
+    )
+    yield (
+        "sitemap.xml",
+        (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            f"{sitemaps}</sitemapindex>"
+        ),
+    )
+
+
+def read_manifest(storage):
+    if not storage.exists(MANIFEST_NAME):
+        return {}
+    with storage.open(MANIFEST_NAME) as manifest:
+        return {int(k): v for k, v in json.load(manifest)["pages"].items()}
+
+
+def export_site(storage, base_url, full=False, workers=8):
+    """
+    Render detail pages, the index and sitemaps into `storage`, linking to
+    each other under `base_url`. Only names
+    whose stamp differs from the last export's manifest are rendered, unless
+    `full`; pages of deleted names are removed. Rendering happens on this
+    thread, uploads in `workers` threads. Returns a dict of counts.
+    """
+    started = timezone.now()
+    previous = {} if full else read_manifest(storage)
+    stamps = current_stamps()
+    changed = [
+        name_id for name_id, value in stamps.items() if previous.get(name_id) != value
+    ]
+    removed = [name_id for name_id in previous if name_id not in stamps]
+
+    def write(item):
+        name, content = item
+        storage.save(name, ContentFile(content.encode("utf-8")))
+
+    with site_urls(base_url), ThreadPoolExecutor(max_workers=workers) as pool:
+        uploads = []
+        for start in range(0, len(changed), RENDER_BATCH_SIZE):
+            batch = changed[start : start + RENDER_BATCH_SIZE]
+            rendered = [pool.submit(write, page) for page in render_details(batch)]
+            # Render one batch ahead of the uploads, no further
+            for upload in uploads:
+                upload.result()
+            uploads = rendered
+        uploads += [
+            pool.submit(storage.delete, page_name(name_id)) for name_id in removed
+        ]
+        # Rendered afresh: the pooled lists link to the app's pages
+        name_list = build_name_lists(1)[0]
+        index = render_to_string("names/index.html", {"name_list": name_list})
+        uploads.append(pool.submit(write, ("index.html", index)))
+        uploads += [
+            pool.submit(write, sitemap) for sitemap in render_sitemaps(stamps, base_url)
+        ]
+        for upload in uploads:
+            upload.result()
+    # The manifest goes last, so an interrupted export is redone next time
+    write(
+        (
+            MANIFEST_NAME,
+            json.dumps({"exported_at": started.isoformat(), "pages": stamps}),
+        )
+    )
+    counts = {"rendered": len(changed), "removed": len(removed), "pages": len(stamps)}
+    logger.info(f"Exported static site: {counts}")
+    return counts
+
+
+@task
+def export_pages(name_ids):
+    """Re-render (or remove) the detail pages of the given names."""
+    storage = site_storage()
+    existing = set(
+        DerbyName.objects.filter(id__in=name_ids).values_list("id", flat=True)
+    )
+    with site_urls(settings.STATIC_EXPORT_BASE_URL):
+        pages = list(render_details(list(existing)))
+    for name, html in pages:
+        storage.save(name, ContentFile(html.encode("utf-8")))
+    for name_id in set(name_ids) - existing:
+        storage.delete(page_name(name_id))
+
+
+_pending = local()
+
+
+def flush_pending_pages():
+    name_ids = sorted(getattr(_pending, "ids", ()))
+    _pending.ids = set()
+    if name_ids:
+        export_pages(name_ids)
+
+
+def queue_page(name_id):
+    """Re-render a detail page once the current transaction commits."""
+    if not hasattr(_pending, "ids"):
+        _pending.ids = set()
+    _pending.ids.add(name_id)
+    connection = transaction.get_connection()
+    if not any(func is flush_pending_pages for _, func, _ in connection.run_on_commit):
+        transaction.on_commit(flush_pending_pages)
+
+
+@receiver(post_save, sender=DerbyName)
+@receiver(post_delete, sender=DerbyName)
+def export_name_page(sender, instance, **kwargs):
+    if settings.STATIC_EXPORT_ON_SAVE:
+        queue_page(instance.pk)
+
+
+@receiver(post_save, sender=DerbyJersey)
+@receiver(post_delete, sender=DerbyJersey)
+def export_jersey_page(sender, instance, **kwargs):
+    if settings.STATIC_EXPORT_ON_SAVE:
+        queue_page(instance.name_id)
@@ -1 +1,1062 @@
-# Create your tests here.
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from itertools import combinations
+from pathlib import Path
+from threading import Barrier, Lock
+from unittest import mock
+from wsgiref.util import setup_testing_defaults
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.storage import storages
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from derbynames import asgi_urls, coalescing
+from derbynames.instrumentation import (
+    RequestMetrics,
+    current,
+    finish_s3_call,
+    instrument_s3_client,
+)
+from derbynames.s3sqlite.snapshot import S3Store
+from derbynames.storage import S3Storage
+
+from .admin import EstimatedCountPaginator
+from .availability import name_filter
+from .corpus import corpus
+from .generation import (
+    ProviderError,
+    StubProvider,
+    claim_jobs,
+    drain,
+    enqueue_jersey_image,
+    finish_job,
+)
+from .ingest import MAX_NAME_LENGTH, ingest_names, insert_names
+from .markov import NameGenerator, name_generator
+from .models import DerbyJersey, DerbyName, JerseyJob, TableVersion
+from .pool import jersey_cards, name_lists
+from .sampling import jerseys_with_images
+from .similarity import near_duplicate_clusters, normalize, similarity
+from .static_site import export_site, site_storage
+from .transfer import EXPORT_FORMATS
+
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.InMemoryStorage"},
+    "models": {"BACKEND": "django.core.files.storage.InMemoryStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
+
+
+@override_settings(STORAGES=STORAGES)
+class QueryCountTests(TestCase):
+    """Each view makes the same number of queries however many rows it shows."""
+
+    @classmethod
+    def setUpTestData(cls):
+        names = DerbyName.objects.bulk_create(
+            DerbyName(name=f"Jammer {i:02d}") for i in range(20)
+        )
+        # Two jerseys per name, with resized copies; bulk_create queues no jobs
+        cls.jerseys = DerbyJersey.objects.bulk_create(
+            DerbyJersey(
+                name=name,
+                image=f"jerseys/{name.pk}-{copy}.png",
+                image_status=DerbyJersey.ImageStatus.READY,
+                metadata={
+                    "prompt": f"A jersey for {name}",
+                    "derivatives": {
+                        "source": f"jerseys/{name.pk}-{copy}.png",
+                        "sources": {
+                            "webp": [{"name": f"jerseys/{name.pk}.webp", "width": 320}]
+                        },
+                    },
+                },
+            )
+            for name in names
+            for copy in range(2)
+        )
+        JerseyJob.objects.bulk_create(
+            JerseyJob(key=f"job-{jersey.pk}", jersey=jersey, prompt="prompt")
+            for jersey in cls.jerseys
+        )
+        cls.name = names[0]
+
+    def setUp(self):
+        cache.clear()
+        jerseys_with_images.invalidate()
+
+    def assertQueriesPerPage(self, url, queries, sizes=(2, 15)):
+        for size in sizes:
+            with self.subTest(url=url, page_size=size):
+                separator = "&" if "?" in url else "?"
+                with self.assertNumQueries(queries):
+                    response = self.client.get(
+                        f"{url}{separator}page_size={size}",
+                        HTTP_ACCEPT="application/json",
+                    )
+                self.assertEqual(response.status_code, 200)
+
+    def test_jersey_list(self):
+        # Table versions, then the page joined to its names
+        self.assertQueriesPerPage("/api/jerseys/", 2)
+        self.assertQueriesPerPage("/api/jerseys/?status=ready", 2)
+
+    def test_jersey_detail(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                f"/api/jerseys/{self.jerseys[0].pk}/", HTTP_ACCEPT="application/json"
+            )
+        self.assertEqual(response.json()["name"]["name"], "Jammer 00")
+        self.assertEqual(response.json()["sources"][0]["type"], "image/webp")
+
+    def test_names_with_jerseys(self):
+        # Table versions, the page of names, then all of their jerseys
+        self.assertQueriesPerPage("/api/names-with-jerseys/", 3)
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                f"/api/names-with-jerseys/{self.name.pk}/",
+                HTTP_ACCEPT="application/json",
+            )
+        self.assertEqual(len(response.json()["jerseys"]), 2)
+
+    def test_sparse_fieldsets(self):
+        response = self.client.get(
+            "/api/jerseys/?fields=id,prompt", HTTP_ACCEPT="application/json"
+        )
+        self.assertEqual(set(response.json()["results"][0]), {"id", "prompt"})
+        # Leaving out the jerseys skips their query
+        self.assertQueriesPerPage("/api/names-with-jerseys/?fields=id,name", 2)
+        response = self.client.get(
+            "/api/names-with-jerseys/?fields=name", HTTP_ACCEPT="application/json"
+        )
+        self.assertEqual(response.json()["results"][0], {"name": "Jammer 00"})
+
+    def test_name_list(self):
+        self.assertQueriesPerPage("/api/names/", 2)
+
+    def test_pages(self):
+        # Validators, the name and its first jersey
+        with self.assertNumQueries(3):
+            self.client.get(f"/names/{self.name.pk}/")
+        # Building the jersey pool checks the table version, reads the ids,
+        # then the picked rows with their names; later requests render from
+        # the cache
+        with self.assertNumQueries(3):
+            self.client.get("/jerseys/")
+        with self.assertNumQueries(0):
+            self.client.get("/jerseys/")
+
+    def test_admin_changelists(self):
+        user = get_user_model().objects.create_superuser("admin", "", "password")
+        self.client.force_login(user)
+        # Session, user, two counts, then the page with jerseys and names
+        for url in ("/admin/names/derbyjersey/", "/admin/names/jerseyjob/"):
+            with self.subTest(url=url), self.assertNumQueries(5):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+
+@override_settings(STORAGES=STORAGES)
+class JerseyValidatorTests(TestCase):
+    """Changes made with update() still move the jersey APIs' validators."""
+
+    @classmethod
+    def setUpTestData(cls):
+        name = DerbyName.objects.create(name="Retry Rita")
+        (cls.jersey,) = DerbyJersey.objects.bulk_create([DerbyJersey(name=name)])
+        cls.job = JerseyJob.objects.create(
+            key="retry", jersey=cls.jersey, prompt="prompt"
+        )
+
+    def etags(self):
+        return [
+            self.client.get(url, HTTP_ACCEPT="application/json")["ETag"]
+            for url in ("/api/jerseys/", f"/api/jerseys/{self.jersey.pk}/")
+        ]
+
+    def assertChangesETags(self, change):
+        before = self.etags()
+        change()
+        for url, etag in zip(("list", "detail"), before):
+            with self.subTest(url=url):
+                self.assertNotIn(etag, self.etags())
+
+    def test_retryable_failure(self):
+        self.assertChangesETags(
+            lambda: finish_job(self.job, error=ProviderError("busy"))
+        )
+        self.jersey.refresh_from_db()
+        self.assertEqual(self.jersey.image_attempts, 1)
+
+    def test_admin_retry(self):
+        DerbyJersey.objects.filter(pk=self.jersey.pk).update(
+            image_status=DerbyJersey.ImageStatus.FAILED
+        )
+        JerseyJob.objects.filter(pk=self.job.pk).update(state=JerseyJob.State.FAILED)
+        user = get_user_model().objects.create_superuser("admin", "", "password")
+        self.client.force_login(user)
+        self.assertChangesETags(
+            lambda: self.client.post(
+                "/admin/names/jerseyjob/",
+                {"action": "retry_now", "_selected_action": [self.job.pk]},
+            )
+        )
+        self.jersey.refresh_from_db()
+        self.assertEqual(self.jersey.image_status, DerbyJersey.ImageStatus.PENDING)
+
+
+@override_settings(STORAGES=STORAGES)
+class NameGeneratorTests(TestCase):
+    """Requests serve the stored model; only retrain() trains one."""
+
+    @classmethod
+    def setUpTestData(cls):
+        DerbyName.objects.bulk_create(
+            DerbyName(name=name)
+            for name in ("Jam Session", "Jammy Dodger", "Block Party", "Blockbuster")
+        )
+
+    def setUp(self):
+        # The storage outlives each test
+        storages["models"].delete("models/test.bin")
+        generator = NameGenerator(
+            order=3, storage="models", path="models/test.bin", check_interval=0
+        )
+        patcher = mock.patch("derbynames.urls.name_generator", generator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.generator = generator
+
+    def get(self):
+        return self.client.get("/api/generate/?count=3", HTTP_ACCEPT="application/json")
+
+    def test_untrained(self):
+        with mock.patch("derbynames.names.markov.train") as train:
+            self.assertEqual(self.get().status_code, 503)
+        train.assert_not_called()
+
+    def test_requests_do_not_retrain(self):
+        self.generator.retrain()
+        DerbyName.objects.create(name="Jammer Time")
+        with mock.patch("derbynames.names.markov.train") as train:
+            self.assertEqual(self.get().status_code, 200)
+        train.assert_not_called()
+
+    def test_retrain_replaces_the_artifact(self):
+        self.generator.retrain()
+        DerbyName.objects.create(name="Jammer Time")
+        model = self.generator.retrain()
+        self.assertEqual(model.meta["names"], 5)
+        _, files = storages["models"].listdir("models")
+        self.assertEqual(files, ["test.bin"])
+        # Another container loads the newer artifact
+        other = NameGenerator(3, "models", "models/test.bin", check_interval=0)
+        self.assertEqual(other.model().meta["names"], 5)
+
+
+def call_wsgi(application, path, query="", **headers):
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "HTTP_HOST": "testserver",
+        "HTTP_ACCEPT": "application/json",
+        **headers,
+    }
+    setup_testing_defaults(environ)
+    started = []
+    body = b"".join(
+        application(environ, lambda status, headers: started.append(status))
+    )
+    return started[0], body
+
+
+async def call_asgi(application, path, query="", headers=()):
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [
+            (b"host", b"testserver"),
+            (b"accept", b"application/json"),
+            *headers,
+        ],
+        "client": ("127.0.0.1", 1234),
+        "server": ("testserver", 80),
+    }
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+    status, body = None, []
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # The client stays connected until the response is sent
+        await asyncio.Future()
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        else:
+            body.append(message.get("body", b""))
+
+    await application(scope, receive, send)
+    return status, b"".join(body)
+
+
+class CoalescingTests(SimpleTestCase):
+    """Concurrent identical requests run the view once and share the response."""
+
+    requests = 8
+
+    def setUp(self):
+        self.calls = 0
+        self.calls_lock = Lock()
+        self.barrier = Barrier(self.requests)
+
+    def slow_random_name(self):
+        with self.calls_lock:
+            self.calls += 1
+            number = self.calls
+        # Long enough for every other request to arrive meanwhile
+        time.sleep(0.3)
+        return DerbyName(id=number, name=f"Jammer {number}")
+
+    def run_concurrently(self, request):
+        def call(number):
+            self.barrier.wait()
+            return request(number)
+
+        before = coalescing.metrics.as_dict()["counts"]
+        with ThreadPoolExecutor(self.requests) as pool:
+            responses = list(pool.map(call, range(self.requests)))
+        after = coalescing.metrics.as_dict()["counts"]
+        roles = {role: after[role] - before.get(role, 0) for role in after}
+        return responses, roles
+
+    def assertCoalesced(self, responses, roles):
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(set(responses), {responses[0]})
+        status, body = responses[0]
+        self.assertIn(status, (200, "200 OK"))
+        self.assertEqual(json.loads(body)["name"], "Jammer 1")
+        self.assertEqual(roles.get("leader"), 1)
+        self.assertEqual(roles.get("joined", 0) + roles.get("reused", 0), 7)
+
+    def test_wsgi(self):
+        from derbynames.wsgi import application
+
+        with mock.patch("derbynames.urls.random_name", self.slow_random_name):
+            responses, roles = self.run_concurrently(
+                lambda number: call_wsgi(application, "/api/random-name/", "wsgi")
+            )
+        self.assertCoalesced(responses, roles)
+
+    def test_asgi(self):
+        from derbynames.asgi import application
+
+        with mock.patch("derbynames.asgi_urls.random_name", self.slow_random_name):
+            responses, roles = self.run_concurrently(
+                lambda number: asyncio.run(
+                    call_asgi(application, "/api/random-name/", "asgi")
+                )
+            )
+        self.assertCoalesced(responses, roles)
+
+    def test_credentials_are_not_shared(self):
+        from derbynames.wsgi import application
+
+        with mock.patch("derbynames.urls.random_name", self.slow_random_name):
+            _, roles = self.run_concurrently(
+                lambda number: call_wsgi(
+                    application,
+                    "/api/random-name/",
+                    "credentials",
+                    HTTP_AUTHORIZATION=f"Token {number}",
+                )
+            )
+        self.assertEqual(roles.get("leader"), self.requests)
+
+    @override_settings(ALLOWED_HOSTS=["*"])
+    def test_hosts_are_not_shared(self):
+        from derbynames.wsgi import application
+
+        with mock.patch("derbynames.urls.random_name", self.slow_random_name):
+            _, roles = self.run_concurrently(
+                lambda number: call_wsgi(
+                    application,
+                    "/api/random-name/",
+                    "hosts",
+                    HTTP_HOST=f"site{number}.example.com",
+                )
+            )
+        self.assertEqual(roles.get("leader"), self.requests)
+
+    def test_key_includes_scheme(self):
+        factory = RequestFactory()
+        self.assertNotEqual(
+            coalescing.request_key(factory.get("/api/names/")),
+            coalescing.request_key(factory.get("/api/names/", secure=True)),
+        )
+
+
+@override_settings(STORAGES=STORAGES)
+class StaticSiteTests(TestCase):
+    """Exported pages link to each other under the export's base URL."""
+
+    def test_links_use_base_url(self):
+        name = DerbyName.objects.create(name="Jam Session")
+        with tempfile.TemporaryDirectory() as directory:
+            counts = export_site(
+                site_storage(directory), "https://example.com/site/", workers=1
+            )
+            page = Path(directory) / "names" / str(name.pk) / "index.html"
+            self.assertTrue(page.exists())
+            index = (Path(directory) / "index.html").read_text()
+            sitemap = (Path(directory) / "sitemap-1.xml").read_text()
+        self.assertEqual(counts["rendered"], 1)
+        self.assertIn(f'href="https://example.com/site/names/{name.pk}/"', index)
+        self.assertIn(f"<loc>https://example.com/site/names/{name.pk}/</loc>", sitemap)
+        # Pages served by the app keep their own links
+        response = self.client.get("/")
+        self.assertContains(response, f'href="/names/{name.pk}/"')
+
+
+class SelectionPoolTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_rename_invalidates_name_lists(self):
+        name = DerbyName.objects.create(name="Jam Session")
+        self.assertIn("Jam Session", name_lists.pick())
+        name.name = "Block Party"
+        name.save()
+        self.assertIn("Block Party", name_lists.pick())
+        name.delete()
+        self.assertNotIn("Block Party", name_lists.pick())
+
+    @override_settings(STORAGES=STORAGES)
+    def test_jersey_changes_invalidate_jersey_cards(self):
+        name = DerbyName.objects.create(name="Jam Session")
+        jersey = DerbyJersey.objects.create(
+            name=name,
+            image="jerseys/jam-session.png",
+            image_status=DerbyJersey.ImageStatus.READY,
+        )
+        self.assertIn("Jam Session", jersey_cards.pick())
+        name.name = "Block Party"
+        name.save()
+        self.assertIn("Block Party", jersey_cards.pick())
+        jersey.image = ""
+        jersey.image_status = DerbyJersey.ImageStatus.PENDING
+        jersey.save()
+        self.assertEqual(jersey_cards.pick(), "")
+        jersey.image = "jerseys/jam-session.png"
+        jersey.image_status = DerbyJersey.ImageStatus.READY
+        jersey.save()
+        self.assertIn("Block Party", jersey_cards.pick())
+        # Cascades to the jersey
+        name.delete()
+        self.assertEqual(jersey_cards.pick(), "")
+
+
+class JerseyIdsTests(TestCase):
+    """Random jersey picks notice writes made by other processes."""
+
+    def test_other_process_writes(self):
+        name = DerbyName.objects.create(name="Jam Session")
+        jerseys_with_images.invalidate()
+        self.assertEqual(jerseys_with_images.pick(5), [])
+        # bulk_create sends no signals, as if another container had written
+        jersey = DerbyJersey.objects.bulk_create(
+            [DerbyJersey(name=name, image_status=DerbyJersey.ImageStatus.READY)]
+        )[0]
+        TableVersion.bump(DerbyJersey._meta.db_table)
+        with mock.patch.object(jerseys_with_images, "check_interval", 0):
+            self.assertEqual(jerseys_with_images.pick(5), [jersey])
+
+
+@override_settings(STORAGES=STORAGES)
+class IngestTests(TestCase):
+    """Bulk imports skip blanks, overlong names and duplicates ignoring case."""
+
+    lines = (
+        "  ",
+        "",
+        "x" * (MAX_NAME_LENGTH + 1),
+        "jam session",
+        "JAM SESSION",
+        "Block Party",
+        "block party",
+        "New Name",
+    )
+
+    def setUp(self):
+        DerbyName.objects.create(name="Jam Session")
+
+    def assertIngested(self, stats):
+        expected = {"read": 8, "blank": 2, "too_long": 1, "duplicates": 3}
+        self.assertEqual({k: stats[k] for k in expected}, expected)
+        self.assertEqual(stats["inserted"], 2)
+        self.assertEqual(
+            sorted(DerbyName.objects.values_list("name", flat=True)),
+            ["Block Party", "Jam Session", "New Name"],
+        )
+
+    def test_ingest_names(self):
+        # Small batches: duplicates of earlier batches are found in the table
+        self.assertIngested(ingest_names(self.lines, batch_size=3))
+
+    def test_conflicts_are_not_counted_as_inserted(self):
+        table = DerbyName._meta.db_table
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        self.assertEqual(insert_names(table, ["Jam Session", "Other"], now), 1)
+
+    def test_bulk_endpoint(self):
+        user = get_user_model().objects.create_superuser("admin", "", "password")
+        self.client.force_login(user)
+        with mock.patch.object(name_generator, "retrain") as retrain:
+            response = self.client.post(
+                "/api/names/bulk/",
+                "\n".join(self.lines),
+                content_type="text/plain",
+                HTTP_ACCEPT="application/json",
+            )
+        self.assertEqual(response.status_code, 201)
+        self.assertIngested(response.json())
+        # Left to the scheduled retrain, off the request path
+        retrain.assert_not_called()
+
+    def test_import_names_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "names.txt"
+            path.write_text("\n".join(self.lines) + "\n")
+            out = StringIO()
+            call_command("import_names", str(path), batch_size=3, stdout=out)
+        self.assertIn(
+            "read 8, inserted 2, duplicates 3, blank 2, too long 1", out.getvalue()
+        )
+        self.assertIn("Retrained the name model on 3 names.", out.getvalue())
+
+
+@override_settings(STORAGES=STORAGES)
+class TransferTests(TestCase):
+    """Admin exports read back in through the batch import."""
+
+    def setUp(self):
+        user = get_user_model().objects.create_superuser("admin", "", "password")
+        self.client.force_login(user)
+        self.names = [
+            DerbyName.objects.create(name=name)
+            for name in ("Jam Session", "Block Party")
+        ]
+
+    def export(self, model, file_format="csv"):
+        return self.client.get(f"/admin/names/{model}/export-stream/{file_format}/")
+
+    def import_csv(self, model, content):
+        upload = SimpleUploadedFile(f"{model}.csv", content)
+        response = self.client.post(
+            f"/admin/names/{model}/import-batches/", {"file": upload}
+        )
+        self.assertEqual(response.status_code, 302)
+
+    def test_name_csv_round_trip(self):
+        content = b"".join(self.export("derbyname").streaming_content)
+        DerbyName.objects.all().delete()
+        self.import_csv("derbyname", content)
+        self.assertEqual(
+            sorted(DerbyName.objects.values_list("name", flat=True)),
+            ["Block Party", "Jam Session"],
+        )
+
+    def test_jersey_csv_round_trip(self):
+        jersey = DerbyJersey.objects.create(name=self.names[0])
+        jersey.set_metadata("prompt", "A jersey")
+        jersey.save()
+        content = b"".join(self.export("derbyjersey").streaming_content)
+        DerbyJersey.objects.all().delete()
+        self.import_csv("derbyjersey", content)
+        imported = DerbyJersey.objects.get()
+        self.assertEqual((imported.pk, imported.name_id), (jersey.pk, jersey.name_id))
+        self.assertEqual(imported.get_metadata("prompt"), "A jersey")
+
+    @unittest.skipUnless("xlsx" in EXPORT_FORMATS, "openpyxl is not installed")
+    def test_xlsx_row_limit(self):
+        with override_settings(NAME_EXPORT_XLSX_MAX_ROWS=2):
+            response = self.export("derbyname", "xlsx")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"PK"))
+        with override_settings(NAME_EXPORT_XLSX_MAX_ROWS=1):
+            response = self.export("derbyname", "xlsx")
+        self.assertRedirects(response, "/admin/names/derbyname/")
+
+    @override_settings(ADMIN_EXACT_COUNT_LIMIT=1)
+    def test_estimated_count(self):
+        last = DerbyName.objects.create(name="Free Name")
+        self.names[1].delete()
+        # The largest id, counting the deleted row
+        names = DerbyName.objects.all()
+        self.assertEqual(EstimatedCountPaginator(names, 10).count, last.pk)
+        self.assertEqual(last.pk, self.names[0].pk + 2)
+        filtered = names.filter(name__startswith="J")
+        self.assertEqual(EstimatedCountPaginator(filtered, 10).count, 1)
+        with override_settings(ADMIN_EXACT_COUNT_LIMIT=100):
+            self.assertEqual(EstimatedCountPaginator(names, 10).count, 2)
+
+
+@override_settings(COALESCE_PATHS=[])
+class StartsWithPaginationTests(TestCase):
+    """Cursor pages over the in-memory corpus follow the database ordering."""
+
+    def setUp(self):
+        names = ["Bab", "BB", "B-Side", "Ba Ba", "Bo", "bo peep", "Brawl", "Banshee"]
+        names += [f"Blocker {i:02d}" for i in range(15)]
+        DerbyName.objects.bulk_create(
+            DerbyName(name=name) for name in [*names, "Jam Session"]
+        )
+        corpus.invalidate()
+        self.expected = list(
+            DerbyName.objects.filter(name__istartswith="b")
+            .order_by("name")
+            .values_list("name", flat=True)
+        )
+
+    def walk(self, url, link):
+        """Names on each page from `url`, following `link`; and the last page."""
+        pages = []
+        while url:
+            data = self.client.get(url, HTTP_ACCEPT="application/json").json()
+            pages.append([name["name"] for name in data["results"]])
+            last, url = data, data[link]
+        return pages, last
+
+    def test_walk_forward_and_back(self):
+        forward, last = self.walk("/api/starts-with/b/?page_size=4", "next")
+        self.assertEqual(len(forward), 6)
+        self.assertEqual([name for page in forward for name in page], self.expected)
+        backward, _ = self.walk(last["previous"], "previous")
+        self.assertEqual(backward, forward[-2::-1])
+
+
+class NearDuplicateTests(TestCase):
+    """Clustering by blocked trigrams finds every pair brute force does."""
+
+    bases = (
+        "Jam Session",
+        "Block Party",
+        "Skate Expectations",
+        "Hell on Wheels",
+        "Ruth Less",
+        "Bo",
+        "Quad Almighty",
+        "Whip It Good",
+    )
+
+    def setUp(self):
+        rng = random.Random(19)
+        names = set()
+        for base in self.bases:
+            names.add(base)
+            for _ in range(6):
+                chars = list(base)
+                for _ in range(rng.randint(1, 3)):
+                    i = rng.randrange(len(chars))
+                    edit = rng.choice(("insert", "delete", "replace", "punctuate"))
+                    if edit == "insert":
+                        chars.insert(i, rng.choice("aeiouxz"))
+                    elif edit == "delete" and len(chars) > 2:
+                        del chars[i]
+                    elif edit == "replace":
+                        chars[i] = rng.choice("aeiouxz")
+                    else:
+                        chars.insert(i, rng.choice("-_. !"))
+                names.add("".join(chars))
+        DerbyName.objects.bulk_create(DerbyName(name=name) for name in sorted(names))
+
+    def brute_force(self, threshold):
+        rows = list(DerbyName.objects.values_list("id", "name"))
+        parent = {pk: pk for pk, _ in rows}
+
+        def root(pk):
+            while parent[pk] != pk:
+                pk = parent[pk]
+            return pk
+
+        for (a, name_a), (b, name_b) in combinations(rows, 2):
+            if similarity(normalize(name_a), normalize(name_b), threshold):
+                parent[root(a)] = root(b)
+        clusters = defaultdict(set)
+        for pk, _ in rows:
+            clusters[root(pk)].add(pk)
+        return {frozenset(ids) for ids in clusters.values() if len(ids) > 1}
+
+    def test_matches_brute_force(self):
+        for threshold in (0.6, 0.7, 0.8, 0.9):
+            with self.subTest(threshold=threshold):
+                found = {
+                    frozenset(pk for pk, _ in cluster)
+                    for cluster in near_duplicate_clusters(threshold)
+                }
+                expected = self.brute_force(threshold)
+                self.assertTrue(expected)
+                self.assertEqual(found, expected)
+
+
+class NameAvailabilityTests(TestCase):
+    """The name filter answers for absent names and notices other writers."""
+
+    def setUp(self):
+        DerbyName.objects.create(name="Jam Session")
+        name_filter.build()
+
+    def test_check(self):
+        self.assertEqual(
+            name_filter.untaken(["Jam Session", "Free Name"]), ["Free Name"]
+        )
+        results = name_filter.check(["jam session", "Jam Session"])
+        self.assertEqual(results["looked_up"], 1)
+        self.assertEqual(
+            results["results"],
+            [
+                {
+                    "name": "jam session",
+                    "taken": False,
+                    "taken_ignoring_case": True,
+                    "matches": ["Jam Session"],
+                },
+                {
+                    "name": "Jam Session",
+                    "taken": True,
+                    "taken_ignoring_case": True,
+                    "matches": ["Jam Session"],
+                },
+            ],
+        )
+
+    def test_endpoint(self):
+        response = self.client.post(
+            "/api/availability/",
+            {"names": ["JAM SESSION", "Free Name"]},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        taken = {
+            r["name"]: r["taken_ignoring_case"] for r in response.json()["results"]
+        }
+        self.assertEqual(taken, {"JAM SESSION": True, "Free Name": False})
+
+    def test_other_process_inserts(self):
+        # An ingest that committed long after it stamped updated_at
+        table = DerbyName._meta.db_table
+        started = timezone.now() - timedelta(hours=1)
+        now = connection.ops.adapt_datetimefield_value(started)
+        insert_names(table, ["Late Name"], now)
+        TableVersion.bump(table)
+        with mock.patch.object(name_filter, "check_interval", 0):
+            self.assertEqual(name_filter.untaken(["Late Name"]), [])
+
+    def test_other_process_renames(self):
+        # update() sends no signals, as if another container had written
+        DerbyName.objects.filter(name="Jam Session").update(
+            name="Block Party", updated_at=timezone.now()
+        )
+        TableVersion.bump(DerbyName._meta.db_table)
+        with mock.patch.object(name_filter, "check_interval", 0):
+            self.assertEqual(name_filter.untaken(["Block Party"]), [])
+
+
+class FlakyProvider(StubProvider):
+    """A StubProvider whose first `failures` calls raise ProviderError."""
+
+    def __init__(self, failures, retryable=True):
+        super().__init__(size=64)
+        self.failures = failures
+        self.retryable = retryable
+        self.calls = 0
+
+    def generate(self, prompt):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ProviderError("busy", retryable=self.retryable)
+        return super().generate(prompt)
+
+
+@override_settings(
+    STORAGES=STORAGES,
+    JERSEY_GENERATION_MAX_ATTEMPTS=3,
+    JERSEY_GENERATION_BACKOFF_SECONDS=10.0,
+)
+class JerseyJobTests(TestCase):
+    """Image generation runs each job once, with backoff, until it gives up."""
+
+    def setUp(self):
+        # Creating a jersey enqueues its job; the drain waits for a commit
+        self.jersey = DerbyJersey.objects.create(
+            name=DerbyName.objects.create(name="Jam Session")
+        )
+        self.job = JerseyJob.objects.get(jersey=self.jersey)
+
+    def make_due(self):
+        JerseyJob.objects.update(next_attempt_at=timezone.now())
+
+    def test_enqueue_is_idempotent(self):
+        self.assertEqual(enqueue_jersey_image(self.jersey, drain=False), self.job)
+        with override_settings(JERSEY_IMAGE_PROMPT="A jersey for {name}"):
+            other = enqueue_jersey_image(self.jersey, drain=False)
+        self.assertNotEqual(other.key, self.job.key)
+        self.assertEqual(JerseyJob.objects.count(), 2)
+
+    def test_claim_jobs(self):
+        now = timezone.now()
+        name = self.jersey.name
+        later, stale, running = (
+            JerseyJob.objects.create(
+                key=key, jersey=self.jersey, prompt=key, **fields
+            ).pk
+            for key, fields in (
+                ("later", {"next_attempt_at": now + timedelta(hours=1)}),
+                ("stale", {"state": JerseyJob.State.RUNNING}),
+                ("running", {"state": JerseyJob.State.RUNNING}),
+            )
+        )
+        # A running job not heard from within the timeout is claimed again
+        JerseyJob.objects.filter(pk=stale).update(updated_at=now - timedelta(days=1))
+        self.assertEqual(len(claim_jobs(1)), 1)
+        claimed = claim_jobs(10)
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(claimed[0].jersey.name, name)
+        self.assertEqual(claim_jobs(10), [])
+        self.assertEqual(
+            set(
+                JerseyJob.objects.filter(state=JerseyJob.State.RUNNING).values_list(
+                    "pk", flat=True
+                )
+            ),
+            {self.job.pk, stale, running},
+        )
+        self.assertEqual(JerseyJob.objects.get(pk=later).state, JerseyJob.State.PENDING)
+
+    def test_stale_job_is_reclaimed_once(self):
+        JerseyJob.objects.filter(pk=self.job.pk).update(
+            state=JerseyJob.State.RUNNING,
+            updated_at=timezone.now() - timedelta(days=1),
+        )
+        other = {}
+        real_filter = JerseyJob.objects.filter
+
+        def filter(*args, **kwargs):
+            # Another drain claims the job between this one's read and update
+            if "updated_at" in kwargs and "claimed" not in other:
+                other["claimed"] = None
+                other["claimed"] = claim_jobs(10)
+            return real_filter(*args, **kwargs)
+
+        with mock.patch.object(JerseyJob.objects, "filter", side_effect=filter):
+            self.assertEqual(claim_jobs(10), [])
+        self.assertEqual(other["claimed"], [self.job])
+
+    def test_enqueue_requeues_failed_job(self):
+        JerseyJob.objects.filter(pk=self.job.pk).update(
+            state=JerseyJob.State.FAILED, attempts=3
+        )
+        DerbyJersey.objects.filter(pk=self.jersey.pk).update(
+            image_status=DerbyJersey.ImageStatus.FAILED
+        )
+        job = enqueue_jersey_image(self.jersey, drain=False)
+        self.assertEqual(job, self.job)
+        self.assertEqual((job.state, job.attempts), (JerseyJob.State.PENDING, 0))
+        self.jersey.refresh_from_db()
+        self.assertEqual(self.jersey.image_status, DerbyJersey.ImageStatus.PENDING)
+        self.assertEqual(drain(StubProvider(size=64))["succeeded"], 1)
+
+    def test_success(self):
+        counts = drain(StubProvider(size=64), concurrency=2)
+        self.assertEqual(counts, {"succeeded": 1, "retrying": 0, "failed": 0})
+        self.job.refresh_from_db()
+        self.jersey.refresh_from_db()
+        self.assertEqual(self.job.state, JerseyJob.State.SUCCEEDED)
+        self.assertEqual(self.jersey.image_status, DerbyJersey.ImageStatus.READY)
+        self.assertEqual(self.jersey.image_attempts, 1)
+        self.assertEqual(self.jersey.get_metadata("prompt"), self.job.prompt)
+
+    def test_retries_with_backoff(self):
+        provider = FlakyProvider(failures=1)
+        before = timezone.now()
+        self.assertEqual(drain(provider)["retrying"], 1)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.state, JerseyJob.State.PENDING)
+        self.assertEqual(self.job.last_error, "busy")
+        # 10s, jittered by half either way
+        delay = self.job.next_attempt_at - before
+        self.assertGreaterEqual(delay, timedelta(seconds=5))
+        self.assertLessEqual(delay, timedelta(seconds=15) + (timezone.now() - before))
+        # Not due yet: nothing runs
+        self.assertEqual(drain(provider)["retrying"], 0)
+        self.assertEqual(provider.calls, 1)
+        self.make_due()
+        self.assertEqual(drain(provider)["succeeded"], 1)
+        self.jersey.refresh_from_db()
+        self.assertEqual(self.jersey.image_attempts, 2)
+
+    def test_fails_after_max_attempts(self):
+        provider = FlakyProvider(failures=10)
+        outcomes = []
+        for _ in range(3):
+            self.make_due()
+            counts = drain(provider)
+            outcomes.append("failed" if counts["failed"] else "retrying")
+        self.assertEqual(outcomes, ["retrying", "retrying", "failed"])
+        self.make_due()
+        self.assertEqual(drain(provider)["failed"], 0)
+        self.assertEqual(provider.calls, 3)
+        self.job.refresh_from_db()
+        self.jersey.refresh_from_db()
+        self.assertEqual(self.job.state, JerseyJob.State.FAILED)
+        self.assertEqual(self.job.attempts, 3)
+        self.assertEqual(self.jersey.image_status, DerbyJersey.ImageStatus.FAILED)
+        self.assertEqual(self.jersey.image_attempts, 3)
+
+    def test_non_retryable_error_fails_at_once(self):
+        counts = drain(FlakyProvider(failures=1, retryable=False))
+        self.assertEqual(counts, {"succeeded": 0, "retrying": 0, "failed": 1})
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.state, JerseyJob.State.FAILED)
+        self.assertEqual(self.job.attempts, 1)
+
+
+class AsyncViewTests(TestCase):
+    """Under ASGI the JSON reads come from async views, with the same JSON."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.name = DerbyName.objects.create(name="Jam Session")
+
+    async def test_same_json(self):
+        urls = [
+            f"/api/names/{self.name.pk}/",
+            "/api/names/0/",
+            "/api/random-name/",
+            "/api/contains/am/",
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                with mock.patch(
+                    "derbynames.asgi_urls.name_json", wraps=asgi_urls.name_json
+                ) as name_json:
+                    response = await self.async_client.get(
+                        url, HTTP_ACCEPT="application/json"
+                    )
+                # Served by the async view, unless it was a 404
+                self.assertEqual(name_json.called, response.status_code == 200)
+                expected = await sync_to_async(self.client.get)(
+                    url, HTTP_ACCEPT="application/json"
+                )
+                self.assertEqual(response.status_code, expected.status_code)
+                self.assertEqual(response.json(), expected.json())
+
+
+class StartupImportTests(SimpleTestCase):
+    """Heavy packages stay off the cold start until a request needs them."""
+
+    deferred = (
+        "boto3",
+        "drf_spectacular.views",
+        "huggingface_hub",
+        "storages.backends.s3",
+        "zappa.asynchronous",
+    )
+
+    def test_deferred_imports(self):
+        script = (
+            "import json, sys, django; django.setup(); "
+            "import derbynames.urls, derbynames.names.generation; "
+            f"print(json.dumps([m for m in {self.deferred!r} if m in sys.modules]))"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", script],
+            env={**os.environ, "DJANGO_SETTINGS_MODULE": "derbynames.settings"},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        self.assertEqual(json.loads(result.stdout.splitlines()[-1]), [])
+
+
+class S3InstrumentationTests(SimpleTestCase):
+    """S3 calls are timed on the app's own clients, not every boto3 client."""
+
+    def s3_client(self, *args, **kwargs):
+        import boto3
+
+        return boto3.session.Session().client(
+            "s3",
+            region_name="us-east-1",
+            aws_access_key_id="test",
+            aws_secret_access_key="test",
+        )
+
+    def timed_calls(self, client):
+        """Make one S3 call, answered locally, and count the timed calls."""
+        from botocore.awsrequest import AWSResponse
+
+        class Body:
+            def stream(self, **kwargs):
+                return iter([b""])
+
+        def respond(request, **kwargs):
+            return AWSResponse(request.url, 200, {"ETag": '"1"'}, Body())
+
+        client.meta.events.register("before-send.s3", respond)
+        request_metrics = RequestMetrics()
+        token = current.set(request_metrics)
+        try:
+            client.head_object(Bucket="bucket", Key="key")
+        finally:
+            current.reset(token)
+        return request_metrics.s3_calls
+
+    def test_clients(self):
+        from botocore import handlers
+
+        timed = self.s3_client()
+        instrument_s3_client(timed)
+        instrument_s3_client(timed)
+        self.assertEqual(self.timed_calls(timed), 1)
+        self.assertEqual(self.timed_calls(self.s3_client()), 0)
+        self.assertNotIn(
+            finish_s3_call, [entry[1] for entry in handlers.BUILTIN_HANDLERS]
+        )
+
+    def test_app_clients(self):
+        with mock.patch("boto3.client", self.s3_client):
+            self.assertEqual(self.timed_calls(S3Store("bucket").client), 1)
+        storage = S3Storage(
+            bucket_name="bucket",
+            region_name="us-east-1",
+            access_key="test",
+            secret_key="test",
+        )
+        self.assertEqual(self.timed_calls(storage.connection.meta.client), 1)
@@ -0,0 +1,116 @@
+import csv
+import importlib.util
+import tempfile
+import time
+from collections import Counter
+from itertools import batched, islice
+from logging import getLogger
+
+from django.http import StreamingHttpResponse
+from tablib import Dataset
+
+from derbynames.s3sqlite.base import group_commit
+
+from .views import Echo
+
+logger = getLogger(__name__)
+
+# XLSX needs openpyxl, which tablib only installs with its xlsx extra
+EXPORT_FORMATS = ["csv"] + (["xlsx"] if importlib.util.find_spec("openpyxl") else [])
+
+# Bytes of an XLSX export kept in memory before spilling to a temporary file,
+# and sent per chunk
+XLSX_SPOOL_BYTES = 8 * 1024 * 1024
+XLSX_CHUNK_BYTES = 64 * 1024
+
+XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def export_rows(resource, queryset, chunk_size):
+    """The resource's header row, then one row per object, read in chunks."""
+    yield resource.get_export_headers()
+    for obj in queryset.iterator(chunk_size=chunk_size):
+        yield resource.export_resource(obj)
+
+
+def xlsx_chunks(rows):
+    """
+    An XLSX file of `rows`, in chunks. A zip cannot be sent before it is
+    complete, so the whole workbook is written first (rows to temporary
+    files, the file to memory up to XLSX_SPOOL_BYTES, then to disk) and
+    nothing is sent until then; hence NAME_EXPORT_XLSX_MAX_ROWS.
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    for row in rows:
+        sheet.append(row)
+    with tempfile.SpooledTemporaryFile(max_size=XLSX_SPOOL_BYTES) as output:
+        workbook.save(output)
+        output.seek(0)
+        while chunk := output.read(XLSX_CHUNK_BYTES):
+            yield chunk
+
+
+def export_response(resource, queryset, file_format, filename, chunk_size):
+    """
+    A response streaming `queryset` as CSV, row by row, or as XLSX once the
+    workbook is built (see xlsx_chunks).
+    """
+    rows = export_rows(resource, queryset, chunk_size)
+    if file_format == "xlsx":
+        response = StreamingHttpResponse(
+            xlsx_chunks(rows), content_type=XLSX_CONTENT_TYPE
+        )
+    else:
+        writer = csv.writer(Echo())
+        # A few hundred rows per write, rather than one
+        chunks = ("".join(map(writer.writerow, chunk)) for chunk in batched(rows, 500))
+        response = StreamingHttpResponse(chunks, content_type="text/csv")
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+def import_rows(resource, rows, batch_size, progress=None):
+    """
+    Import CSV rows (a header, then data) through an import-export resource,
+    `batch_size` rows at a time, so only one batch is held in memory. Each
+    batch is its own transaction: a batch with errors is rolled back and the
+    rest carry on. The database is uploaded once, at the end. Returns the
+    resource's totals for the batches that went in, with counts of rows read,
+    batches, and failed batches and their rows.
+    """
+    rows = iter(rows)
+    headers = next(rows, None)
+    totals = Counter()
+    if not headers:
+        return totals
+    start = time.perf_counter()
+    with group_commit():
+        while batch := list(islice(rows, batch_size)):
+            # Pad or trim ragged rows to the header
+            width = len(headers)
+            batch = [(row + [""] * width)[:width] for row in batch]
+            result = resource.import_data(
+                Dataset(*batch, headers=headers),
+                dry_run=False,
+                use_transactions=True,
+                raise_errors=False,
+            )
+            totals["read"] += len(batch)
+            totals["batches"] += 1
+            if result.has_errors() or result.has_validation_errors():
+                totals["failed_batches"] += 1
+                totals["rolled_back"] += len(batch)
+                logger.warning(
+                    f"Import batch {totals['batches']} failed: "
+                    f"{result.invalid_rows[:1] or result.row_errors()[:1]}"
+                )
+            else:
+                totals.update(result.totals)
+            if progress:
+                progress(totals)
+    totals["seconds"] = time.perf_counter() - start
+    logger.info(f"Imported rows: {dict(totals)}")
+    return totals
@@ -1,33 +1,123 @@
+import csv
+import json
+from itertools import chain
 from logging import getLogger
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from django.shortcuts import render
-from django.db.models import Q
+from django.db.models import Max
 
+from .caching import cache_page_policy, row_validators, table_validators
 from .models import DerbyName, DerbyJersey
+from .pool import jersey_cards, name_lists
 
 logger = getLogger(__name__)
 
 
+@cache_page_policy("random")
 def index(request):
-    names = DerbyName.objects.order_by("?").all()[:10]  # Get 10 random DerbyNames
-    logger.info(f"Rendering index with {len(names)} names.")
-    logger.debug(f"Names: {[name.name for name in names]}")
-    return render(request, "names/index.html", {"names": names})
+    # A pre-rendered list of 10 random names from the selection pool
+    logger.info("Rendering index from the name selection pool.")
+    return render(request, "names/index.html", {"name_list": name_lists.pick()})
 
 
+def detail_validators(request, name_id, variant=""):
+    # The name's and its jerseys' updated_at, in one query
+    row = (
+        DerbyName.objects.filter(id=name_id)
+        .annotate(jersey_updated_at=Max("derbyjersey__updated_at"))
+        .values_list("updated_at", "jersey_updated_at")
+        .first()
+    )
+    return row_validators(*row, variant=variant) if row else None
+
+
+@cache_page_policy("detail", detail_validators)
 def detail(request, name_id):
     name = DerbyName.objects.get(id=name_id)
-    jersey = DerbyJersey.objects.filter(name=name).first()
+    # The first jersey, as in the static export; ordering by the default
+    # (the name) would join DerbyName again
+    jersey = DerbyJersey.objects.filter(name=name).order_by("id").first()
     logger.info(f"Rendering detail for name: {name.name}")
     return render(request, "names/detail.html", {"name": name, "jersey": jersey})
 
 
+@cache_page_policy("random")
 def jersey_grid(request):
-    # Select jerseys with images
-    jerseys = (
-        DerbyJersey.objects.filter(Q(image__isnull=False) & ~Q(image__exact=""))
-        .order_by("?")
-        .all()[:9]
-    )  # Get 9 random DerbyJerseys
-    logger.info(f"Rendering jersey grid with {len(jerseys)} jerseys.")
-    logger.debug(f"Jerseys: {[jersey.name for jersey in jerseys]}")
-    return render(request, "names/jersey_grid.html", {"jerseys": jerseys})
+    # A pre-rendered grid of 9 random jerseys with images from the selection pool
+    logger.info("Rendering jersey grid from the jersey selection pool.")
+    return render(
+        request, "names/jersey_grid.html", {"jersey_cards": jersey_cards.pick()}
+    )
+
+
+# Async versions of the pages above for the ASGI server (derbynames.asgi_urls),
+# using the async ORM and cache API
+
+
+@cache_page_policy("random")
+async def index_async(request):
+    return render(request, "names/index.html", {"name_list": await name_lists.apick()})
+
+
+async def detail_validators_async(request, name_id):
+    row = await (
+        DerbyName.objects.filter(id=name_id)
+        .annotate(jersey_updated_at=Max("derbyjersey__updated_at"))
+        .values_list("updated_at", "jersey_updated_at")
+        .afirst()
+    )
+    return row_validators(*row) if row else None
+
+
+@cache_page_policy("detail", detail_validators_async)
+async def detail_async(request, name_id):
+    name = await DerbyName.objects.aget(id=name_id)
+    jersey = await DerbyJersey.objects.filter(name=name).order_by("id").afirst()
+    logger.info(f"Rendering detail for name: {name.name}")
+    return render(request, "names/detail.html", {"name": name, "jersey": jersey})
+
+
+@cache_page_policy("random")
+async def jersey_grid_async(request):
+    return render(
+        request,
+        "names/jersey_grid.html",
+        {"jersey_cards": await jersey_cards.apick()},
+    )
+
+
+class Echo:
+    """A file-like object that hands written rows straight back to the caller."""
+
+    def write(self, value):
+        return value
+
+
+@cache_page_policy(
+    "listing",
+    lambda request: table_validators(
+        DerbyName, variant=f"{request.GET.get('format', 'ndjson')}-"
+    ),
+)
+def export_names(request):
+    # Stream every name as NDJSON (default) or CSV without loading the table
+    export_format = request.GET.get("format", "ndjson")
+    rows = (
+        DerbyName.objects.order_by("id")
+        .values_list("id", "name")
+        .iterator(chunk_size=settings.NAME_EXPORT_CHUNK_SIZE)
+    )
+    if export_format == "csv":
+        writer = csv.writer(Echo())
+        lines = chain(
+            [writer.writerow(["id", "name"])], (writer.writerow(row) for row in rows)
+        )
+        content_type, filename = "text/csv", "derbynames.csv"
+    else:
+        lines = (json.dumps({"id": id, "name": name}) + "\n" for id, name in rows)
+        content_type, filename = "application/x-ndjson", "derbynames.ndjson"
+    logger.info(f"Streaming {export_format} export of derby names.")
+    response = StreamingHttpResponse(lines, content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
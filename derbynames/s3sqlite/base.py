@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+from logging import getLogger
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+
+from .snapshot import Snapshot, metrics
+
+logger = getLogger(__name__)
+
+
+class DatabaseWrapper(SQLiteDatabaseWrapper):
+    """
+    SQLite database whose file lives in S3, replacing django_s3_sqlite.
+
+    Settings: NAME is the local path (under /tmp on Lambda), REMOTE_NAME the
+    object key in BUCKET. STORE_ROOT swaps S3 for a local directory.
+    REVALIDATE_SECONDS skips the ETag check for connections opened within
+    that many seconds of the last one. READ_ONLY never uploads.
+    FLUSH_SECONDS and FLUSH_CHANGES group writes from several connections
+    into one upload.
+
+    The file is only uploaded after committed writes.
+    """
+
+    def __init__(self, settings_dict, alias=DEFAULT_DB_ALIAS):
+        super().__init__(settings_dict, alias)
+        # One per settings, shared with this alias's connections in other
+        # threads
+        self.snapshot = Snapshot.from_settings(self.settings_dict)
+        self.snapshot_read_only = self.settings_dict.get("READ_ONLY", False)
+        self._changes_seen = 0
+        self._counter_seen = None
+
+    def get_new_connection(self, conn_params):
+        self.snapshot.open()
+        try:
+            with metrics.timer("open"):
+                conn = super().get_new_connection(conn_params)
+        except Exception:
+            self.snapshot.close()
+            raise
+        if self.snapshot_read_only:
+            conn.execute("PRAGMA query_only = ON")
+        self._counter_seen = self.snapshot.change_counter()
+        self._changes_seen = 0
+        return conn
+
+    def record_changes(self):
+        if self.connection is None:
+            return
+        total = self.connection.total_changes
+        changes, self._changes_seen = total - self._changes_seen, total
+        # Kept per connection: the snapshot, and the file, are shared
+        counter = self.snapshot.change_counter()
+        if counter != self._counter_seen:
+            self.snapshot.record_write(changes)
+        self._counter_seen = counter
+
+    def close(self):
+        was_open = self.connection is not None
+        self.record_changes()
+        super().close()
+        if was_open and self.connection is None:
+            self.snapshot.close()
+        if self.connection is None and self.snapshot.due():
+            self.snapshot.push()
+
+    def flush(self):
+        """Upload any unsaved writes now, whatever the flush window."""
+        if self.in_atomic_block:
+            raise RuntimeError("Cannot upload the database inside a transaction.")
+        self.record_changes()
+        self.snapshot.push()
+
+
+@contextmanager
+def read_only(using=DEFAULT_DB_ALIAS):
+    """Refuse writes on an S3-backed connection for the duration of the block."""
+    connection = connections[using]
+    if not isinstance(connection, DatabaseWrapper) or connection.snapshot_read_only:
+        yield
+        return
+    connection.snapshot_read_only = True
+    if connection.connection is not None:
+        connection.connection.execute("PRAGMA query_only = ON")
+    try:
+        yield
+    finally:
+        connection.snapshot_read_only = False
+        if connection.connection is not None:
+            connection.connection.execute("PRAGMA query_only = OFF")
+
+
+@contextmanager
+def group_commit(using=DEFAULT_DB_ALIAS):
+    """
+    Hold back uploads of an S3-backed database until the block ends, then
+    upload once. Use around bulk writes: imports, batch jobs.
+    """
+    connection = connections[using]
+    if not isinstance(connection, DatabaseWrapper):
+        yield
+        return
+    connection.snapshot.defer(1)
+    try:
+        yield
+    finally:
+        if not connection.snapshot.defer(-1):
+            connection.flush()
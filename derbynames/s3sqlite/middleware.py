@@ -0,0 +1,104 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+
+from .base import read_only
+from .router import Routing, current
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class ReadOnlySafeMethodsMiddleware:
+    """
+    Serve safe requests from the local database snapshot with writes refused,
+    so they can never trigger an upload.
+
+    Place it after SessionMiddleware: sessions are saved on the way out,
+    once the read-only block has ended.
+    """
+
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if request.method not in SAFE_METHODS:
+            return self.get_response(request)
+        with read_only():
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        if request.method not in SAFE_METHODS:
+            return await self.get_response(request)
+        # The async ORM queries on the request's sync thread, so the block is
+        # entered and left there
+        block = read_only()
+        await sync_to_async(block.__enter__)()
+        try:
+            return await self.get_response(request)
+        finally:
+            await sync_to_async(block.__exit__)(None, None, None)
+
+
+class ReadSnapshotMiddleware:
+    """
+    Route the reads of safe requests to settings.DB_READ_ALIAS, through
+    ReadSnapshotRouter. A request that writes sets a short-lived cookie,
+    and requests carrying it read from the primary, so whoever just wrote
+    sees their writes before the read snapshot catches up.
+
+    Place it before SessionMiddleware, so session saves count as writes.
+    """
+
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def routing(self, request):
+        read_alias = settings.DB_READ_ALIAS
+        if (
+            request.method not in SAFE_METHODS
+            or settings.DB_PRIMARY_COOKIE in request.COOKIES
+        ):
+            read_alias = None
+        return Routing(read_alias)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        routing = self.routing(request)
+        token = current.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.finish(routing, response)
+
+    async def __acall__(self, request):
+        routing = self.routing(request)
+        token = current.set(routing)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.finish(routing, response)
+
+    def finish(self, routing, response):
+        if routing.wrote and settings.DB_READ_ALIAS:
+            response.set_cookie(
+                settings.DB_PRIMARY_COOKIE,
+                "1",
+                max_age=settings.DB_PRIMARY_STICKY_SECONDS,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
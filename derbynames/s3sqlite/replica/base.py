@@ -0,0 +1,134 @@
+import os
+import sqlite3
+from logging import getLogger
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+
+from ..base import DatabaseWrapper as S3DatabaseWrapper
+from ..snapshot import metrics
+
+logger = getLogger(__name__)
+
+
+class ReadSnapshot:
+    """
+    A read-only copy of another alias's database file. It is copied with
+    SQLite's backup API, so it is consistent even while the source is being
+    written, and swapped in with a rename: connections already open keep
+    reading the copy they opened.
+    """
+
+    def __init__(self, path, refresh_seconds=0):
+        self.path = Path(path)
+        self.refresh_seconds = refresh_seconds
+        self._lock = Lock()
+        self._source = None
+        self._checked_at = None
+
+    def fingerprint(self, source):
+        """Changes with every commit to the source, or when it is replaced."""
+        stat = os.stat(source)
+        with open(source, "rb") as f:
+            f.seek(24)
+            counter = f.read(4)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns, counter
+
+    def copy(self, source, target):
+        uri = f"{Path(source).resolve().as_uri()}?mode=ro"
+        src, dst = sqlite3.connect(uri, uri=True), sqlite3.connect(target)
+        try:
+            src.backup(dst)
+        finally:
+            src.close()
+            dst.close()
+
+    def refresh(self, source):
+        """Copy `source` if it changed since the last copy."""
+        with self._lock:
+            now = monotonic()
+            if (
+                self._checked_at is not None
+                and now - self._checked_at < self.refresh_seconds
+                and self.path.exists()
+            ):
+                return
+            self._checked_at = now
+            fingerprint = self.fingerprint(source)
+            if fingerprint == self._source and self.path.exists():
+                metrics.incr("read_snapshot_reused")
+                return
+            partial = self.path.with_name(self.path.name + ".partial")
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                with metrics.timer("read_snapshot_copy"):
+                    self.copy(source, partial)
+                os.replace(partial, self.path)
+            finally:
+                partial.unlink(missing_ok=True)
+            self._source = fingerprint
+            metrics.incr("read_snapshot_copied")
+            logger.info(f"Copied {source} to the read snapshot at {self.path}.")
+
+
+# One copy per path, shared by the connections of every thread
+_snapshots = {}
+_snapshots_lock = Lock()
+
+
+def read_snapshot(path, refresh_seconds):
+    with _snapshots_lock:
+        if path not in _snapshots:
+            _snapshots[path] = ReadSnapshot(path, refresh_seconds)
+        return _snapshots[path]
+
+
+class DatabaseWrapper(SQLiteDatabaseWrapper):
+    """
+    A read-only alias serving a local copy of the PRIMARY alias's SQLite
+    file, opened with mode=ro&immutable=1 so SQLite skips file locking and
+    change detection, and memory-mapped (MMAP_SIZE bytes).
+
+    NAME is where the copy is kept. Each new connection first brings the
+    primary's file up to date (an S3-backed primary revalidates against the
+    bucket as usual) and copies it if it changed, at most every
+    REFRESH_SECONDS. Route reads here with ReadSnapshotRouter.
+    """
+
+    def __init__(self, settings_dict, alias):
+        super().__init__(settings_dict, alias)
+        # A test mirror of the primary has no PRIMARY and opens as usual
+        self.primary = self.settings_dict.get("PRIMARY")
+        self.mmap_size = self.settings_dict.get("MMAP_SIZE", 256 * 1024 * 1024)
+        self.read_snapshot = None
+        if self.primary:
+            self.read_snapshot = read_snapshot(
+                self.settings_dict["NAME"], self.settings_dict.get("REFRESH_SECONDS", 0)
+            )
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        if self.read_snapshot:
+            uri = self.read_snapshot.path.resolve().as_uri()
+            kwargs["database"] = f"{uri}?mode=ro&immutable=1"
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        if not self.read_snapshot:
+            return super().get_new_connection(conn_params)
+        primary = connections[self.primary]
+        if primary.is_in_memory_db():
+            raise ImproperlyConfigured(
+                f"{self.alias!r} cannot copy the in-memory database of "
+                f"{self.primary!r}."
+            )
+        if isinstance(primary, S3DatabaseWrapper):
+            primary.snapshot.fetch()
+        self.read_snapshot.refresh(primary.settings_dict["NAME"])
+        conn = super().get_new_connection(conn_params)
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        return conn
@@ -0,0 +1,64 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+class Routing:
+    """Where the current request's reads go; set by ReadSnapshotMiddleware."""
+
+    def __init__(self, read_alias=None):
+        self.read_alias = read_alias
+        self.wrote = False
+
+
+current = ContextVar("database_routing", default=None)
+
+
+@contextmanager
+def use_primary():
+    """Read from and write to the primary for the duration of the block."""
+    token = current.set(Routing())
+    try:
+        yield
+    finally:
+        current.reset(token)
+
+
+class ReadSnapshotRouter:
+    """
+    Send reads to settings.DB_READ_ALIAS while ReadSnapshotMiddleware serves
+    a safe request, and everything else to the primary. Once a request
+    writes, its remaining reads go to the primary too, so it sees its own
+    rows. Outside requests (commands, jobs) nothing changes.
+    """
+
+    def db_for_read(self, model, **hints):
+        routing = current.get()
+        if routing is None or routing.read_alias is None:
+            return DEFAULT_DB_ALIAS
+        # A session missing from a stale snapshot would be dropped, logging
+        # its user out
+        if model._meta.app_label == "sessions":
+            return DEFAULT_DB_ALIAS
+        return routing.read_alias
+
+    def db_for_write(self, model, **hints):
+        routing = current.get()
+        if routing is not None:
+            routing.wrote = True
+            routing.read_alias = None
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {DEFAULT_DB_ALIAS, settings.DB_READ_ALIAS}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        # The read snapshot is a copy of the migrated primary
+        if db == settings.DB_READ_ALIAS:
+            return False
+        return None
@@ -0,0 +1,367 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+from contextlib import contextmanager
+from logging import getLogger
+from pathlib import Path
+from threading import Lock
+from time import monotonic, perf_counter, time
+
+from botocore.exceptions import ClientError
+
+logger = getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class SnapshotConflict(Exception):
+    """The remote database changed since the local copy was fetched."""
+
+
+class SnapshotMetrics:
+    """
+    Running totals, in milliseconds, of the snapshot's I/O phases. Each
+    listener is also called with (phase, ms) as phases complete.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.timings = {}
+        self.counts = {}
+        self.listeners = []
+
+    @contextmanager
+    def timer(self, phase):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, (perf_counter() - start) * 1000)
+
+    def record(self, phase, ms):
+        with self._lock:
+            total, count, _ = self.timings.get(phase, (0.0, 0, 0.0))
+            self.timings[phase] = (total + ms, count + 1, ms)
+        for listener in self.listeners:
+            listener(phase, ms)
+        logger.debug("Database snapshot %s took %.1fms.", phase, ms)
+
+    def incr(self, counter, amount=1):
+        with self._lock:
+            self.counts[counter] = self.counts.get(counter, 0) + amount
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "timings": {
+                    phase: {"total_ms": total, "count": count, "last_ms": last}
+                    for phase, (total, count, last) in self.timings.items()
+                },
+                "counts": dict(self.counts),
+            }
+
+
+metrics = SnapshotMetrics()
+
+# Snapshots by settings, see Snapshot.from_settings
+_snapshots = {}
+_snapshots_lock = Lock()
+
+# Each is called with every boto3 client an S3Store creates
+client_listeners = []
+
+
+class S3Store:
+    """Remote copy of the database in an S3 bucket."""
+
+    def __init__(self, bucket, client=None):
+        self.bucket = bucket
+        if client is None:
+            # boto3 takes longer to import than the rest of the backend
+            import boto3
+
+            client = boto3.client("s3")
+            for listener in client_listeners:
+                listener(client)
+        self.client = client
+
+    def head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)["ETag"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def download(self, key, path):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.NoSuchKey:
+            return None
+        with open(path, "wb") as f:
+            f.writelines(response["Body"].iter_chunks(CHUNK_SIZE))
+        return response["ETag"]
+
+    def upload(self, key, path, if_match=None):
+        # Conditional writes: only replace the version we fetched, or only
+        # create the object if we never fetched one.
+        condition = {"IfMatch": if_match} if if_match else {"IfNoneMatch": "*"}
+        try:
+            with open(path, "rb") as f:
+                response = self.client.put_object(
+                    Bucket=self.bucket, Key=key, Body=f, **condition
+                )
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in ("PreconditionFailed", "ConditionalRequestConflict"):
+                raise SnapshotConflict(key) from e
+            raise
+        return response["ETag"]
+
+    def put(self, key, path):
+        with open(path, "rb") as f:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=f)
+
+
+class FileSystemStore:
+    """
+    Stand-in for S3Store backed by a local directory, for tests and local
+    runs of the Lambda configuration. ETags are content md5s, as on S3.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _etag(self, path):
+        digest = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return f'"{digest.hexdigest()}"'
+
+    def head(self, key):
+        path = self.root / key
+        return self._etag(path) if path.exists() else None
+
+    def download(self, key, path):
+        source = self.root / key
+        if not source.exists():
+            return None
+        shutil.copyfile(source, path)
+        return self._etag(source)
+
+    def upload(self, key, path, if_match=None):
+        if self.head(key) != if_match:
+            raise SnapshotConflict(key)
+        return self.put(key, path)
+
+    def put(self, key, path):
+        target = self.root / key
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(path, target)
+        return self._etag(target)
+
+
+class Snapshot:
+    """
+    A local copy of the remote database file, reused across invocations.
+
+    The remote ETag of the local copy is kept in a sidecar file so a warm
+    container (or a cold one whose /tmp survived) revalidates with a HEAD
+    request and only downloads when the remote object actually changed.
+
+    Writes are grouped: uploads wait until `flush_seconds` have passed since
+    the first unsaved write or `flush_changes` rows have changed, and are
+    held back entirely inside group_commit() blocks. Uploads are conditional
+    on the fetched ETag, so a container never overwrites another's writes.
+    """
+
+    def __init__(
+        self,
+        store,
+        key,
+        local_path,
+        revalidate_seconds=0,
+        flush_seconds=0,
+        flush_changes=0,
+    ):
+        self.store = store
+        self.key = key
+        self.local_path = Path(local_path)
+        self.etag_path = self.local_path.with_name(self.local_path.name + ".etag")
+        self.revalidate_seconds = revalidate_seconds
+        self.flush_seconds = flush_seconds
+        self.flush_changes = flush_changes
+        self.deferred = 0
+        self.pending_writes = 0
+        self.pending_changes = 0
+        self.connections = 0
+        self._dirty_since = None
+        self._validated_at = None
+        self._lock = Lock()
+
+    @classmethod
+    def from_settings(cls, settings_dict):
+        """
+        The snapshot for these settings, shared by the connections of every
+        thread: they share one local file, so they must share its state.
+        """
+        root = settings_dict.get("STORE_ROOT")
+        key = (
+            root or settings_dict["BUCKET"],
+            settings_dict["REMOTE_NAME"],
+            str(settings_dict["NAME"]),
+        )
+        with _snapshots_lock:
+            if key not in _snapshots:
+                store = (
+                    FileSystemStore(root) if root else S3Store(settings_dict["BUCKET"])
+                )
+                _snapshots[key] = cls(
+                    store,
+                    key=settings_dict["REMOTE_NAME"],
+                    local_path=settings_dict["NAME"],
+                    revalidate_seconds=settings_dict.get("REVALIDATE_SECONDS", 0),
+                    flush_seconds=settings_dict.get("FLUSH_SECONDS", 0),
+                    flush_changes=settings_dict.get("FLUSH_CHANGES", 0),
+                )
+            return _snapshots[key]
+
+    @property
+    def etag(self):
+        try:
+            return self.etag_path.read_text() or None
+        except FileNotFoundError:
+            return None
+
+    @etag.setter
+    def etag(self, value):
+        self.etag_path.write_text(value or "")
+
+    def fetch(self):
+        """Make sure the local copy matches the remote one."""
+        with self._lock:
+            self._fetch()
+
+    def open(self):
+        """fetch() for a new connection, which then counts as open."""
+        with self._lock:
+            self._fetch()
+            self.connections += 1
+
+    def close(self):
+        with self._lock:
+            self.connections -= 1
+
+    def defer(self, delta):
+        """Change the count of group_commit() blocks; returns the new count."""
+        with self._lock:
+            self.deferred += delta
+            return self.deferred
+
+    def _fetch(self):
+        now = monotonic()
+        if self.pending_writes or self.connections:
+            # Unsaved local writes win until they are pushed, and the file
+            # is never replaced under connections that may hold others
+            return
+        if (
+            self._validated_at is not None
+            and now - self._validated_at < self.revalidate_seconds
+        ):
+            return
+        local_etag = self.etag if self.local_path.exists() else None
+        if local_etag is not None:
+            with metrics.timer("head"):
+                remote_etag = self.store.head(self.key)
+            if remote_etag in (local_etag, None):
+                metrics.incr("reused")
+                self._validated_at = now
+                return
+        self.local_path.parent.mkdir(parents=True, exist_ok=True)
+        partial = self.local_path.with_name(self.local_path.name + ".partial")
+        try:
+            with metrics.timer("download"):
+                etag = self.store.download(self.key, partial)
+            if etag is None:
+                logger.warning(f"No remote database at {self.key}, starting empty.")
+                self.local_path.touch()
+            else:
+                os.replace(partial, self.local_path)
+                metrics.incr("downloaded")
+        finally:
+            partial.unlink(missing_ok=True)
+        self.etag = etag
+        self._validated_at = now
+
+    def change_counter(self):
+        """
+        The file change counter in the SQLite header, which moves with every
+        committed transaction. Rolled back transactions leave it (and the
+        file) untouched.
+        """
+        with open(self.local_path, "rb") as f:
+            f.seek(24)
+            return int.from_bytes(f.read(4) or b"\0", "big")
+
+    def record_write(self, changes):
+        with self._lock:
+            self.pending_writes += 1
+            self.pending_changes += changes
+            if self._dirty_since is None:
+                self._dirty_since = monotonic()
+
+    def due(self):
+        if not self.pending_writes or self.deferred:
+            return False
+        return monotonic() - self._dirty_since >= self.flush_seconds or (
+            self.flush_changes and self.pending_changes >= self.flush_changes
+        )
+
+    def copy(self, target):
+        """
+        Copy the local database with SQLite's backup API, which reads it
+        under a shared lock: connections in other threads may be committing.
+        """
+        uri = f"{self.local_path.resolve().as_uri()}?mode=ro"
+        src, dst = sqlite3.connect(uri, uri=True), sqlite3.connect(target)
+        try:
+            src.backup(dst)
+        finally:
+            src.close()
+            dst.close()
+
+    def push(self):
+        """Upload a copy of the local database if it has unsaved writes."""
+        with self._lock:
+            if not self.pending_writes:
+                return
+            upload = self.local_path.with_name(self.local_path.name + ".upload")
+            try:
+                with metrics.timer("copy"):
+                    self.copy(upload)
+                with metrics.timer("upload"):
+                    self.etag = self.store.upload(self.key, upload, if_match=self.etag)
+            except SnapshotConflict:
+                self._save_conflict(upload)
+            else:
+                metrics.incr("uploaded")
+                metrics.incr("coalesced", self.pending_writes - 1)
+            finally:
+                upload.unlink(missing_ok=True)
+            self.pending_writes = self.pending_changes = 0
+            self._dirty_since = None
+
+    def _save_conflict(self, path):
+        # Keep our copy next to the remote one for manual recovery, then
+        # fetch the remote version on the next connection.
+        conflict_key = f"{self.key}.conflict-{int(time())}"
+        self.store.put(conflict_key, path)
+        metrics.incr("conflicts")
+        logger.error(
+            f"{self.key} changed remotely since it was fetched; local writes "
+            f"saved to {conflict_key} instead."
+        )
+        self.etag = None
+        self._validated_at = None
@@ -0,0 +1,379 @@
+import os
+import sqlite3
+import tempfile
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.utils import OperationalError
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from .base import DatabaseWrapper, group_commit, read_only
+from .middleware import ReadSnapshotMiddleware
+from .replica.base import DatabaseWrapper as ReplicaDatabaseWrapper
+from .router import ReadSnapshotRouter
+from .snapshot import FileSystemStore, Snapshot, metrics
+
+
+def create_database(path, *names):
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE IF NOT EXISTS names (name TEXT)")
+    db.executemany("INSERT INTO names VALUES (?)", [(name,) for name in names])
+    db.commit()
+    db.close()
+
+
+def read_names(path):
+    db = sqlite3.connect(path)
+    try:
+        return [name for (name,) in db.execute("SELECT name FROM names ORDER BY name")]
+    finally:
+        db.close()
+
+
+class InterruptedStore(FileSystemStore):
+    """Reads each upload in two halves, calling `between()` in the middle."""
+
+    def __init__(self, root, between):
+        super().__init__(root)
+        self.between = between
+
+    def put(self, key, path):
+        with open(path, "rb") as f:
+            first = f.read(os.path.getsize(path) // 2)
+            self.between()
+            data = first + f.read()
+        (self.root / key).write_bytes(data)
+        return self._etag(self.root / key)
+
+
+class StoreTestCase(SimpleTestCase):
+    """A FileSystemStore standing in for the bucket, and a local /tmp."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = Path(directory.name) / "bucket"
+        self.root.mkdir()
+        self.local = Path(directory.name) / "tmp" / "db.sqlite3"
+        self.store = FileSystemStore(self.root)
+        self.remote = self.root / "db.sqlite3"
+
+    def counts(self):
+        return dict(metrics.as_dict()["counts"])
+
+    def assertCounted(self, before, **expected):
+        after = self.counts()
+        counted = {name: after.get(name, 0) - before.get(name, 0) for name in expected}
+        self.assertEqual(counted, expected)
+
+    def write(self, connection, *names):
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS names (name TEXT)")
+            for name in names:
+                cursor.execute("INSERT INTO names VALUES (%s)", [name])
+
+    def connect(self, alias, connection):
+        # Not in settings.DATABASES, so no test database is set up for it
+        connections[alias] = connection
+
+        def remove():
+            connection.close()
+            del connections[alias]
+
+        self.addCleanup(remove)
+        return connection
+
+    def add_alias(self, alias, **settings):
+        """Connect `alias` to an S3-backed database on this store."""
+        return self.connect(
+            alias,
+            DatabaseWrapper(
+                {
+                    **connections["default"].settings_dict,
+                    "ENGINE": "derbynames.s3sqlite",
+                    "NAME": str(self.local),
+                    "BUCKET": "",
+                    "REMOTE_NAME": "db.sqlite3",
+                    "STORE_ROOT": str(self.root),
+                    **settings,
+                },
+                alias,
+            ),
+        )
+
+
+class SnapshotTests(StoreTestCase):
+    def snapshot(self, **kwargs):
+        return Snapshot(self.store, "db.sqlite3", self.local, **kwargs)
+
+    def test_fetch_downloads_then_revalidates(self):
+        create_database(self.remote, "Ada")
+        before = self.counts()
+        snapshot = self.snapshot()
+        snapshot.fetch()
+        self.assertEqual(read_names(self.local), ["Ada"])
+        self.assertEqual(snapshot.etag, self.store.head("db.sqlite3"))
+        # Unchanged remote: one HEAD, no download
+        snapshot.fetch()
+        self.assertCounted(before, downloaded=1, reused=1)
+        timings = metrics.as_dict()["timings"]
+        self.assertGreater(timings["download"]["count"], 0)
+        self.assertGreater(timings["head"]["count"], 0)
+
+    def test_new_container_reuses_local_copy(self):
+        create_database(self.remote, "Ada")
+        self.snapshot().fetch()
+        # A cold start whose /tmp survived: the ETag sidecar is still there
+        before = self.counts()
+        self.snapshot().fetch()
+        self.assertCounted(before, downloaded=0, reused=1)
+
+    def test_remote_change_is_downloaded(self):
+        create_database(self.remote, "Ada")
+        snapshot = self.snapshot()
+        snapshot.fetch()
+        create_database(self.remote, "Bo")
+        snapshot.fetch()
+        self.assertEqual(read_names(self.local), ["Ada", "Bo"])
+
+    def test_revalidate_seconds_skip_head(self):
+        create_database(self.remote, "Ada")
+        snapshot = self.snapshot(revalidate_seconds=60)
+        snapshot.fetch()
+        create_database(self.remote, "Bo")
+        before = self.counts()
+        snapshot.fetch()
+        self.assertCounted(before, downloaded=0, reused=0)
+        self.assertEqual(read_names(self.local), ["Ada"])
+
+    def test_missing_remote_starts_empty(self):
+        snapshot = self.snapshot()
+        snapshot.fetch()
+        self.assertTrue(self.local.exists())
+        self.assertIsNone(snapshot.etag)
+
+    def test_settings_share_one_snapshot(self):
+        settings = {
+            "NAME": str(self.local),
+            "BUCKET": "",
+            "REMOTE_NAME": "db.sqlite3",
+            "STORE_ROOT": str(self.root),
+        }
+        self.assertIs(
+            Snapshot.from_settings(settings), Snapshot.from_settings(settings)
+        )
+
+
+class DatabaseWrapperTests(StoreTestCase):
+    def test_committed_writes_are_uploaded(self):
+        connection = self.add_alias("s3")
+        self.write(connection, "Ada")
+        connection.close()
+        self.assertEqual(read_names(self.remote), ["Ada"])
+
+    def test_conflicting_upload_is_kept_aside(self):
+        connection = self.add_alias("s3")
+        self.write(connection, "Ada")
+        connection.close()
+        # Another container uploads first
+        create_database(self.remote, "Bo")
+        connection.snapshot.record_write(1)
+        before = self.counts()
+        connection.snapshot.push()
+        self.assertCounted(before, uploaded=0, conflicts=1)
+        self.assertEqual(read_names(self.remote), ["Ada", "Bo"])
+        (conflict,) = self.root.glob("db.sqlite3.conflict-*")
+        self.assertEqual(read_names(conflict), ["Ada"])
+
+    def test_upload_is_consistent(self):
+        connection = self.add_alias("s3")
+        self.write(connection, *(f"Ada {i:04d}" for i in range(500)))
+        connection.close()
+
+        def commit_elsewhere():
+            # Another thread's connection commits while the file is read
+            db = sqlite3.connect(self.local)
+            db.execute("DELETE FROM names")
+            db.executemany(
+                "INSERT INTO names VALUES (?)", [(f"Bo {i:04d}",) for i in range(500)]
+            )
+            db.commit()
+            db.close()
+
+        connection.snapshot.store = InterruptedStore(self.root, commit_elsewhere)
+        connection.snapshot.record_write(1)
+        connection.snapshot.push()
+        db = sqlite3.connect(self.remote)
+        try:
+            self.assertEqual(db.execute("PRAGMA integrity_check").fetchone(), ("ok",))
+        finally:
+            db.close()
+        self.assertEqual(len(read_names(self.remote)), 500)
+
+    def test_group_commit_uploads_once(self):
+        connection = self.add_alias("s3")
+        before = self.counts()
+        with group_commit("s3"):
+            for name in ("Ada", "Bo", "Cy"):
+                self.write(connection, name)
+                connection.close()
+            self.assertFalse(self.remote.exists())
+        self.assertCounted(before, uploaded=1)
+        self.assertEqual(read_names(self.remote), ["Ada", "Bo", "Cy"])
+
+    def test_read_only_refuses_writes(self):
+        connection = self.add_alias("s3")
+        self.write(connection, "Ada")
+        with read_only("s3"), self.assertRaises(OperationalError):
+            self.write(connection, "Bo")
+        connection.close()
+        self.assertEqual(read_names(self.remote), ["Ada"])
+
+    def test_read_only_setting(self):
+        create_database(self.remote, "Ada")
+        connection = self.add_alias("s3", READ_ONLY=True)
+        with self.assertRaises(OperationalError):
+            self.write(connection, "Bo")
+        connection.close()
+        self.assertEqual(read_names(self.remote), ["Ada"])
+
+    def test_threads_share_unsaved_writes(self):
+        # Two connections stand in for two threads' connections to one alias
+        first = self.add_alias("s3", FLUSH_SECONDS=3600)
+        second = self.add_alias("s3_other", FLUSH_SECONDS=3600)
+        self.assertIs(first.snapshot, second.snapshot)
+        self.write(first, "Ada")
+        first.close()
+        self.assertFalse(self.remote.exists())
+        # Another container's upload must not replace the unsaved write
+        create_database(self.remote, "Bo")
+        with second.cursor() as cursor:
+            cursor.execute("SELECT name FROM names")
+            self.assertEqual(cursor.fetchall(), [("Ada",)])
+        second.close()
+
+    def test_open_connections_keep_their_file(self):
+        create_database(self.remote, "Ada")
+        first = self.add_alias("s3")
+        second = self.add_alias("s3_other")
+        first.ensure_connection()
+        create_database(self.remote, "Bo")
+        # Opened while the first is open: no download under it
+        with second.cursor() as cursor:
+            cursor.execute("SELECT name FROM names")
+            self.assertEqual(cursor.fetchall(), [("Ada",)])
+        first.close()
+        second.close()
+        # Once both are closed, the next connection fetches the new version
+        with first.cursor() as cursor:
+            cursor.execute("SELECT name FROM names ORDER BY name")
+            self.assertEqual(cursor.fetchall(), [("Ada",), ("Bo",)])
+
+
+class ReplicaTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.primary = self.add_alias("s3")
+        self.write(self.primary, "Ada")
+        self.primary.close()
+
+    def add_replica(self, **settings):
+        return self.connect(
+            "s3_read",
+            ReplicaDatabaseWrapper(
+                {
+                    **connections["default"].settings_dict,
+                    "ENGINE": "derbynames.s3sqlite.replica",
+                    "PRIMARY": "s3",
+                    "NAME": str(self.local.with_name("db.read.sqlite3")),
+                    **settings,
+                },
+                "s3_read",
+            ),
+        )
+
+    def read(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM names ORDER BY name")
+            names = [name for (name,) in cursor.fetchall()]
+        connection.close()
+        return names
+
+    def test_copies_primary(self):
+        replica = self.add_replica()
+        self.assertEqual(self.read(replica), ["Ada"])
+        with self.assertRaises(OperationalError):
+            self.write(replica, "Bo")
+
+    def test_refreshes_after_primary_writes(self):
+        replica = self.add_replica(REFRESH_SECONDS=0)
+        self.assertEqual(self.read(replica), ["Ada"])
+        self.write(self.primary, "Bo")
+        self.primary.close()
+        self.assertEqual(self.read(replica), ["Ada", "Bo"])
+
+    def test_refresh_seconds_keep_copy(self):
+        replica = self.add_replica(REFRESH_SECONDS=3600)
+        self.assertEqual(self.read(replica), ["Ada"])
+        self.write(self.primary, "Bo")
+        self.primary.close()
+        self.assertEqual(self.read(replica), ["Ada"])
+
+    def test_revalidates_primary_snapshot(self):
+        replica = self.add_replica(REFRESH_SECONDS=0)
+        self.assertEqual(self.read(replica), ["Ada"])
+        # Another container uploads; the primary fetches it for the copy
+        create_database(self.remote, "Cy")
+        self.assertEqual(self.read(replica), ["Ada", "Cy"])
+
+
+@override_settings(DB_READ_ALIAS="read")
+class ReadSnapshotRouterTests(SimpleTestCase):
+    router = ReadSnapshotRouter()
+
+    def get_response(self, method="get", cookies=None, write=False):
+        """Run a view through ReadSnapshotMiddleware, noting where it read."""
+        seen = {}
+
+        def view(request):
+            seen["read"] = self.router.db_for_read(User)
+            seen["session"] = self.router.db_for_read(Session)
+            if write:
+                seen["write"] = self.router.db_for_write(User)
+                seen["read_after_write"] = self.router.db_for_read(User)
+            return HttpResponse()
+
+        request = getattr(RequestFactory(), method)("/")
+        request.COOKIES.update(cookies or {})
+        response = ReadSnapshotMiddleware(view)(request)
+        return seen, response
+
+    def test_safe_requests_read_snapshot(self):
+        seen, response = self.get_response()
+        self.assertEqual(seen, {"read": "read", "session": DEFAULT_DB_ALIAS})
+        self.assertNotIn("db_primary", response.cookies)
+
+    def test_writes_switch_to_primary(self):
+        seen, response = self.get_response(write=True)
+        self.assertEqual(seen["read"], "read")
+        self.assertEqual(seen["write"], DEFAULT_DB_ALIAS)
+        self.assertEqual(seen["read_after_write"], DEFAULT_DB_ALIAS)
+        cookie = response.cookies["db_primary"]
+        self.assertEqual(cookie["max-age"], 10)
+        self.assertTrue(cookie["httponly"])
+
+    def test_primary_cookie_reads_primary(self):
+        seen, response = self.get_response(cookies={"db_primary": "1"})
+        self.assertEqual(seen["read"], DEFAULT_DB_ALIAS)
+        self.assertNotIn("db_primary", response.cookies)
+
+    def test_unsafe_requests_read_primary(self):
+        seen, _ = self.get_response(method="post")
+        self.assertEqual(seen["read"], DEFAULT_DB_ALIAS)
+
+    def test_outside_requests_use_primary(self):
+        self.assertEqual(self.router.db_for_read(User), DEFAULT_DB_ALIAS)
+        self.assertEqual(self.router.db_for_write(User), DEFAULT_DB_ALIAS)
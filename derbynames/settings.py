@@ -66,6 +66,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "derbynames.instrumentation.RequestMetricsMiddleware",
+    "derbynames.urlconf.ASGIURLConfMiddleware",
+    "derbynames.coalescing.CoalesceRequestsMiddleware",
+    "derbynames.s3sqlite.middleware.ReadSnapshotMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -73,13 +77,17 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "derbynames.s3sqlite.middleware.ReadOnlySafeMethodsMiddleware",
 ]
 
 ROOT_URLCONF = "derbynames.urls"
+# Requests served over ASGI resolve here instead (ASGIURLConfMiddleware)
+ASGI_URLCONF = "derbynames.asgi_urls"
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        # DjangoTemplates, timing renders for RequestMetricsMiddleware
+        "BACKEND": "derbynames.instrumentation.TimedDjangoTemplates",
         "DIRS": [],
         "APP_DIRS": True,
         "OPTIONS": {
@@ -104,7 +112,7 @@ STATIC_URL = f"https://{AWS_S3_CUSTOM_DOMAIN}/"
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-# If running in AWS Lambda, use django-s3-sqlite
+# If running in AWS Lambda, keep the SQLite database in S3 (see derbynames.s3sqlite)
 if os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
     ALLOWED_HOSTS.append(
         env.str(
@@ -113,9 +121,18 @@ if os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
     )
     DATABASES = {
         "default": {
-            "ENGINE": "django_s3_sqlite",
+            "ENGINE": "derbynames.s3sqlite",
             "BUCKET": S3_BUCKET_NAME,
-            "NAME": "db.sqlite3",
+            "REMOTE_NAME": "db.sqlite3",
+            "NAME": "/tmp/db.sqlite3",
+            # Seconds a warm container trusts its copy before another HEAD
+            "REVALIDATE_SECONDS": env.float("DB_REVALIDATE_SECONDS", default=0),
+            # A local directory standing in for the bucket, for testing
+            "STORE_ROOT": env.str("DB_STORE_ROOT", default=""),
+            # Group writes into one upload: wait this many seconds after the
+            # first unsaved write, or until this many rows changed (0 = off)
+            "FLUSH_SECONDS": env.float("DB_FLUSH_SECONDS", default=0),
+            "FLUSH_CHANGES": env.int("DB_FLUSH_CHANGES", default=0),
         }
     }
 else:
@@ -127,6 +144,31 @@ else:
         }
     }
 
+# Serve the reads of GET requests from a read-only, immutable local copy of
+# the database file (derbynames.s3sqlite.replica), on Lambda by default.
+# The copy is refreshed from the primary's file at most every
+# DB_READ_REFRESH_SECONDS; a browser that wrote reads from the primary for
+# DB_PRIMARY_STICKY_SECONDS, to see its own writes
+DB_READ_SNAPSHOT = env.bool(
+    "DB_READ_SNAPSHOT", default=bool(os.getenv("AWS_LAMBDA_FUNCTION_NAME"))
+)
+DB_READ_ALIAS = "read" if DB_READ_SNAPSHOT else None
+if DB_READ_SNAPSHOT:
+    primary_name = Path(DATABASES["default"]["NAME"])
+    DATABASES[DB_READ_ALIAS] = {
+        "ENGINE": "derbynames.s3sqlite.replica",
+        "PRIMARY": "default",
+        "NAME": primary_name.with_name(
+            f"{primary_name.stem}.read{primary_name.suffix}"
+        ),
+        "REFRESH_SECONDS": env.float("DB_READ_REFRESH_SECONDS", default=1.0),
+        "MMAP_SIZE": env.int("DB_READ_MMAP_SIZE", default=256 * 1024 * 1024),
+        "TEST": {"MIRROR": "default"},
+    }
+DATABASE_ROUTERS = ["derbynames.s3sqlite.router.ReadSnapshotRouter"]
+DB_PRIMARY_COOKIE = "db_primary"
+DB_PRIMARY_STICKY_SECONDS = env.int("DB_PRIMARY_STICKY_SECONDS", default=10)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -171,24 +213,48 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 STORAGES = {
     "default": {
-        "BACKEND": "storages.backends.s3.S3Storage",
+        "BACKEND": "derbynames.storage.S3Storage",
         "OPTIONS": {
             "bucket_name": S3_BUCKET_NAME,
             "custom_domain": AWS_S3_CUSTOM_DOMAIN,
+            # Jersey images are stored under their content hash and never change
+            "object_parameters": {
+                "CacheControl": "public, max-age=31536000, immutable"
+            },
         },
     },
     "staticfiles": {
-        "BACKEND": "storages.backends.s3.S3StaticStorage",
+        "BACKEND": "derbynames.storage.S3StaticStorage",
         "OPTIONS": {
             "bucket_name": S3_BUCKET_NAME,
             "custom_domain": AWS_S3_CUSTOM_DOMAIN,
         },
     },
     "mediafiles": {
-        "BACKEND": "storages.backends.s3.S3MediaStorage",
+        "BACKEND": "derbynames.storage.S3Storage",
+        "OPTIONS": {
+            "bucket_name": S3_BUCKET_NAME,
+            "custom_domain": AWS_S3_CUSTOM_DOMAIN,
+        },
+    },
+    # The name generator's compiled model: a fixed key replaced on every
+    # retrain, so not public and not cached
+    "models": {
+        "BACKEND": "derbynames.storage.S3Storage",
+        "OPTIONS": {
+            "bucket_name": S3_BUCKET_NAME,
+            "file_overwrite": True,
+            "object_parameters": {"CacheControl": "no-cache"},
+        },
+    },
+    # Static HTML export of the site (manage.py export_static)
+    "site": {
+        "BACKEND": "derbynames.storage.S3Storage",
         "OPTIONS": {
             "bucket_name": S3_BUCKET_NAME,
             "custom_domain": AWS_S3_CUSTOM_DOMAIN,
+            "location": "site",
+            "object_parameters": {"CacheControl": "public, max-age=300"},
         },
     },
 }
@@ -214,3 +280,121 @@ JERSEY_IMAGE_PROMPT = env.str(
     "JERSEY_IMAGE_PROMPT",
     default="A colorful roller derby jersey prominently displaying the name {name}",
 )
+
+# Jersey image generation queue: provider ("huggingface", "stub" or a dotted
+# path), provider calls in flight at once, and retry policy for failed jobs
+JERSEY_IMAGE_PROVIDER = env.str("JERSEY_IMAGE_PROVIDER", default="huggingface")
+JERSEY_IMAGE_MODEL = env.str(
+    "JERSEY_IMAGE_MODEL", default="black-forest-labs/FLUX.1-schnell"
+)
+JERSEY_GENERATION_CONCURRENCY = env.int("JERSEY_GENERATION_CONCURRENCY", default=4)
+JERSEY_GENERATION_MAX_ATTEMPTS = env.int("JERSEY_GENERATION_MAX_ATTEMPTS", default=5)
+JERSEY_GENERATION_BACKOFF_SECONDS = env.float(
+    "JERSEY_GENERATION_BACKOFF_SECONDS", default=30.0
+)
+# Drain on an event loop instead of threads, with this many provider calls in
+# flight per batch
+JERSEY_GENERATION_ASYNC = env.bool("JERSEY_GENERATION_ASYNC", default=False)
+JERSEY_GENERATION_ASYNC_CONCURRENCY = env.int(
+    "JERSEY_GENERATION_ASYNC_CONCURRENCY", default=32
+)
+# Running jobs older than this are assumed lost (e.g. a timed-out Lambda)
+JERSEY_GENERATION_TIMEOUT = env.int("JERSEY_GENERATION_TIMEOUT", default=900)
+
+# Resized copies of jersey images for srcset: widths in pixels, formats in
+# order of preference (formats this Pillow build cannot write are skipped)
+JERSEY_DERIVATIVE_WIDTHS = env.list(
+    "JERSEY_DERIVATIVE_WIDTHS", cast=int, default=[320, 640, 1024]
+)
+JERSEY_DERIVATIVE_FORMATS = env.list(
+    "JERSEY_DERIVATIVE_FORMATS", default=["avif", "webp"]
+)
+JERSEY_DERIVATIVE_QUALITY = env.int("JERSEY_DERIVATIVE_QUALITY", default=60)
+
+# Encoding of stored jersey originals: "png" or lossless "webp"
+JERSEY_IMAGE_FORMAT = env.str("JERSEY_IMAGE_FORMAT", default="png")
+
+# Result limits for /api/contains/<substring>/ (override with ?limit=)
+NAME_SEARCH_DEFAULT_LIMIT = env.int("NAME_SEARCH_DEFAULT_LIMIT", default=50)
+NAME_SEARCH_MAX_LIMIT = env.int("NAME_SEARCH_MAX_LIMIT", default=200)
+
+# Batch availability checks: names per request, and the false positive rate
+# of the in-memory filter that rules out untaken names without a query
+NAME_AVAILABILITY_MAX_NAMES = env.int("NAME_AVAILABILITY_MAX_NAMES", default=500)
+NAME_FILTER_ERROR_RATE = env.float("NAME_FILTER_ERROR_RATE", default=0.01)
+
+# Near-duplicate names: minimum similarity (1 - edit distance / length), how
+# many to report, and how many trigram index candidates to verify
+NAME_SIMILARITY_THRESHOLD = env.float("NAME_SIMILARITY_THRESHOLD", default=0.8)
+NAME_SIMILARITY_TOP_K = env.int("NAME_SIMILARITY_TOP_K", default=5)
+NAME_SIMILARITY_CANDIDATES = env.int("NAME_SIMILARITY_CANDIDATES", default=200)
+
+# Name generator: n-gram order (characters of context plus one), where the
+# compiled model is kept (a STORAGES alias and path), how often a warm
+# container looks for a retrained one, in seconds, and names per request
+NAME_MODEL_ORDER = env.int("NAME_MODEL_ORDER", default=4)
+NAME_MODEL_STORAGE = env.str("NAME_MODEL_STORAGE", default="models")
+NAME_MODEL_PATH = env.str("NAME_MODEL_PATH", default="models/names-ngram.bin")
+NAME_MODEL_CHECK_INTERVAL = env.float("NAME_MODEL_CHECK_INTERVAL", default=60.0)
+NAME_GENERATE_DEFAULT_COUNT = env.int("NAME_GENERATE_DEFAULT_COUNT", default=20)
+NAME_GENERATE_MAX_COUNT = env.int("NAME_GENERATE_MAX_COUNT", default=5000)
+
+# Cache-Control for pages and API responses, by policy name. Random picks are
+# cached briefly by CDNs only; the rest carry ETags for cheap revalidation.
+CACHE_POLICIES = {
+    "random": {"max_age": 0, "s_maxage": 5, "stale_while_revalidate": 30},
+    "listing": {"max_age": 60, "s_maxage": 300, "stale_while_revalidate": 3600},
+    "detail": {"max_age": 3600, "s_maxage": 86400, "stale_while_revalidate": 86400},
+}
+
+# Pre-rendered random selections for the index and jersey grid, kept in each
+# container's own cache: how many are kept, and for how many seconds before
+# they are rebuilt, which bounds how long other containers show stale names
+SELECTION_POOL_SIZE = env.int("SELECTION_POOL_SIZE", default=20)
+SELECTION_POOL_TTL = env.int("SELECTION_POOL_TTL", default=600)
+
+# Static HTML export: the STORAGES alias written to, the public URL it is
+# served from (for links between pages and sitemaps), and whether saves
+# re-render pages right away
+STATIC_EXPORT_STORAGE = env.str("STATIC_EXPORT_STORAGE", default="site")
+STATIC_EXPORT_BASE_URL = env.str(
+    "STATIC_EXPORT_BASE_URL", default=f"https://{AWS_S3_CUSTOM_DOMAIN}/site"
+)
+STATIC_EXPORT_ON_SAVE = env.bool("STATIC_EXPORT_ON_SAVE", default=False)
+
+# Per-request metrics (derbynames.instrumentation): Server-Timing header, the
+# share of requests logged as JSON, the threshold above which every request
+# is logged, and how much of the slowest SQL statement to log
+REQUEST_METRICS_SERVER_TIMING = env.bool("REQUEST_METRICS_SERVER_TIMING", default=True)
+REQUEST_METRICS_SAMPLE_RATE = env.float("REQUEST_METRICS_SAMPLE_RATE", default=0.01)
+REQUEST_METRICS_SLOW_MS = env.float("REQUEST_METRICS_SLOW_MS", default=1000.0)
+REQUEST_METRICS_SQL_LENGTH = env.int("REQUEST_METRICS_SQL_LENGTH", default=500)
+
+# Identical concurrent requests under these path prefixes share one response
+# (derbynames.coalescing), kept for this many seconds after it is rendered;
+# requests waiting on another give up and run the view after COALESCE_TIMEOUT
+COALESCE_PATHS = env.list(
+    "COALESCE_PATHS", default=["/api/random-name/", "/api/starts-with/", "/jerseys/"]
+)
+COALESCE_TTL = env.float("COALESCE_TTL", default=1.0)
+COALESCE_TIMEOUT = env.float("COALESCE_TIMEOUT", default=10.0)
+
+# Rows fetched per database round trip by the streaming name export, and the
+# most rows an XLSX export may hold: it is built in full before it is sent
+NAME_EXPORT_CHUNK_SIZE = env.int("NAME_EXPORT_CHUNK_SIZE", default=2000)
+NAME_EXPORT_XLSX_MAX_ROWS = env.int("NAME_EXPORT_XLSX_MAX_ROWS", default=100000)
+
+# Admin changelists: tables larger than this show an estimated count; CSV
+# uploads to "Import in batches" are imported this many rows at a time
+ADMIN_EXACT_COUNT_LIMIT = env.int("ADMIN_EXACT_COUNT_LIMIT", default=100000)
+ADMIN_IMPORT_BATCH_SIZE = env.int("ADMIN_IMPORT_BATCH_SIZE", default=1000)
+
+# In-process DerbyName cache reused by warm containers: memory ceiling before
+# least recently used buckets are evicted, and how often (in seconds) to check
+# the database for writes made by other containers.
+NAMES_CORPUS_MAX_BYTES = env.int("NAMES_CORPUS_MAX_BYTES", default=64 * 1024 * 1024)
+NAMES_CORPUS_CHECK_INTERVAL = env.float("NAMES_CORPUS_CHECK_INTERVAL", default=1.0)
+
+# How often (in seconds) the ids of jerseys with images, kept for random
+# picks, are checked against the database for other containers' writes
+JERSEY_IDS_CHECK_INTERVAL = env.float("JERSEY_IDS_CHECK_INTERVAL", default=1.0)
@@ -0,0 +1,23 @@
+from storages.backends import s3
+
+from derbynames.instrumentation import instrument_s3_client
+
+
+class InstrumentedConnectionMixin:
+    """Time the S3 calls of each thread's connection in the request metrics."""
+
+    @property
+    def connection(self):
+        created = getattr(self._connections, "connection", None) is None
+        connection = super().connection
+        if created:
+            instrument_s3_client(connection.meta.client)
+        return connection
+
+
+class S3Storage(InstrumentedConnectionMixin, s3.S3Storage):
+    pass
+
+
+class S3StaticStorage(InstrumentedConnectionMixin, s3.S3StaticStorage):
+    pass
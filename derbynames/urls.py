@@ -15,18 +15,34 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 
+import codecs
+
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
-from rest_framework import routers, serializers, viewsets, permissions
+from django.db.models import Prefetch
+from rest_framework import routers, serializers, viewsets, permissions, status, views
+from rest_framework.decorators import action
+from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
-from rest_framework.authtoken import views as token_views
-from drf_spectacular.views import (
-    SpectacularAPIView,
-    SpectacularRedocView,
-    SpectacularSwaggerView,
+from derbynames.lazy import api_view
+from derbynames.names.availability import name_filter
+from derbynames.names.caching import CachePolicyMixin, row_validators, table_validators
+from derbynames.names.corpus import corpus
+from derbynames.names.ingest import ingest_names, read_names
+from derbynames.names.markov import NoNameModel, name_generator
+from derbynames.names.models import DerbyJersey, DerbyName
+from derbynames.names.pagination import JerseyKeysetPagination, NameKeysetPagination
+from derbynames.names.sampling import random_name
+from derbynames.names.search import search_limit, search_names
+from derbynames.names.similarity import similar_names
+from derbynames.names.views import (
+    detail,
+    detail_validators,
+    export_names,
+    index,
+    jersey_grid,
 )
-from derbynames.names.models import DerbyName
-from derbynames.names.views import index, detail, jersey_grid
 import logging
 
 # Set up logging
@@ -41,16 +57,130 @@ class DerbyNameSerializer(serializers.HyperlinkedModelSerializer):
         fields = ["id", "name"]
 
 
+# ?fields=id,name limits the top-level objects to those fields; unknown
+# names are ignored
+class SparseFieldsetMixin:
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get("request")
+        # Only for the objects the response lists, not those nested in them;
+        # by now the serializer is bound, so its parent is known
+        top_level = self.parent is None or self.parent is self.root
+        requested = requested_fields(request) if request and top_level else None
+        if requested:
+            for field in set(fields) - requested:
+                del fields[field]
+        return fields
+
+
+def requested_fields(request):
+    requested = request.query_params.get("fields", "")
+    return {field.strip() for field in requested.split(",") if field.strip()}
+
+
+class JerseyNameSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DerbyName
+        fields = ["id", "name"]
+
+
+class DerbyJerseySerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    name = JerseyNameSerializer(read_only=True)
+    prompt = serializers.SerializerMethodField()
+    sources = serializers.SerializerMethodField()
+
+    class Meta:
+        model = DerbyJersey
+        fields = [
+            "id",
+            "name",
+            "image",
+            "image_status",
+            "image_generated_at",
+            "image_attempts",
+            "prompt",
+            "sources",
+            "updated_at",
+        ]
+
+    def get_prompt(self, jersey):
+        return jersey.get_metadata("prompt")
+
+    def get_sources(self, jersey):
+        return [
+            {"type": image_type, "srcset": srcset}
+            for image_type, srcset in jersey.image_sources()
+        ]
+
+
+class NameJerseySerializer(DerbyJerseySerializer):
+    class Meta(DerbyJerseySerializer.Meta):
+        fields = [
+            field for field in DerbyJerseySerializer.Meta.fields if field != "name"
+        ]
+
+
+class NameWithJerseysSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    jerseys = NameJerseySerializer(many=True, read_only=True)
+
+    class Meta:
+        model = DerbyName
+        fields = ["id", "name", "jerseys"]
+
+
+# Validators from the names table version, or the row for detail routes; they
+# differ per representation (JSON or the browsable API)
+class NameValidatorsMixin(CachePolicyMixin):
+    def get_validators(self):
+        variant = f"{self.request.accepted_renderer.format}-"
+        if self.kwargs.get("pk"):
+            updated_at = (
+                DerbyName.objects.filter(pk=self.kwargs["pk"])
+                .values_list("updated_at", flat=True)
+                .first()
+            )
+            return row_validators(updated_at, variant=variant)
+        return table_validators(DerbyName, variant=variant)
+
+
 # ViewSets define the view behavior.
-class DerbyNameViewSet(viewsets.ModelViewSet):
+class DerbyNameViewSet(NameValidatorsMixin, viewsets.ModelViewSet):
     queryset = DerbyName.objects.all()
     serializer_class = DerbyNameSerializer
+    pagination_class = NameKeysetPagination
+
+    @property
+    def cache_policy(self):
+        return "detail" if self.kwargs.get("pk") else "listing"
+
+    # A created name comes back with the existing names closest to it
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        response.data["similar"] = similar_names(
+            response.data["name"], exclude=response.data["id"]
+        )
+        return response
+
+    # Bulk import: a multipart "file" upload, or a text/plain or text/csv body
+    @action(detail=False, methods=["post"], parser_classes=[MultiPartParser])
+    def bulk(self, request):
+        if request.content_type.startswith("multipart/"):
+            upload = request.FILES["file"]
+            is_csv = upload.name.lower().endswith(".csv")
+            lines = codecs.iterdecode(upload, "utf-8")
+        else:
+            is_csv = request.content_type.startswith("text/csv")
+            lines = codecs.iterdecode(request.stream, "utf-8")
+        stats = ingest_names(read_names(lines, "csv" if is_csv else "text"))
+        return Response(stats, status=status.HTTP_201_CREATED)
 
 
 # RandomDerbyName returns a random DerbyName.
-class RandomDerbyNameView(viewsets.ModelViewSet):
+class RandomDerbyNameView(CachePolicyMixin, viewsets.ModelViewSet):
+    cache_policy = "random"
+
     def get_queryset(self):
-        return DerbyName.objects.order_by("?").first()
+        return random_name()
 
     def list(self, request, *args, **kwargs):
         queryset = self.get_queryset()
@@ -63,8 +193,9 @@ class RandomDerbyNameView(viewsets.ModelViewSet):
     serializer_class = DerbyNameSerializer
 
 
-class NameStartWithView(viewsets.ModelViewSet):
+class NameStartWithView(NameValidatorsMixin, viewsets.ModelViewSet):
     serializer_class = DerbyNameSerializer
+    pagination_class = NameKeysetPagination
 
     def get_queryset(self):
         start_letter = self.kwargs.get("start_letter", "").lower()
@@ -72,27 +203,150 @@ class NameStartWithView(viewsets.ModelViewSet):
             return DerbyName.objects.filter(name__istartswith=start_letter)
         return DerbyName.objects.none()
 
+    def list(self, request, *args, **kwargs):
+        # Serve listings from the in-memory corpus instead of the database
+        names = corpus.starting_with(self.kwargs.get("start_letter", "").lower())
+        page = self.paginate_queryset(names)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
     # Override the default permission to allow unauthenticated access
     permission_classes = [permissions.AllowAny]
 
 
-class NameContainsView(viewsets.ModelViewSet):
+# Search results are already ranked and capped by ?limit=, so they are not
+# cursor-paginated: a keyset on name would discard the ranking.
+class NameContainsView(NameValidatorsMixin, viewsets.ModelViewSet):
     serializer_class = DerbyNameSerializer
 
     def get_queryset(self):
         substring = self.kwargs.get("substring", "").lower()
         if substring:
-            return DerbyName.objects.filter(name__icontains=substring)
+            limit = search_limit(self.request.query_params.get("limit"))
+            return search_names(substring, limit)
         return DerbyName.objects.none()
 
     # Override the default permission to allow unauthenticated access
     permission_classes = [permissions.AllowAny]
 
 
+# Jerseys with their names, one query per page whatever its size:
+# ?status=pending|ready|failed filters by image status
+class DerbyJerseyViewSet(CachePolicyMixin, viewsets.ReadOnlyModelViewSet):
+    serializer_class = DerbyJerseySerializer
+    pagination_class = JerseyKeysetPagination
+    permission_classes = [permissions.AllowAny]
+    statuses = {
+        DerbyJersey.ImageStatus.PENDING: "pending",
+        DerbyJersey.ImageStatus.READY: "with_image",
+        DerbyJersey.ImageStatus.FAILED: "failed",
+    }
+
+    @property
+    def cache_policy(self):
+        return "detail" if self.kwargs.get("pk") else "listing"
+
+    def get_queryset(self):
+        queryset = DerbyJersey.objects.select_related("name")
+        status = self.request.query_params.get("status")
+        if status in self.statuses:
+            queryset = getattr(queryset, self.statuses[status])()
+        return queryset
+
+    def get_validators(self):
+        variant = f"{self.request.accepted_renderer.format}-"
+        if self.kwargs.get("pk"):
+            row = (
+                DerbyJersey.objects.filter(pk=self.kwargs["pk"])
+                .values_list("updated_at", "name__updated_at")
+                .first()
+            )
+            return row_validators(*row, variant=variant) if row else None
+        return table_validators(DerbyJersey, DerbyName, variant=variant)
+
+
+# Names with all their jerseys: one query for the page of names and one for
+# their jerseys (skipped when ?fields= leaves jerseys out)
+class NameWithJerseysViewSet(CachePolicyMixin, viewsets.ReadOnlyModelViewSet):
+    serializer_class = NameWithJerseysSerializer
+    pagination_class = NameKeysetPagination
+    permission_classes = [permissions.AllowAny]
+
+    @property
+    def cache_policy(self):
+        return "detail" if self.kwargs.get("pk") else "listing"
+
+    def get_queryset(self):
+        queryset = DerbyName.objects.all()
+        fields = requested_fields(self.request)
+        if not fields or "jerseys" in fields:
+            jerseys = DerbyJersey.objects.order_by("id")
+            queryset = queryset.prefetch_related(
+                Prefetch("derbyjersey_set", queryset=jerseys, to_attr="jerseys")
+            )
+        return queryset
+
+    def get_validators(self):
+        variant = f"{self.request.accepted_renderer.format}-"
+        if self.kwargs.get("pk"):
+            return detail_validators(self.request, self.kwargs["pk"], variant)
+        return table_validators(DerbyJersey, DerbyName, variant=variant)
+
+
+class NameAvailabilitySerializer(serializers.Serializer):
+    names = serializers.ListField(
+        child=serializers.CharField(max_length=100),
+        allow_empty=False,
+        max_length=settings.NAME_AVAILABILITY_MAX_NAMES,
+    )
+
+
+# Batch availability: POST {"names": [...]}; names the in-memory filter rules
+# out are answered without a query
+class NameAvailabilityView(views.APIView):
+    permission_classes = [permissions.AllowAny]
+    serializer_class = NameAvailabilitySerializer
+
+    def post(self, request):
+        serializer = NameAvailabilitySerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(name_filter.check(serializer.validated_data["names"]))
+
+
+class GenerateNamesSerializer(serializers.Serializer):
+    count = serializers.IntegerField(
+        min_value=1,
+        max_value=settings.NAME_GENERATE_MAX_COUNT,
+        default=settings.NAME_GENERATE_DEFAULT_COUNT,
+    )
+
+
+# New names from the n-gram model, none of them already taken: ?count=
+class GenerateNamesView(CachePolicyMixin, views.APIView):
+    cache_policy = "random"
+    permission_classes = [permissions.AllowAny]
+    serializer_class = GenerateNamesSerializer
+
+    def get(self, request):
+        serializer = GenerateNamesSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        try:
+            names = name_generator.generate(serializer.validated_data["count"])
+        except NoNameModel as e:
+            return Response(
+                {"detail": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        return Response(names)
+
+
 # Routers provide an easy way of automatically determining the URL conf.
 router = routers.DefaultRouter()
 router.register(r"names", DerbyNameViewSet)
 router.register(r"random-name", RandomDerbyNameView, basename="random-name")
+router.register(r"jerseys", DerbyJerseyViewSet, basename="derbyjersey")
+router.register(
+    r"names-with-jerseys", NameWithJerseysViewSet, basename="name-with-jerseys"
+)
 router.register(
     r"starts-with/(?P<start_letter>[a-zA-Z])",
     NameStartWithView,
@@ -107,19 +361,30 @@ urlpatterns = [
     path("", index, name="index"),
     path("names/<int:name_id>/", detail, name="name-detail"),
     path("jerseys/", jersey_grid, name="jersey-grid"),
+    path("api/export/names/", export_names, name="names-export"),
+    path(
+        "api/availability/",
+        NameAvailabilityView.as_view(),
+        name="name-availability",
+    ),
+    path("api/generate/", GenerateNamesView.as_view(), name="generate-names"),
     path("api/", include(router.urls)),
     path("admin/", admin.site.urls),
     path("api-auth/", include("rest_framework.urls")),
-    path("api-token-auth/", token_views.obtain_auth_token),
-    path("api/schema/", SpectacularAPIView.as_view(), name="schema"),
+    path("api-token-auth/", api_view("rest_framework.authtoken.views.ObtainAuthToken")),
+    path(
+        "api/schema/",
+        api_view("drf_spectacular.views.SpectacularAPIView"),
+        name="schema",
+    ),
     path(
         "api/schema/swagger-ui/",
-        SpectacularSwaggerView.as_view(url_name="schema"),
+        api_view("drf_spectacular.views.SpectacularSwaggerView", url_name="schema"),
         name="swagger-ui",
     ),
     path(
         "api/schema/redoc/",
-        SpectacularRedocView.as_view(url_name="schema"),
+        api_view("drf_spectacular.views.SpectacularRedocView", url_name="schema"),
         name="redoc",
     ),
 ]